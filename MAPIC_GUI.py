@@ -3,12 +3,11 @@ import tkinter.ttk as ttk
 import numpy
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import time
 from array import array
 import MAPIC_functions as MAPIC
+import MAPIC_analysis
 import json
-from scipy.stats import norm
-import scipy.optimize as sciop
+import concurrent.futures
 #==================================================================================#
 # SETUP
 # Reload previous setup from json file,
@@ -17,21 +16,14 @@ import scipy.optimize as sciop
 # setup each frame with a label and allocate sizes with grid.
 #==================================================================================#
 
-fp = open("MAPIC_utils/MAPIC_config.json","r")          # load config file in read mode
-default = json.load(fp)                                 # load default settings dictionary
-fp.close()
+default = MAPIC.load_config()                          # load default settings dictionary, shared with the APIC
+
+FRAME_MS = 100                                          # period in ms of GUI updates during acquisition
 
 def load_settings():
     ''' Write default settings to the pyboard. '''
-    apic.writeI2C(default['gainpos'],0)
-    time.sleep(0.1)
-    apic.writeI2C(default['threshpos'],1)
-    time.sleep(0.1)
-    apic.setpolarity(setpolarity=default['polarity'])
-    time.sleep(0.1)
-
-
-    apic.drain_socket()
+    apic.apply_profile(default['gainpos'], default['threshpos'], default['polarity'], default['testpulse'])
+    apic.set_peak_finder(*default['peakfinder'])
 
 def checkerror():
     # POPUP BOX WITH ERROR STATUS
@@ -60,6 +52,113 @@ polarityframe.grid(row=5,column=4,rowspan=2)
 histframe = LabelFrame(root, text='Graph Config')
 histframe.grid(row=7,column=1, columnspan=3,rowspan=5,sticky=NW)
 
+#==================================================================================#
+# HISTOGRAM CANVAS
+# One persistent figure/canvas for the whole session. The bars are updated in place
+# and blitted over a cached background so live updates during a run are cheap, the
+# full figure is only redrawn when the axes change.
+#==================================================================================#
+
+class HistCanvas:
+    ''' Persistent histogram plot in the GUI, use update to change the bar heights. '''
+
+    def __init__(self, master):
+        self.figure = plt.Figure(dpi=100)
+        self.ax = self.figure.add_subplot(111)
+        self.canvas = FigureCanvasTkAgg(self.figure, master)
+        self.canvas.get_tk_widget().grid(row=1,column=7,columnspan=1,rowspan=10)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+        self.bars = []                  # bar patches, animated so they are only drawn by blit
+        self.binedges = None            # edges the bars were created for
+        self.background = None          # cached render of everything but the bars
+        self.fitline = None             # line drawn by normfit, animated like the bars
+        self.drawpending = False        # a full draw has been asked for and not done yet
+        self.blitpending = False        # a blit is waiting for the Tk idle loop
+
+        self.ax.minorticks_on()
+        self.ax.tick_params(axis='y', which ='major',direction='in', width=1, length=16,right=True,left=True )
+        self.ax.tick_params(axis='y', which='minor',direction='in',width =1, length=8,right=True,left=True )
+        self.ax.tick_params(axis='x', which ='major',direction='in', width=1, length=5,bottom=True,top=True )
+        self.ax.tick_params(axis='x', which='minor',direction='in',width =1, length=3,bottom=True,top=True)
+
+    def labels(self, title, xlabel, ylabel):
+        self.ax.set_title(title)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.redraw()
+
+    def on_draw(self, event):
+        ''' Cache the background after a full draw, then draw the bars on top. '''
+        self.drawpending = False
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for bar in self.bars:
+            self.ax.draw_artist(bar)
+        if self.fitline is not None:
+            self.ax.draw_artist(self.fitline)
+
+    def setbins(self, binedges):
+        ''' Replace the bars, only needed when the bins or boundaries change. '''
+        for bar in self.bars:
+            bar.remove()
+        self.bars = list(self.ax.bar(binedges[:-1], numpy.zeros(len(binedges)-1), numpy.diff(binedges),
+            align='edge', color='b', edgecolor='black', animated=True))
+        self.binedges = numpy.array(binedges)
+        self.ax.set_xlim(binedges[0], binedges[-1])
+
+    def update(self, binvals, binedges, rescale=False):
+        ''' Set the bar heights to binvals, blitting unless the axes need a full redraw.
+        rescale fits the y axis tightly to the data, otherwise it only grows with headroom. '''
+        redraw = self.binedges is None or len(binedges) != len(self.binedges) or not numpy.allclose(binedges, self.binedges)
+        if redraw:
+            self.setbins(binedges)
+        for bar, val in zip(self.bars, binvals):
+            bar.set_height(val)
+
+        top = max(numpy.max(binvals) if len(binvals) else 0, 1)
+        if rescale or redraw or top > self.ax.get_ylim()[1]:
+            self.ax.set_ylim(0, top*(1.05 if rescale else 1.5))
+            self.redraw()               # on_draw recaches the background
+        else:
+            self.blit()
+
+    def redraw(self):
+        ''' Ask for a full draw, unless one is already pending: a slow backend draws once however many frames ask. '''
+        if not self.drawpending:
+            self.drawpending = True
+            self.canvas.draw_idle()
+
+    def blit(self):
+        ''' Blit the bars when Tk is next idle. Frames that come before it only change the bar heights it draws, and
+        no blit is needed while a full draw is pending, as it draws the bars too. '''
+        if self.background is None:
+            self.redraw()
+            return
+        if self.drawpending or self.blitpending:
+            return
+        self.blitpending = True
+        self.canvas.get_tk_widget().after_idle(self.blit_now)
+
+    def blit_now(self):
+        self.blitpending = False
+        if self.drawpending:
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.ax.bbox)
+
+    def setfit(self, x, y):
+        ''' Draw the normfit result, replacing the previous one. '''
+        if self.fitline is not None:
+            self.fitline.remove()
+        self.fitline, = self.ax.plot(x, y, color='r', animated=True)
+        self.blit()
+
+hist = HistCanvas(root)
+
 #==================================================================================#
 # GAUSSIAN FIT SECTION
 # The inputs for this are contained in the histogram section.
@@ -68,29 +167,55 @@ histframe.grid(row=7,column=1, columnspan=3,rowspan=5,sticky=NW)
 
 nlowbound = StringVar()
 nhighbound = StringVar()
+nlines = StringVar()
 
-def normfit():
-    binx = []
-    biny = []
-    for x, y in zip(apic.binedges[:-1],apic.binvals):
-        if x >= int(nlowbound.get()) and x <= int(nhighbound.get()):
-            binx.append(x)
-            biny.append(y)
-        else:
-            pass
-    
-    binx = numpy.array(binx)
-    biny = numpy.array(biny)
-    apic.mean, apic.std = norm.fit(binx)
+fitter = MAPIC_analysis.PeakFitter(apic.hist)
+fitpool = concurrent.futures.ThreadPoolExecutor(1)     # fits run here so the GUI stays responsive
+fitjob = None                                           # fit in progress on fitpool
+fitagain = False                                        # normfit was called while fitjob ran
+boardpool = concurrent.futures.ThreadPoolExecutor(1)   # board queries after a run, a slow reply must not freeze the GUI
 
-    def gaussian(x,A):
-        return A*numpy.exp(-0.5*((x-apic.mean)/apic.std)**2)
-            
-    global ax
-    popt, pcov = sciop.curve_fit(gaussian, binx, biny)
-    print(popt)
-    biny = gaussian(binx,popt[0])
-    ax.plot( binx, biny, color='r') #legend =r'$, \bar x = $' + str(apic.mean) + r'$, \sigma = $' + str(apic.std) + ', Resolution = ' + str((2*FWHMval)/apic.mean) )
+def fitwindow():
+    ''' Return the NORMFIT window and number of lines, None if the entries are not set. '''
+    try:
+        return (float(nlowbound.get()), float(nhighbound.get())), max(int(nlines.get() or 1), 1)
+    except ValueError:
+        return None
+
+def normfit():
+    ''' Fit the lines in the NORMFIT window on fitpool, normfit_done draws the result. Called on every live update,
+    so while a fit runs the request is only noted and the fit repeated once it finishes. '''
+    global fitjob, fitagain
+    request = fitwindow()
+    if request is None:
+        return
+    if fitjob is not None:
+        fitagain = True
+        return
+    window, lines = request
+    fitjob = fitpool.submit(fitter.fit, window, lines, apic.units)
+    root.after(FRAME_MS//4, normfit_done)
+
+def normfit_done():
+    global fitjob, fitagain
+    if not fitjob.done():
+        root.after(FRAME_MS//4, normfit_done)
+        return
+    job, fitjob = fitjob, None
+    try:
+        fit = job.result()
+    except (ValueError, RuntimeError) as error:
+        fitlabel.config(text='Fit failed: %s' % error)
+    else:
+        x = numpy.linspace(fit['window'][0], fit['window'][1], 400)
+        hist.setfit(x, fitter.curve(fit, x, apic.binedges[1] - apic.binedges[0]))
+        apic.mean, apic.std = fit['lines'][0]['centroid'], fit['lines'][0]['sigma']
+        fitlabel.config(text='\n'.join('%.1f +- %.1f %s, FWHM %.1f +- %.1f, resolution %.2f +- %.2f %%' % (line['centroid'],
+            line['centroid_err'], fit['units'], line['fwhm'], line['fwhm_err'], 100*line['resolution'],
+            100*line['resolution_err']) for line in fit['lines']))
+    if fitagain:
+        fitagain = False
+        normfit()
 
 
 #==================================================================================#
@@ -169,12 +294,13 @@ def ADC_IT_POLL():
     apic.drain_socket()
     progress['value'] = 0                               # reset progressbar
     datapoints = int(numadc.get())                      # get desired number of samples from the tkinter text entry
-    apic.ADC_IT_poll(datapoints,progress,root)          # take data using ADC_IT_poll protocol
+    progress['maximum'] = datapoints
+    receiver = apic.start_IT_poll(datapoints)           # take data using ADC_IT_poll protocol on the receiver thread
+    ADC_out.config(state=DISABLED)
+    root.after(FRAME_MS, poll_acquisition, receiver, 8, ADC_IT_POLL_done)
 
-    global histogram
-    histogram = plt.Figure(dpi=100)
-    global ax
-    ax = histogram.add_subplot(111)
+def ADC_IT_POLL_done():
+    apic.finish_IT_poll()
 
     apic.savedata(apic.data,'adc')                      # save raw data
     apic.raw_dat_count += 1
@@ -182,57 +308,94 @@ def ADC_IT_POLL():
     apic.data = numpy.average(apic.setunits(apic.data, default['units']), axis=1)   # average the ADC peak data over the columns
     apic.data = apic.data[apic.data>0]                                              # remove zeros (controvertial feature)
     
-    apic.binvals, apic.binedges, patchs = ax.hist(apic.data,apic.bins,apic.boundaries,color='b', edgecolor='black')
+    apic.rebin()
+    hist.update(apic.binvals, apic.binedges, rescale=True)
 
     # set titles and axis labels
-    ax.set_title(default['title'])
-    ax.set_xlabel(default['xlabel']+ (" (%s)") % (apic.units))
-    ax.set_ylabel(default['ylabel'])
-        
-    # add the plot to the gui
-    global bar1
-    bar1 = FigureCanvasTkAgg(histogram, root)   
-    bar1.get_tk_widget().grid(row=1,column=7,columnspan=1,rowspan=10)
+    hist.labels(default['title'], default['xlabel']+ (" (%s)") % (apic.units), default['ylabel'])
     apic.drain_socket()                     # drain socket to clear interrupt overflows
 
+def poll_acquisition(receiver, recordbytes, done, update=None):
+    ''' Update the progress bar from the receiver thread at a fixed frame rate, call done once it finishes.
+    update is called every frame to process the partial results of the run so far. '''
+    progress['value'] = receiver.progress(recordbytes)
+    if update is not None:
+        update()
+    if receiver.is_alive():
+        root.after(FRAME_MS, poll_acquisition, receiver, recordbytes, done, update)
+    else:
+        progress['value'] = progress['maximum']         # ensure progress bar is full
+        ADC_out.config(state=NORMAL)
+        done()
 
 def ADC_DMA():
     progress['value'] = 0                               # reset progressbar
     datapoints = int(numadc.get())                      # get desired number of samples from the tkinter text entry
-    apic.adc_peak_find(datapoints,progress,root)
-    
-    global histogram
-    histogram = plt.Figure(dpi=100)
-    global ax
-    ax = histogram.add_subplot(111)
-    ax.minorticks_on()
-    ax.tick_params(axis='y', which ='major',direction='in', width=1, length=16,right=True,left=True )
-    ax.tick_params(axis='y', which='minor',direction='in',width =1, length=8,right=True,left=True )
-    
-    ax.tick_params(axis='x', which ='major',direction='in', width=1, length=5,bottom=True,top=True )
-    ax.tick_params(axis='x', which='minor',direction='in',width =1, length=3,bottom=True,top=True)
+    progress['maximum'] = datapoints
+    if datapoints == 0:                                 # run until STOP, the progress bar shows the recent peaks kept
+        receiver = apic.start_continuous(compact=default['compact'])
+        progress['maximum'] = receiver.window
+        ADC_out.config(text='Stop', command=apic.stop_peak_find)
+        root.after(FRAME_MS, poll_acquisition, receiver, MAPIC.PEAK_BYTES, ADC_DMA_done, live_update)
+        return
+    if default['histogram']:                            # "full" or "delta" on-board histogram snapshots
+        receiver = apic.start_histogram(datapoints, default['histinterval'], default['histogram'] == 'delta')
+    else:
+        receiver = apic.start_peak_find(datapoints, default['compact'])    # receive the DMA stream on the receiver thread
+    ADC_out.config(state=DISABLED)
+    root.after(FRAME_MS, poll_acquisition, receiver, MAPIC.PEAK_BYTES, ADC_DMA_done, live_update)
+
+def live_update():
+    ''' Grow the displayed spectrum with the peaks received since the last frame. '''
+    apic.update_histogram()
+    apic.rebin()
+    hist.update(apic.binvals, apic.binedges)
+    showloss()
+    showrate()
+    normfit()
+
+def showloss(rejected=None, udp=None):
+    ''' Show the packet and peak loss of the DMA stream so far, and the peaks rejected and datagrams the board\n
+    failed to send if given. '''
+    stats = apic.stream_stats()
+    text = 'Lost: %i/%i packets, %i/%i peaks' % (stats['packets_lost'], stats['packets_sent'],
+        stats['peaks_lost'], stats['peaks_sent'])
+    if rejected is not None:
+        text += '\nRejected: %(narrow)i narrow, %(wide)i wide, %(pileup)i piled up' % rejected
+    if udp is not None and udp['errors'] + udp['busy'] > 0:
+        text += '\nNot sent: %(errors)i failed, %(busy)i busy' % udp
+    losslabel.config(text=text)
+
+def showboard(job):
+    ''' Add the peaks the board rejected and the datagrams it failed to send to the loss label once job, the board
+    queries of ADC_DMA_done, has its replies. '''
+    if not job.done():
+        root.after(FRAME_MS, showboard, job)
+        return
+    try:
+        showloss(*job.result())
+    except (OSError, ValueError, RuntimeError) as error:    # no reply, or the board failed the query
+        losslabel.config(text=losslabel.cget('text') + '\nBoard counts unavailable: %s' % error)
+
+def showrate():
+    ''' Show the event rate of the run so far from the peak times, see MAPIC_analysis.RateMonitor. '''
+    rate = apic.rate.stats()
+    ratelabel.config(text='%.1f Hz (%.1f Hz dead time corrected)' % (rate['smoothed'], rate['corrected']))
+
+def ADC_DMA_done():
+    ADC_out.config(text='Start', command=ADC_DMA)
+    apic.finish_peak_find()
+    showloss()
+    root.after(FRAME_MS, showboard, boardpool.submit(lambda: (apic.peak_rejected(), apic.udp_stats())))
+    showrate()
 
     apic.data = apic.setunits(apic.data, default['units'])
     # apic.data_time -> time with us resolution in same order as above
 
-    apic.binvals, apic.binedges, patchs = ax.hist(apic.data,apic.bins,apic.boundaries,color='b', edgecolor='black')
-    ax.set_title(default['title'])
-    ax.set_xlabel(default['xlabel']+ (" (%s)") % (apic.units))
-    ax.set_ylabel(default['ylabel'])
-
-    if nlowbound.get == "" or nhighbound.get() == "":
-        pass
-    else:
-        normfit()
-
-    # add the plot to the gui
-    global bar1
-    bar1 = FigureCanvasTkAgg(histogram, root)   
-    bar1.get_tk_widget().grid(row=1,column=7,columnspan=1,rowspan=10)
-
-    apic.savedata(apic.data,'adc')            # save data
-    apic.savedata(apic.data_time,'time')       # save time data
-    apic.raw_dat_count += 1
+    apic.rebin()
+    hist.update(apic.binvals, apic.binedges, rescale=True)
+    hist.labels(default['title'], default['xlabel']+ (" (%s)") % (apic.units), default['ylabel'])
+    normfit()
 
 
 # Add ADC frame widgets
@@ -248,6 +411,9 @@ ADC_out.grid(row=1,column=3)
 progress = ttk.Progressbar(ADCframe,value=0,maximum=apic.samples,length=350) # add a progress bar
 progress.grid(row=2,column=1,columnspan=3)
 
+losslabel = Label(ADCframe, text='---')
+losslabel.grid(row=3,column=1,columnspan=3)
+
 #==================================================================================#
 # POLARITY FRAME
 #==================================================================================#
@@ -276,31 +442,22 @@ unitvar = StringVar()
 lowbound = StringVar()
 highbound = StringVar()
 
+def plothist(axis):
+    ''' Draw apic.binvals, apic.binedges as a histogram on axis. '''
+    axis.hist(apic.binedges[:-1], apic.binedges, weights=apic.binvals, color='b', edgecolor='black')
+
 # CLEAR HISTOGRAM + SET NEW OPTIONS
 def set_t():
-    ax.cla()
-    ax.set_title(titlestr.get())
-    ax.set_xlabel(xstr.get())
     apic.title = titlestr.get()
     apic.xlabel = xstr.get()+(" (%s)" % (unitvar.get()))
     apic.ylabel = ystr.get()
     apic.bins = int(cbins.get())
-    ax.set_ylabel(ystr.get())
     apic.boundaries = (int(lowbound.get()),int(highbound.get()))
-    ax.minorticks_on()
-    ax.tick_params(axis='y', which ='major',direction='in', width=1, length=16,right=True,left=True )
-    ax.tick_params(axis='y', which='minor',direction='in',width =1, length=8,right=True,left=True )
-
-    ax.tick_params(axis='x', which ='major',direction='in', width=1, length=6,bottom=True,top=True )
-    ax.tick_params(axis='x', which='minor',direction='in',width =1, length=3,bottom=True,top=True)
     apic.data = apic.setunits(apic.data,unitvar.get())
-    apic.binvals, apic.binedges, patchs = ax.hist(apic.data, int(cbins.get()), (int(lowbound.get()),int(highbound.get())), color='b', edgecolor='black')
-    if nlowbound.get == "" or nhighbound.get() == "":
-        pass
-    else:
-        normfit()    
-    bar1 = FigureCanvasTkAgg(histogram, root)   
-    bar1.get_tk_widget().grid(row=1,column=7,columnspan=1,rowspan=10)
+    apic.rebin()
+    hist.update(apic.binvals, apic.binedges, rescale=True)
+    hist.labels(titlestr.get(), xstr.get(), ystr.get())
+    normfit()
 
 # SAVE HISTOGRAM WITH CURRENT SETTINGS
 def savefig():
@@ -322,9 +479,11 @@ def savefig():
     ax1.tick_params(axis='x', which='minor',direction='in',width =1, length=3,bottom=True,top=True)
 
     apic.data = apic.setunits(apic.data,unitvar.get())
-    apic.binvals, apic.binedges, patchs = ax1.hist(apic.data, int(cbins.get()), (int(lowbound.get()),int(highbound.get())), color='b', edgecolor='black')
+    apic.rebin()
+    plothist(ax1)
     
     figtemp.savefig('histdata\histogram'+apic.createfileno(apic.raw_dat_count-1)+'.png')
+    plt.close(figtemp)                  # pyplot keeps every figure open until closed
 
 ewidth = 35
 t_entr = Entry(histframe, textvariable = titlestr, width =ewidth)
@@ -362,6 +521,11 @@ normal_high_bound = Entry(histframe,textvariable=nhighbound, width=int(ewidth/2)
 normal_high_bound.grid(row=6,column=3)
 normal_low_bound = Entry(histframe,textvariable=nlowbound, width=int(ewidth/2))
 normal_low_bound.grid(row=6,column=2)
+normal_lines = Entry(histframe,textvariable=nlines, width=5)
+normal_lines.grid(row=6,column=4)
+normal_lines.insert([0], 1)
+fitlabel = Label(histframe, text='---', justify=LEFT)
+fitlabel.grid(row=7,column=1,columnspan=4,sticky=W)
 
 
 t_label = Label(histframe, text = 'TITLE:')
@@ -393,26 +557,44 @@ def f(x,a,b,c):
     return a*x**2 + b*x + c
 
 def calibrate():
-    apic.calibration()
-    cf1, cf2  = sciop.curve_fit(f, apic.inputpulses, apic.outputpulses)
-    a,b,c = cf1
+    ''' Start a calibration run, the transfer curve fit is shown as the pulses arrive until it converges. '''
+    calibration.config(state=DISABLED)
+    receiver = apic.start_calibration()
+    root.after(FRAME_MS, poll_calibration, receiver)
+
+def poll_calibration(receiver):
+    ''' Show the transfer curve fitted so far in mV, call calibrate_done once the run ends. '''
+    fit = receiver.fit.coefficients()
+    if fit is not None:
+        a, b, c = fit
+        caliblabel.config(text='y=%.3gx^2+%.4gx+%.4g (%i pulses, +-%.2f ADU)' % (a/MAPIC_analysis.MV_PER_ADU, b,
+            c*MAPIC_analysis.MV_PER_ADU, receiver.pairs, receiver.fit.stderr()))
+    if receiver.is_alive():
+        root.after(FRAME_MS, poll_calibration, receiver)
+    else:
+        calibration.config(state=NORMAL)
+        calibrate_done()
+
+def calibrate_done():
+    apic.finish_calibration()
+    a,b,c = apic.calibfit
     fig = plt.figure()
     global ax2
     ax2 = fig.add_subplot(122)
-    ax2.plot(apic.inputpulses,apic.outputpulses,label='Output/Input Transfer Curve', color='b')
-    ax2.plot(apic.inputpulses,f(apic.inputpulses,a,b,c),
+    curve = numpy.sort(apic.inputpulses)
+    ax2.plot(apic.inputpulses,apic.outputpulses,'.',label='Output/Input Transfer Curve', color='b')
+    ax2.plot(curve,f(curve,a,b,c),
         label='y = %fx^2 + %fx + %fc' % (a,b,c),linestyle='--', color='r')
     ax2.legend()
     fig.savefig('calibration.png')
     # Set apic objects for the gain/offset of the fit
     apic.calibgradient = b
     apic.caliboffset = c
-    #caliblabel.config(text='y=%fx^2+%fx+%f' % (a,b,c))
-    apic.drain_socket()
 #    ADCout.config(state=NORMAL)
 
 def rateaq():
-    ''' Acquire the rate of the source. '''
+    ''' Acquire the rate of the source with a separate counting run on the board, the label is also updated\n
+    from the peak times during every run. '''
     rate = apic.rateaq()
     ratelabel.config(text=str(rate)+'Hz')
     apic.drain_socket()
@@ -445,13 +627,15 @@ def quit():
 def savesettings():
     ''' Save updated config settings so that setup is preserved on restart. '''
     
-    fp = open("MAPIC_utils/MAPIC_config.json","w")
+    fp = open(MAPIC.CONFIG_PATH,"w")
 
     default['calibgradient'] = apic.calibgradient
     default['timeout'] = apic.tout
     default['gainpos'] = apic.posGAIN
     default['threshpos'] = apic.posTHRESH
     default['polarity'] = apic.polarity
+    default['testpulse'] = apic.testpulse
+    default['peakfinder'] = list(apic.peakfinder)
     default['title'] = apic.title
     default['bins'] = apic.bins
     default['boundaries'] = apic.boundaries
@@ -459,10 +643,15 @@ def savesettings():
     json.dump(default,fp,indent=1)
     fp.close()
 
+def exportrun():
+    ''' Convert the last saved binary run to the old text files. '''
+    apic.export_text(apic.raw_dat_count-1)
+
 # create a pulldown menu, and add it to the menu bar
 filemenu = Menu(menubar, tearoff=0)
 filemenu.add_command(label='Load',command=load_settings)
 filemenu.add_command(label='Save', command=savesettings)
+filemenu.add_command(label='Export Run As Text', command=exportrun)
 filemenu.add_separator()
 filemenu.add_command(label="Exit", command=quit)
 menubar.add_cascade(label="Menu", menu=filemenu)
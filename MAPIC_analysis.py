@@ -0,0 +1,398 @@
+'''Module containing the analysis classes used on DAQ data while it arrives, starting with the fixed resolution
+Histogram that every displayed spectrum is derived from, the PeakFitter fitting its lines and the RateMonitor giving
+the event rate from the peak times.'''
+
+import numpy
+
+ADC_BITS = 12                                       # pyboard ADC resolution
+ADC_RANGE = 1 << ADC_BITS                           # number of possible ADC values
+MV_PER_ADU = 3300/4096                              # conversion used by APIC.setunits
+FWHM_SIGMA = 2*numpy.sqrt(2*numpy.log(2))           # FWHM of a gaussian in sigma
+
+class Histogram:
+    '''Histogram of ADC values at the full 12 bit resolution of the ADC, one base bin per ADU.\n
+    Events are added incrementally with add, and any user chosen binning is derived from the base counts with\n
+    rebin, so changing bins, boundaries or units costs O(4096) rather than a pass over every event.'''
+
+    def __init__(self):
+        self.counts = numpy.zeros(ADC_RANGE, dtype='int64')    # base counts, index is the ADC value
+        self.version = 0                                        # incremented whenever the counts change
+
+    def reset(self):
+        '''Clear all counts, used at the start of a new run.'''
+        self.counts[:] = 0
+        self.version += 1
+
+    def add(self, adc):
+        '''Add an array of integer ADC values (0-4095) to the base counts.'''
+        if len(adc) == 0:
+            return
+        self.counts += numpy.bincount(adc, minlength=ADC_RANGE)[:ADC_RANGE]
+        self.version += 1
+
+    def total(self):
+        '''Return the number of events in the histogram.'''
+        return int(self.counts.sum())
+
+    def peak(self, width=50, iterations=3):
+        '''Return a dictionary of statistics of the highest line in the histogram, in ADU: the peaks in it, its\n
+        centroid, sigma, the standard error of the centroid and the FWHM resolution as a fraction of the centroid.\n
+        The line starts as width ADU either side of the fullest bin and is narrowed to 3 sigma of the centroid\n
+        over a few iterations, so the flat background far from the line is left out.\n
+        self.peak(width=50, iterations=3)'''
+        centroid = float(numpy.argmax(self.counts))
+        sigma = width/3
+        values = numpy.arange(ADC_RANGE)
+        for i in range(iterations):
+            low, high = int(max(centroid - 3*sigma, 0)), int(min(centroid + 3*sigma, ADC_RANGE - 1))
+            counts = self.counts[low:high + 1]
+            n = int(counts.sum())
+            if n < 2:
+                return {'peaks': n, 'centroid': centroid, 'sigma': 0.0, 'stderr': float('inf'), 'resolution': 0.0}
+            centroid = float(numpy.dot(values[low:high + 1], counts)/n)
+            sigma = max(float(numpy.sqrt(numpy.dot((values[low:high + 1] - centroid)**2, counts)/(n - 1))), 0.5)
+        return {'peaks': n, 'centroid': centroid, 'sigma': sigma, 'stderr': sigma/numpy.sqrt(n),
+            'resolution': 2.3548*sigma/centroid if centroid > 0 else 0.0}
+
+    def rebin(self, bins, boundaries, units='ADU'):
+        '''Return (binvals, binedges) for bins equal bins between boundaries, in the same form as numpy.histogram.\n
+        self.rebin(bins, boundaries, units)\n
+        Arguments:
+            \t bins: number of bins
+            \t boundaries: tuple of (low, high) histogram range in the given units
+            \t units: string specifying the units of boundaries and edges, can be "mV" or "ADU".'''
+        if units == 'ADU':
+            scale = 1
+        elif units == 'mV':
+            scale = MV_PER_ADU
+        else:
+            raise ValueError('Unit is not supported. Acceptable values are "mV" or "ADU"')
+
+        low, high = boundaries
+        binedges = numpy.linspace(low, high, bins + 1)
+        values = numpy.arange(ADC_RANGE)*scale                  # position of each base bin in the chosen units
+
+        inrange = (values >= low) & (values <= high)
+        idx = numpy.floor((values[inrange] - low)*(bins/(high - low))).astype('int64')
+        idx[idx == bins] = bins - 1                             # upper boundary belongs to the last bin, as numpy.histogram
+        binvals = numpy.bincount(idx, weights=self.counts[inrange], minlength=bins)
+        return binvals, binedges
+
+FIT_CACHE = 16                                      # fit results kept by a PeakFitter
+
+class PeakFitter:
+    '''Fit one or several gaussian lines on a linear background to a window of a Histogram. The fit uses the base\n
+    counts at one bin per ADU, so it does not depend on the displayed binning. The window is selected with an array\n
+    mask, each line is seeded from the count weighted moments of its part of the window, and all the lines and the\n
+    background are fitted together with the analytic jacobian. Results are cached per histogram version, window and\n
+    number of lines, so a redraw returns the last fit and only a histogram that has changed is fitted again.\n
+    PeakFitter(hist)\n
+    Arguments:
+        \t hist: the Histogram to fit'''
+
+    def __init__(self, hist):
+        self.hist = hist
+        self.cache = {}                                 # (version, low, high, lines) -> result in ADU
+
+    def window(self, window, units='ADU'):
+        '''Return the (low, high) ADC values of the base bins inside window, given in units "mV" or "ADU".'''
+        scale = MV_PER_ADU if units == 'mV' else 1
+        values = numpy.arange(ADC_RANGE)*scale
+        inside = numpy.nonzero((values >= window[0]) & (values <= window[1]))[0]
+        if len(inside) == 0:
+            raise ValueError('Fit window %s %s holds no ADC values' % (window, units))
+        return int(inside[0]), int(inside[-1])
+
+    @staticmethod
+    def model(x, params, middle):
+        '''Return the sum of the gaussian lines and the linear background at the ADC values x, and the jacobian.\n
+        params holds amplitude, centroid and sigma of each line then the background level at ADC value middle and\n
+        its slope.'''
+        x = numpy.asarray(x, dtype='float64')
+        lines = (len(params) - 2)//3
+        jacobian = numpy.empty((len(x), len(params)))
+        y = params[-2] + params[-1]*(x - middle)
+        for i in range(lines):
+            amplitude, centroid, sigma = params[3*i:3*i + 3]
+            u = (x - centroid)/sigma
+            g = numpy.exp(-0.5*u*u)
+            y = y + amplitude*g
+            jacobian[:, 3*i] = g
+            jacobian[:, 3*i + 1] = amplitude*g*u/sigma
+            jacobian[:, 3*i + 2] = amplitude*g*u*u/sigma
+        jacobian[:, -2] = 1
+        jacobian[:, -1] = x - middle
+        return y, jacobian
+
+    def seed(self, x, y, lines):
+        '''Return starting parameters for model from the counts y at x: the background is the line through the\n
+        mean counts at each end of the window, the lines are the highest maxima left after it is subtracted, each\n
+        seeded with the weighted moments of the counts between the midpoints to its neighbours.'''
+        edge = max(len(x)//10, 1)
+        left, right = y[:edge].mean(), y[-edge:].mean()
+        slope = (right - left)/max(len(x) - edge, 1)
+        level = (left + right)/2
+        signal = numpy.clip(y - level - slope*(x - (x[0] + x[-1])/2), 0, None)
+
+        rest = numpy.convolve(signal, numpy.ones(3)/3, 'same')
+        maxima = []
+        for i in range(lines):
+            top = int(numpy.argmax(rest))
+            if rest[top] <= 0:
+                raise ValueError('Found %i of %i lines in the fit window' % (i, lines))
+            below = numpy.nonzero(rest < rest[top]/2)[0]
+            halfwidth = max(top - below[below < top].max() if (below < top).any() else top,
+                below[below > top].min() - top if (below > top).any() else len(x) - top, 1)
+            rest[max(top - 2*halfwidth, 0):top + 2*halfwidth + 1] = 0
+            maxima.append(top)
+        maxima.sort()
+
+        params = []
+        cuts = [0] + [(a + b)//2 + 1 for a, b in zip(maxima[:-1], maxima[1:])] + [len(x)]
+        for start, stop in zip(cuts[:-1], cuts[1:]):
+            w, v = signal[start:stop], x[start:stop]
+            n = w.sum()
+            if n <= 0:
+                raise ValueError('No counts above the background for a line in the fit window')
+            centroid = float(numpy.dot(w, v)/n)
+            sigma = max(float(numpy.sqrt(numpy.dot(w, (v - centroid)**2)/n)), 0.5)
+            params += [float(w.max()), centroid, sigma]
+        return numpy.array(params + [level, slope])
+
+    def fit(self, window, lines=1, units='ADU'):
+        '''Return a dictionary of the fit of lines gaussian lines on a linear background to the counts in window.\n
+        self.fit(window, lines=1, units='ADU')\n
+        Arguments:
+            \t window: tuple of (low, high) fit range in the given units
+            \t lines: number of lines fitted together
+            \t units: string specifying the units of window and of the results, can be "mV" or "ADU"\n
+        The result holds "lines", a list with the centroid, fwhm, resolution (fwhm/centroid), counts and sigma of each\n
+        line with their standard errors under the same name + "_err", and the background, chi2, dof, version, units,\n
+        window and params of the fit in ADU for curve. Raises ValueError if the window has too few counts or bins and\n
+        RuntimeError if the fit does not converge.'''
+        import scipy.optimize as sciop
+
+        if units not in ('ADU', 'mV'):
+            raise ValueError('Unit is not supported. Acceptable values are "mV" or "ADU"')
+        version = self.hist.version
+        low, high = self.window(window, units)
+        key = (version, low, high, lines)
+        if key not in self.cache:
+            x = numpy.arange(low, high + 1, dtype='float64')
+            y = self.hist.counts[low:high + 1].astype('float64')
+            if len(x) <= 3*lines + 2 or y.sum() < 3*lines + 2:
+                raise ValueError('Too few bins or counts in the fit window for %i lines' % lines)
+            error = numpy.sqrt(numpy.maximum(y, 1))         # poisson, an empty bin counts as one
+            middle = (low + high)/2
+            params, covariance = sciop.curve_fit(lambda x, *p: self.model(x, p, middle)[0], x, y,
+                self.seed(x, y, lines), error, absolute_sigma=True, jac=lambda x, *p: self.model(x, p, middle)[1])
+            params[2:3*lines:3] = numpy.abs(params[2:3*lines:3])
+            residual = (y - self.model(x, params, middle)[0])/error
+            if len(self.cache) >= FIT_CACHE:
+                del self.cache[next(iter(self.cache))]
+            self.cache[key] = (params, covariance, float(residual @ residual), len(x) - len(params))
+        params, covariance, chi2, dof = self.cache[key]
+        return self.result(params, covariance, chi2, dof, units, version, (low, high))
+
+    def result(self, params, covariance, chi2, dof, units, version, window):
+        '''Return the dictionary of fit for the fitted params and their covariance in ADU.'''
+        scale = MV_PER_ADU if units == 'mV' else 1
+        lines = []
+        for i in range(0, len(params) - 2, 3):
+            amplitude, centroid, sigma = params[i:i + 3]
+            c = covariance[i:i + 3, i:i + 3]
+            counts = amplitude*sigma*numpy.sqrt(2*numpy.pi)
+            resolution = FWHM_SIGMA*sigma/centroid
+            # first order propagation of the covariance to counts and resolution
+            dcounts = numpy.array([sigma, 0, amplitude])*numpy.sqrt(2*numpy.pi)
+            dresolution = numpy.array([0, -resolution/centroid, FWHM_SIGMA/centroid])
+            lines.append({'centroid': centroid*scale, 'centroid_err': numpy.sqrt(c[1, 1])*scale,
+                'sigma': sigma*scale, 'sigma_err': numpy.sqrt(c[2, 2])*scale,
+                'fwhm': FWHM_SIGMA*sigma*scale, 'fwhm_err': FWHM_SIGMA*numpy.sqrt(c[2, 2])*scale,
+                'resolution': resolution, 'resolution_err': numpy.sqrt(dresolution @ c @ dresolution),
+                'counts': counts, 'counts_err': numpy.sqrt(dcounts @ c @ dcounts)})
+        return {'lines': lines, 'background': (params[-2], params[-1]/scale), 'chi2': chi2, 'dof': dof,
+            'version': version, 'units': units, 'window': (window[0]*scale, window[1]*scale), 'params': params}
+
+    def curve(self, fit, x, binwidth=None):
+        '''Return the counts the fit expects in bins of binwidth centred on x, both in the units of the fit. binwidth\n
+        defaults to one ADU, so the curve lies on the base counts.'''
+        scale = MV_PER_ADU if fit['units'] == 'mV' else 1
+        binwidth = scale if binwidth is None else binwidth
+        middle = (fit['window'][0] + fit['window'][1])/2/scale
+        return self.model(numpy.asarray(x, dtype='float64')/scale, fit['params'], middle)[0]*binwidth/scale
+
+DEADTIME_INTERVALS = 100                            # intervals seen before the dead time is estimated from them
+
+class RateMonitor:
+    '''Event rate of a run estimated continuously from the peak times as they arrive, so no separate counting run\n
+    is needed. Times are taken as intervals between consecutive peaks, intervals going backwards are left out as\n
+    they come from a reordered packet. The rate is given over a sliding window, exponentially smoothed and\n
+    corrected for the dead time of the peak finder.\n
+    RateMonitor(window=1.0, smoothing=2.0, deadtime=None)\n
+    Arguments:
+        \t window: seconds of the most recent peaks in rate
+        \t smoothing: time constant in seconds of smoothed
+        \t deadtime: non-paralysable dead time in us, None to estimate it from the shortest interval seen'''
+
+    def __init__(self, window=1.0, smoothing=2.0, deadtime=None):
+        self.window = window
+        self.smoothing = smoothing
+        self.fixed_deadtime = deadtime
+        self.reset()
+
+    def reset(self):
+        '''Forget every peak, used at the start of a new run.'''
+        self.last = None                                # time in us of the last peak added
+        self.counts = numpy.zeros(0, dtype='int64')     # peaks in each segment of the window
+        self.durations = numpy.zeros(0, dtype='int64')  # us of each segment of the window
+        self.ema = None
+        self.peaks = 0                                  # peaks over the whole run
+        self.livetime = 0                               # us over the whole run
+        self.intervals = 0                              # intervals between peaks seen, for the dead time estimate
+        self.interval_sum = 0
+        self.shortest = None
+
+    def add(self, time_us):
+        '''Add the times in us of the peaks received since the last call, in the order they arrived.'''
+        times = numpy.asarray(time_us, dtype='int64')
+        if len(times) == 0:
+            return
+        if self.last is not None:
+            times = numpy.concatenate(([self.last], times))    # the first interval starts at the last peak added
+        self.last = int(times[-1])
+        intervals = numpy.diff(times)
+        intervals = intervals[intervals >= 0]
+        if len(intervals) == 0:
+            return
+        self.intervals += len(intervals)
+        self.interval_sum += int(intervals.sum())
+        shortest = int(intervals.min())
+        self.shortest = shortest if self.shortest is None else min(self.shortest, shortest)
+        self.segments(numpy.ones(len(intervals), dtype='int64'), intervals)
+
+    def add_counts(self, peaks, seconds):
+        '''Add peaks counted over seconds, for streams without peak times such as the on-board histogram.'''
+        if seconds > 0:
+            self.segments(numpy.array([peaks], dtype='int64'), numpy.array([int(seconds*1E6)], dtype='int64'))
+
+    def segments(self, counts, durations):
+        '''Add segments of counts peaks over durations us, keeping the fewest recent ones that span the window.'''
+        total = int(durations.sum())
+        if total <= 0:
+            return
+        n = int(counts.sum())
+        self.peaks += n
+        self.livetime += total
+        # weight of the new segments for their duration, the run so far is averaged evenly until it is longer than smoothing
+        alpha = max(1 - numpy.exp(-total*1E-06/self.smoothing), total/self.livetime)
+        self.ema = n*1E06/total if self.ema is None else self.ema + alpha*(n*1E06/total - self.ema)
+
+        self.counts = numpy.concatenate((self.counts, counts))
+        self.durations = numpy.concatenate((self.durations, durations))
+        spans = numpy.cumsum(self.durations[::-1])
+        keep = min(int(numpy.searchsorted(spans, self.window*1E6)) + 1, len(spans))
+        self.counts, self.durations = self.counts[-keep:], self.durations[-keep:]
+
+    def rate(self):
+        '''Return the measured rate in Hz over the last window seconds.'''
+        total = int(self.durations.sum())
+        return int(self.counts.sum())*1E06/total if total > 0 else 0.0
+
+    def smoothed(self):
+        '''Return the exponentially smoothed measured rate in Hz.'''
+        return float(self.ema) if self.ema is not None else 0.0
+
+    def mean(self):
+        '''Return the measured rate in Hz over the whole run.'''
+        return self.peaks*1E06/self.livetime if self.livetime > 0 else 0.0
+
+    def deadtime(self):
+        '''Return the dead time in us, the fixed one if given. Otherwise it is estimated as the start of the\n
+        exponential distribution of intervals, from the shortest interval less its expected excess (mean - shortest)/n,\n
+        and 0 until DEADTIME_INTERVALS intervals have been seen.'''
+        if self.fixed_deadtime is not None:
+            return float(self.fixed_deadtime)
+        n = self.intervals
+        if n < DEADTIME_INTERVALS:
+            return 0.0
+        return max((n*self.shortest - self.interval_sum/n)/(n - 1), 0.0)
+
+    def corrected(self, rate=None):
+        '''Return the true rate in Hz of a measured rate (smoothed if not given) for the non-paralysable dead time.'''
+        rate = self.smoothed() if rate is None else rate
+        lost = rate*self.deadtime()*1E-06               # fraction of the time the peak finder is dead
+        return rate/(1 - lost) if lost < 1 else float('inf')
+
+    def stats(self):
+        '''Return a dictionary of the windowed, smoothed and whole run rates in Hz, the smoothed rate corrected for\n
+        dead time, the dead time in us and the number of peaks.'''
+        return {'rate': self.rate(), 'smoothed': self.smoothed(), 'mean': self.mean(), 'corrected': self.corrected(),
+            'deadtime': self.deadtime(), 'peaks': self.peaks}
+
+class TransferFit:
+    '''Least squares fit of the quadratic transfer curve output = a*input**2 + b*input + c, updated as pulse pairs\n
+    arrive. Only the sums of the normal equations are kept, so adding pairs costs O(pairs) and solving the fit O(1),\n
+    and the fit has converged once the standard error of the curve is below a tolerance over the inputs seen. The\n
+    sums are replaced as a whole on every add, so another thread may read the fit while pairs are being added.\n
+    TransferFit(scale=ADC_RANGE)\n
+    Arguments:
+        \t scale: inputs and outputs are divided by scale before they are summed, so the powers of them stay near 1'''
+
+    def __init__(self, scale=ADC_RANGE):
+        self.scale = scale
+        self.reset()
+
+    def reset(self):
+        '''Forget every pair.'''
+        # sums of v v^T and v*output with v = (input**2, input, 1), of output**2, number of pairs and input range
+        self.state = (numpy.zeros((3, 3)), numpy.zeros(3), 0.0, 0, numpy.inf, -numpy.inf)
+
+    def add(self, inputs, outputs):
+        '''Add arrays of input and output pulse heights in ADU.'''
+        x = numpy.asarray(inputs, dtype='float64')/self.scale
+        y = numpy.asarray(outputs, dtype='float64')/self.scale
+        if len(x) == 0:
+            return
+        v = numpy.stack((x*x, x, numpy.ones_like(x)))
+        sums, moments, squares, n, low, high = self.state
+        self.state = (sums + v @ v.T, moments + v @ y, squares + float(y @ y), n + len(x), min(low, float(x.min())),
+            max(high, float(x.max())))
+
+    def pairs(self):
+        '''Return the number of pairs added.'''
+        return self.state[3]
+
+    def solve(self):
+        '''Return (theta, inverse normal matrix, residual variance) of the scaled fit, None if it cannot be solved.'''
+        sums, moments, squares, n, low, high = self.state
+        if n <= 3:
+            return None
+        try:
+            inverse = numpy.linalg.inv(sums)
+        except numpy.linalg.LinAlgError:
+            return None                                 # fewer than 3 distinct inputs
+        theta = inverse @ moments
+        return theta, inverse, max(squares - float(theta @ moments), 0.0)/(n - 3)
+
+    def coefficients(self):
+        '''Return (a, b, c) of the transfer curve in ADU, None until it can be fitted.'''
+        fit = self.solve()
+        if fit is None:
+            return None
+        a, b, c = fit[0]
+        return float(a/self.scale), float(b), float(c*self.scale)
+
+    def stderr(self):
+        '''Return the largest standard error in ADU of the fitted output over the inputs seen, inf until it can be fitted.'''
+        fit = self.solve()
+        if fit is None:
+            return float('inf')
+        theta, inverse, variance = fit
+        x = numpy.linspace(self.state[4], self.state[5], 5)
+        v = numpy.stack((x*x, x, numpy.ones_like(x)))
+        return float(numpy.sqrt(variance*numpy.einsum('in,ij,jn->n', v, inverse, v).max()))*self.scale
+
+    def converged(self, tol, minpairs):
+        '''Return True once there are minpairs pairs and the standard error of the curve is at most tol ADU.'''
+        return self.pairs() >= minpairs and self.stderr() <= tol
@@ -0,0 +1,234 @@
+'''Throughput benchmark of the host DAQ path against a local MAPIC_sim board. Run from the repository folder:
+
+    $ python MAPIC_bench.py --sizes 10000,100000,1000000 --rate 200000 --output bench.json
+    $ python MAPIC_bench.py --compare bench.json          # rerun and compare with earlier results
+    $ python MAPIC_bench.py --imports                     # only check the import time budget of MAPIC_functions
+
+For every acquisition path and run size it reports events/s, packets/s, drop percentage, wall and CPU time of each
+stage (acquire, decode, histogram, rebin, save, text export, plot) and peak RSS, and writes them as JSON. Each run is
+taken in a fresh process, so its peak RSS is that of the run alone, next to the RSS of the process before it started.
+The time a fresh interpreter takes to import MAPIC_functions is measured first and must stay within IMPORT_BUDGET.
+
+The peak stream paths and the on-board histogram paths (read_dma modes 2 and 3) are covered. ADC_IT_poll is left out:
+it is the legacy path where the board samples each test pulse from a python interrupt and sends the samples on the
+command socket after fixed sleeps, so its rate is set by the board and the pulser, not by the host, and the simulator
+does not model it.'''
+
+import concurrent.futures
+import multiprocessing
+import subprocess
+import tempfile
+import argparse
+import platform
+import shutil
+import numpy
+import json
+import time
+import sys
+import os
+
+import MAPIC_functions as MAPIC
+import MAPIC_runfile
+import MAPIC_analysis
+
+try:
+    import resource                                 # not available on windows
+except ImportError:
+    resource = None
+
+IMPORT_BUDGET = 0.3                                 # seconds a fresh interpreter may take to import MAPIC_functions
+HEADLESS = ('tkinter', 'matplotlib', 'scipy')       # modules MAPIC_functions must not import
+PATHS = ('blocking', 'polled', 'compact', 'histogram', 'histogram_delta')
+                                                    # adc_peak_find, start_peak_find polled as the GUI does, polled with
+                                                    # the compact delta encoded stream, and start_histogram polled with
+                                                    # full and delta snapshots
+
+def peak_rss():
+    '''Return the peak resident set size of this process in MB, or None where it cannot be measured.'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss/2**20 if sys.platform == 'darwin' else rss/2**10, 1)
+
+def import_time(module='MAPIC_functions', repeat=5):
+    '''Return the fastest of repeat imports of module, each in a fresh interpreter started in the repository folder,\n
+    in seconds and the list of HEADLESS modules it loaded.'''
+    script = ('import sys, time; start = time.perf_counter(); import %s; '
+        'print(time.perf_counter() - start, *[m for m in %r if m in sys.modules])' % (module, HEADLESS))
+    best = float('inf')
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)))
+        out = out.decode().split()
+        best = min(best, float(out[0]))
+    return best, out[1:]
+
+class Stage:
+    '''Context manager recording the wall and CPU time of one benchmark stage into a results dictionary.'''
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def __exit__(self, *exc):
+        self.results[self.name] = {'wall': time.perf_counter() - self.wall, 'cpu': time.process_time() - self.cpu}
+
+def acquire(apic, datpts, path):
+    '''Run one acquisition, returning its duration.'''
+    start = time.perf_counter()
+    if path.startswith('histogram'):
+        apic.start_histogram(datpts, delta=path == 'histogram_delta', save=False)
+    else:
+        apic.start_peak_find(datpts, path == 'compact')
+    if path != 'blocking':
+        while apic.receiver.is_alive():
+            apic.receiver.join(0.1)                 # GUI frame period
+            apic.update_histogram()
+            apic.rebin()
+    else:
+        apic.receiver.join()
+    return time.perf_counter() - start
+
+def bench_run(apic, datpts, path, tmpdir, plot):
+    '''Benchmark one acquisition and the processing of its data, returning the results dictionary. A histogram run\n
+    has no peaks to decode, its counts are saved and exported instead.'''
+    stages = {}
+    with Stage(stages, 'acquire'):
+        elapsed = acquire(apic, datpts, path)
+    apic.receiver.raise_error()
+    stats = apic.stream_stats()
+
+    if path.startswith('histogram'):
+        words = apic.receiver.counts
+        with Stage(stages, 'histogram'):
+            hist = MAPIC_analysis.Histogram()
+            hist.counts[:] = words
+    else:
+        words = apic.receiver.received(apic.receiver.recordwords)
+        with Stage(stages, 'decode'):
+            data, data_time = apic.receiver.decode()
+        with Stage(stages, 'histogram'):
+            hist = MAPIC_analysis.Histogram()
+            hist.add(data)
+    with Stage(stages, 'rebin'):
+        hist.rebin(apic.bins, apic.boundaries)
+    for codec in (None, 'zlib'):
+        path_out = os.path.join(tmpdir, 'bench.mapic')
+        with Stage(stages, 'save_%s' % (codec or 'raw')):
+            writer = MAPIC_runfile.RunWriter(path_out, {}, words.dtype.name, codec)
+            for chunk in range(0, len(words), MAPIC.WRITE_CHUNK//words.itemsize):
+                writer.write(words[chunk:chunk + MAPIC.WRITE_CHUNK//words.itemsize])
+            writer.close()
+        stages['save_%s' % (codec or 'raw')]['bytes'] = os.path.getsize(path_out)
+    with Stage(stages, 'export_text'):
+        if path.startswith('histogram'):
+            numpy.savetxt(os.path.join(tmpdir, 'ADC_hist.txt'), words, fmt='%d')
+        else:
+            numpy.savetxt(os.path.join(tmpdir, 'ADC_count.txt'), data)
+            numpy.savetxt(os.path.join(tmpdir, 'data_time.txt'), numpy.column_stack(divmod(data_time, 1000000)), fmt='%d.%06d')
+    if plot:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        with Stage(stages, 'plot'):
+            binvals, binedges = hist.rebin(apic.bins, apic.boundaries)
+            figure = Figure(dpi=100)
+            FigureCanvasAgg(figure)
+            figure.add_subplot(111).bar(binedges[:-1], binvals, numpy.diff(binedges), align='edge')
+            figure.canvas.draw()
+
+    return {'path': path, 'datpts': datpts, 'peaks': stats['peaks'], 'packets': stats['packets'],
+        'seconds': elapsed, 'events_per_s': stats['peaks']/elapsed, 'packets_per_s': stats['packets']/elapsed,
+        'drop_percent': 100*stats['peaks_lost']/max(stats['peaks_sent'], 1), 'stream': stats, 'stages': stages,
+        'peak_rss_mb': peak_rss()}
+
+def bench_process(port, local, datpts, path, tmpdir, plot, config):
+    '''Run bench_run in this fresh process against the simulator on port and return its results, with base_rss_mb\n
+    the peak RSS of the process before the run. Commands are sent from local, a port no earlier run used, as the\n
+    board would answer a command tag it has seen from the same port with its cached reply.'''
+    apic = MAPIC.APIC(5, ('127.0.0.1', port), port=local, config=config)
+    try:
+        base = peak_rss()
+        result = bench_run(apic, datpts, path, tmpdir, plot)
+    finally:
+        apic.sock.close()
+        apic.sockdma.close()
+        apic.catalog.close()
+    result['base_rss_mb'] = base
+    return result
+
+def compare(results, baseline):
+    '''Print the ratio of events/s and stage CPU time against earlier results for matching runs.'''
+    old = {(r['path'], r['datpts']): r for r in baseline['results']}
+    for r in results:
+        b = old.get((r['path'], r['datpts']))
+        if b is None:
+            continue
+        print('%-15s %9i  events/s x%.2f' % (r['path'], r['datpts'], r['events_per_s']/b['events_per_s']), end='')
+        for name, stage in r['stages'].items():
+            if name in b['stages'] and b['stages'][name]['cpu'] > 0:
+                print('  %s x%.2f' % (name, stage['cpu']/b['stages'][name]['cpu']), end='')
+        print()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MAPIC host DAQ path against MAPIC_sim.')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma separated run sizes in peaks')
+    parser.add_argument('--rate', type=float, default=200000, help='simulated event rate in Hz')
+    parser.add_argument('--loss', type=float, default=0, help='simulated datagram loss probability')
+    parser.add_argument('--reorder', type=float, default=0, help='simulated datagram reorder probability')
+    parser.add_argument('--paths', default=','.join(PATHS), help='comma separated acquisition paths to run')
+    parser.add_argument('--port', type=int, default=8080, help='simulator control port, run i sends its commands from port + 1 + i')
+    parser.add_argument('--noplot', action='store_true', help='skip the matplotlib plot stage')
+    parser.add_argument('--output', default='bench_results.json', help='file to write the JSON results to')
+    parser.add_argument('--compare', default=None, help='earlier JSON results to compare against')
+    parser.add_argument('--imports', action='store_true', help='only check the import time budget')
+    args = parser.parse_args()
+
+    seconds, loaded = import_time()
+    imports = {'seconds': seconds, 'budget': IMPORT_BUDGET, 'loaded': loaded}
+    print('import MAPIC_functions %.3fs (budget %.3fs)%s' % (seconds, IMPORT_BUDGET,
+        ', loaded ' + ' '.join(loaded) if loaded else ''))
+    if args.imports:
+        sys.exit(seconds > IMPORT_BUDGET or len(loaded) > 0)
+
+    os.makedirs('histdata', exist_ok=True)
+    config = dict(MAPIC.load_config(), savemode=False)     # the save stage is measured separately
+    sim = subprocess.Popen([sys.executable, 'MAPIC_sim.py', '--port', str(args.port), '--rate', str(args.rate),
+        '--loss', str(args.loss), '--reorder', str(args.reorder), '--seed', '1'], stdout=subprocess.DEVNULL)
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    try:
+        time.sleep(1)                               # let the simulator bind
+        runs = [(int(n), path) for n in args.sizes.split(',') for path in args.paths.split(',')]
+        for i, (datpts, path) in enumerate(runs):
+            # spawned, not forked, so the process does not start with the peak RSS of this one
+            with concurrent.futures.ProcessPoolExecutor(1, multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(bench_process, args.port, args.port + 1 + i, datpts, path, tmpdir, not args.noplot,
+                    config).result()
+            results.append(result)
+            print('%-15s %9i peaks  %10.0f events/s  %8.0f packets/s  %5.2f%% dropped  %s MB peak RSS (%s before)' % (
+                path, datpts, result['events_per_s'], result['packets_per_s'], result['drop_percent'],
+                result['peak_rss_mb'], result['base_rss_mb']))
+            print('    ' + '  '.join('%s %.3fs' % (name, stage['cpu']) for name, stage in result['stages'].items()))
+    finally:
+        sim.terminate()
+        shutil.rmtree(tmpdir)
+
+    try:
+        version = subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        version = None
+    output = {'version': version, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+        'numpy': numpy.__version__, 'platform': platform.platform(), 'rate': args.rate, 'loss': args.loss, 'reorder': args.reorder,
+        'imports': imports, 'results': results}
+    with open(args.output, 'w') as fp:
+        json.dump(output, fp, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
+
+if __name__ == '__main__':
+    main()
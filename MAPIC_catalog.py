@@ -0,0 +1,175 @@
+'''Module containing the RunCatalog class, an sqlite index of the runs saved in histdata. Every saved run is recorded
+when it starts and completed when it finishes, with its files, time span, event count, pot positions, polarity and
+summary statistics, so the next run number and queries over past runs never have to list the folder or open a data
+file. A catalog that does not exist yet is built once from the files already in the folder.
+
+    $ python MAPIC_catalog.py --gain 134 --days 7
+    >>> catalog = RunCatalog('histdata/catalog.sqlite')
+    >>> catalog.next_run('run'), catalog.query(gainpos=134, since=time.time() - 7*86400)'''
+
+import argparse
+import sqlite3
+import json
+import time
+import os
+import re
+import numpy
+
+import MAPIC_runfile
+
+CATALOG_NAME = 'catalog.sqlite'                     # catalog file in the data folder
+COLUMNS = ('prefix', 'run', 'format', 'paths', 'start', 'end', 'events', 'gainpos', 'threshpos', 'polarity', 'stats')
+RUN_NAME = re.compile(r'^(.*?)(\d{4})(\.mapic)?$')                      # run file or continuous run folder
+TEXT_NAME = re.compile(r'^(ADC_count|data_time|ADC_hist)(\d{4})\.txt$')  # text files of runs with the "run" prefix
+
+class RunCatalog:
+    '''Index of the runs in one data folder, kept in an sqlite file in it. A run is identified by the prefix of its\n
+    file names and its number. paths and stats are stored as JSON, stats holds whatever summary the run was\n
+    finished with (centroid, resolution, rate, losses...).\n
+    RunCatalog(path)\n
+    Arguments:
+        \t path: sqlite file of the catalog, built from the files in its folder if it does not exist'''
+
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS runs (prefix TEXT, run INTEGER, format TEXT, paths TEXT, '
+                'start REAL, end REAL, events INTEGER, gainpos INTEGER, threshpos INTEGER, polarity INTEGER, stats TEXT, '
+                'PRIMARY KEY (prefix, run))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS runs_start ON runs (start)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS runs_settings ON runs (gainpos, threshpos)')
+        if new:
+            self.rebuild()
+
+    def close(self):
+        self.db.close()
+
+    def next_run(self, prefix):
+        '''Return the number after the highest run recorded with prefix, numbers of deleted runs are not reused.'''
+        row = self.db.execute('SELECT MAX(run) FROM runs WHERE prefix = ?', (prefix,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def start(self, prefix, run, header, paths):
+        '''Record a run as it starts, from the header of its run file, so its number is taken even if it never\n
+        finishes. A run already recorded, one being resumed, is left as it is.'''
+        form = 'continuous' if header.get('continuous') else header.get('format')
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?, NULL, NULL, ?, ?, ?, NULL)', (prefix, run,
+                form, json.dumps(paths), header.get('start'), header.get('gainpos'), header.get('threshpos'),
+                header.get('polarity')))
+
+    def finish(self, prefix, run, events, stats, paths=None, end=None):
+        '''Complete the record of a run with its end time, number of events and summary stats, and its files if given.'''
+        with self.db:
+            self.db.execute('UPDATE runs SET end = ?, events = ?, stats = ? WHERE prefix = ? AND run = ?',
+                (time.time() if end is None else end, events, json.dumps(stats), prefix, run))
+            if paths is not None:
+                self.db.execute('UPDATE runs SET paths = ? WHERE prefix = ? AND run = ?', (json.dumps(paths), prefix, run))
+
+    def add_paths(self, prefix, run, paths):
+        '''Add files to a run, such as its text export, recording the run if it is not in the catalog yet.'''
+        record = self.get(prefix, run)
+        with self.db:
+            if record is None:
+                self.db.execute('INSERT INTO runs (prefix, run, format, paths, start) VALUES (?, ?, ?, ?, ?)',
+                    (prefix, run, 'text', json.dumps(paths), time.time()))
+            else:
+                self.db.execute('UPDATE runs SET paths = ? WHERE prefix = ? AND run = ?',
+                    (json.dumps(record['paths'] + [path for path in paths if path not in record['paths']]), prefix, run))
+
+    def get(self, prefix, run):
+        '''Return the record of one run as a dictionary, None if it is not in the catalog.'''
+        row = self.db.execute('SELECT * FROM runs WHERE prefix = ? AND run = ?', (prefix, run)).fetchone()
+        return None if row is None else self.record(row)
+
+    def query(self, since=None, until=None, **settings):
+        '''Return the records of the runs that started between since and until (unix times, None for no limit)\n
+        and match every keyword, e.g. query(gainpos=134, polarity=1, since=time.time() - 7*86400), oldest first.'''
+        unknown = set(settings) - set(COLUMNS)
+        if unknown:
+            raise ValueError('Runs have no %s, query one of %s' % (', '.join(sorted(unknown)), ', '.join(COLUMNS)))
+        clauses = ['%s = ?' % name for name in settings]
+        values = list(settings.values())
+        if since is not None:
+            clauses.append('start >= ?')
+            values.append(since)
+        if until is not None:
+            clauses.append('start < ?')
+            values.append(until)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return [self.record(row) for row in self.db.execute('SELECT * FROM runs%s ORDER BY start, run' % where, values)]
+
+    def record(self, row):
+        record = dict(row)
+        record['paths'] = json.loads(record['paths']) if record['paths'] else []
+        record['stats'] = json.loads(record['stats']) if record['stats'] else {}
+        return record
+
+    def rebuild(self):
+        '''Record the runs of the files in the catalog folder that are not recorded yet. Peak run files and the parts of\n
+        continuous runs are sized from their chunk lengths and histogram runs from their counts, other run files\n
+        and text files only give their paths and times.'''
+        folder = os.path.dirname(self.path) or '.'
+        runs = {}
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            match = TEXT_NAME.match(name)
+            key = ('run', int(match.group(2))) if match else None
+            if key is None:
+                match = RUN_NAME.match(name)
+                if match is None or (match.group(3) is None) != os.path.isdir(path):
+                    continue
+                key = (match.group(1), int(match.group(2)))
+            runs.setdefault(key, []).append(path)
+
+        for (prefix, run), paths in runs.items():
+            if self.get(prefix, run) is not None:
+                continue
+            files = MAPIC_runfile.run_files(paths)
+            header, events, mtimes = {'format': 'text'}, None, [os.path.getmtime(path) for path in files or paths]
+            starts = []
+            for path in files:
+                if path.endswith('.mapic'):
+                    try:
+                        header, nbytes = MAPIC_runfile.scan_run(path)
+                    except (OSError, ValueError):
+                        continue                    # not a run file, or unreadable
+                    if header.get('format') == 'histogram':
+                        events = (events or 0) + int(MAPIC_runfile.load_run(path)[1].sum())  # one count per ADC value
+                    elif header.get('format') == 'peak':
+                        # whole peak records of the words saved, whatever word size they were written as
+                        record = max(MAPIC_runfile.PEAK_RECORD, numpy.dtype(header['dtype']).itemsize)
+                        events = (events or 0) + nbytes//record
+                    starts.append(header.get('start', min(mtimes)))
+            self.start(prefix, run, dict(header, start=min(starts) if starts else min(mtimes)), files or paths)
+            self.finish(prefix, run, events, {}, end=max(mtimes))
+
+def main():
+    parser = argparse.ArgumentParser(description='List the runs in the MAPIC run catalog.')
+    parser.add_argument('--folder', default='histdata', help='data folder holding the catalog')
+    parser.add_argument('--prefix', default=None, help='run file prefix, e.g. run or board0_run')
+    parser.add_argument('--gain', type=int, default=None, help='gain pot position')
+    parser.add_argument('--thresh', type=int, default=None, help='threshold pot position')
+    parser.add_argument('--polarity', type=int, default=None, help='1 positive, 0 negative')
+    parser.add_argument('--days', type=float, default=None, help='only runs started in the last days')
+    parser.add_argument('--rebuild', action='store_true', help='record files in the folder missing from the catalog')
+    args = parser.parse_args()
+
+    catalog = RunCatalog(os.path.join(args.folder, CATALOG_NAME))
+    if args.rebuild:
+        catalog.rebuild()
+    settings = {name: value for name, value in (('prefix', args.prefix), ('gainpos', args.gain),
+        ('threshpos', args.thresh), ('polarity', args.polarity)) if value is not None}
+    since = time.time() - args.days*86400 if args.days is not None else None
+    for record in catalog.query(since=since, **settings):
+        print('%s%04i  %-10s %s  %9s events  gain %4s  thresh %4s  polarity %4s  %s' % (record['prefix'], record['run'],
+            record['format'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['start'])) if record['start'] else '-',
+            record['events'], record['gainpos'], record['threshpos'], record['polarity'],
+            ' '.join('%s=%.4g' % item for item in record['stats'].items() if isinstance(item[1], (int, float)))))
+    catalog.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+'''Module containing the acknowledged command protocol of main.py and the asyncio ControlClient for it.
+
+Every command travels in one datagram with its arguments and is answered with one reply:
+    request: command bytes a, b + tag (uint16) + arguments
+    reply:   command bytes a, b + tag (uint16) + status byte + reply data
+
+Replies are matched to requests by tag, so several queries can be in flight at once, and a request without a reply
+is resent with the same tag. The board keeps its last replies and answers such a retry without running the command
+twice. APIC.command is the blocking version used by the GUI.
+
+    >>> async def setup():
+    ...     client = await ControlClient.connect(('192.168.4.1', 8080))
+    ...     print(await client.apply_profile(134, 128, 1))
+    ...     print(await asyncio.gather(client.read_i2c(), client.check_state()))
+    >>> asyncio.run(setup())'''
+
+import asyncio
+import socket
+import struct
+
+REQUEST = struct.Struct('<BBH')                     # a, b, tag
+REPLY = struct.Struct('<BBHB')                      # a, b, tag, status
+ACK_OK = 0                                          # command ran, reply data follows
+ACK_ERROR = 1                                       # command raised an exception on the board
+ACK_UNKNOWN = 2                                     # the board has no such command
+CMD_TIMEOUT = 0.2                                   # seconds to wait for a reply before resending
+CMD_RETRIES = 5                                     # resends before giving up
+RATE_TIME = 4                                       # seconds the board counts for in rateaq
+
+def request(a,b,tag,args=b''):
+    '''Return the datagram of command a, b with its argument bytes.'''
+    return REQUEST.pack(a, b, tag) + bytes(args)
+
+def parse_reply(data):
+    '''Return (a, b, tag, status, reply data) of a reply datagram, or None for anything else.'''
+    if len(data) < REPLY.size:
+        return None
+    return REPLY.unpack_from(data) + (bytes(data[REPLY.size:]),)
+
+def check_status(a,b,status):
+    '''Raise the error reported by the board for command a, b.'''
+    if status == ACK_UNKNOWN:
+        raise ValueError('The board does not know command [%i,%i]' % (a, b))
+    elif status != ACK_OK:
+        raise RuntimeError('The board failed to run command [%i,%i]' % (a, b))
+
+class ControlClient(asyncio.DatagramProtocol):
+    '''asyncio client for the acknowledged commands of one board, create it with ControlClient.connect.\n
+    ControlClient(ipv4, timeout=CMD_TIMEOUT, retries=CMD_RETRIES)\n
+    Arguments:
+        \t ipv4: (ip, port) tuple of the board
+        \t timeout: seconds to wait for each reply before resending
+        \t retries: resends before a command raises socket.timeout'''
+
+    def __init__(self, ipv4, timeout=CMD_TIMEOUT, retries=CMD_RETRIES):
+        self.ipv4 = tuple(ipv4)
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = None
+        self.tag = 0                                # tag of the last request
+        self.pending = {}                           # tag -> (command, future) of every request waiting for its reply
+
+    @classmethod
+    async def connect(cls, ipv4, port=0, timeout=CMD_TIMEOUT, retries=CMD_RETRIES):
+        '''Return a ControlClient bound to the local port, any free port by default.'''
+        loop = asyncio.get_running_loop()
+        transport, client = await loop.create_datagram_endpoint(lambda: cls(ipv4, timeout, retries),
+            local_addr=('0.0.0.0', port))
+        return client
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = parse_reply(data)
+        if reply is None:
+            return
+        command, future = self.pending.get(reply[2], (None, None))
+        if command == reply[:2] and not future.done():
+            future.set_result(reply)
+
+    def close(self):
+        self.transport.close()
+
+    async def command(self, a, b, args=b'', timeout=None):
+        '''Send command a, b with its argument bytes and return the reply data once the board acknowledges it.\n
+        timeout is the wait for each attempt, self.timeout by default.'''
+        timeout = self.timeout if timeout is None else timeout
+        self.tag = (self.tag + 1) % 65536
+        tag = self.tag
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag] = ((a, b), future)
+        try:
+            datagram = request(a, b, tag, args)
+            for attempt in range(self.retries + 1):
+                self.transport.sendto(datagram, self.ipv4)
+                try:
+                    reply = await asyncio.wait_for(asyncio.shield(future), timeout)
+                    break
+                except asyncio.TimeoutError:
+                    continue
+            else:
+                raise socket.timeout('No reply from the board to command [%i,%i]' % (a, b))
+        finally:
+            del self.pending[tag]
+        check_status(a, b, reply[3])
+        return reply[4]
+
+    # COMMANDS OF main.py
+    async def read_i2c(self):
+        '''Return the (gain, threshold) potentiometer positions.'''
+        reply = await self.command(0, 0)
+        return reply[0], reply[1]
+
+    async def scan_i2c(self):
+        '''Return the list of I2C addresses found on the board.'''
+        return list(await self.command(0, 2))
+
+    async def write_i2c(self, pos, pot):
+        '''Set potentiometer pot (0 gain, 1 threshold) to the 8 bit position pos.'''
+        await self.command(1, pot, bytes([pos]))
+
+    async def set_polarity(self, polarity):
+        await self.command(4, polarity)
+
+    async def set_testpulse(self, enable):
+        await self.command(6, 1 if enable else 0)
+
+    async def rate(self):
+        '''Return the event rate in Hz counted by the board over RATE_TIME seconds.'''
+        reply = await self.command(5, 1, timeout=RATE_TIME + self.timeout)
+        return int.from_bytes(reply, 'little', signed=False)
+
+    async def check_state(self):
+        return (await self.command(7, 1)).decode('utf-8')
+
+    async def set_state(self, state):
+        await self.command(7, 0, state.encode('utf-8'))
+
+    async def set_dest(self, dmaport):
+        '''Point the DMA stream of the board at dmaport of this host, see APIC.setdest.'''
+        await self.command(8, 0, dmaport.to_bytes(2, 'little', signed=False))
+
+    async def start_peak_find(self, datpts, compact=False):
+        '''Start streaming datpts peaks, acknowledged once the board has started, see APIC.start_peak_find.'''
+        await self.command(2, 3 if compact else 0, datpts.to_bytes(4, 'little', signed=False))
+
+    async def start_histogram(self, datpts, interval=100, delta=False):
+        '''Start counting datpts peaks in the on-board histogram, see APIC.start_histogram.'''
+        await self.command(2, 6 if delta else 5, datpts.to_bytes(4, 'little', signed=False) +
+            interval.to_bytes(2, 'little', signed=False))
+
+    async def start_calibration(self, port, maxtime=10):
+        '''Start streaming calibration pulse pairs to port of this host for at most maxtime seconds, see\n
+        APIC.start_calibration.'''
+        await self.command(5, 0, port.to_bytes(2, 'little', signed=False) + maxtime.to_bytes(2, 'little', signed=False))
+
+    async def stop_calibration(self):
+        '''End the calibration stream, the board sends the pulses left and an empty datagram.'''
+        await self.command(5, 2)
+
+    async def peak_config(self, threshold, min_width=0, max_width=0, pileup=0):
+        '''Set the peak finder of the DMA stream, see APIC.set_peak_finder.'''
+        await self.command(9, 0, b''.join(int(v).to_bytes(2, 'little', signed=False)
+            for v in (threshold, min_width, max_width, pileup)))
+
+    async def peak_rejected(self):
+        '''Return the (narrow, wide, pileup) peaks rejected in the last DMA stream, see APIC.peak_rejected.'''
+        reply = await self.command(9, 1)
+        return tuple(int.from_bytes(reply[i:i + 4], 'little', signed=False) for i in range(0, 12, 4))
+
+    async def dma_buffer(self, size=None):
+        '''Set the DMA buffer size if given and return (size, overruns), see APIC.dma_buffer.'''
+        reply = await self.command(9, 2, b'' if size is None else size.to_bytes(2, 'little', signed=False))
+        return int.from_bytes(reply[:2], 'little'), int.from_bytes(reply[2:6], 'little')
+
+    async def udp_stats(self):
+        '''Return the (sent, errors, busy) datagrams of the last DMA stream, see APIC.udp_stats.'''
+        reply = await self.command(9, 3)
+        return tuple(int.from_bytes(reply[i:i + 4], 'little', signed=False) for i in range(0, 12, 4))
+
+    async def apply_profile(self, gainpos, threshpos, polarity, testpulse=0):
+        '''Apply both potentiometers, polarity and test pulses in one command, see APIC.apply_profile.\n
+        Returns the (gain, threshold, polarity, testpulse) read back by the board.'''
+        return tuple(await self.command(1, 2, bytes([gainpos, threshpos, polarity, testpulse])))
@@ -1,34 +1,736 @@
-'''Module containing APIC Class with methods to control pyboard peripherals and the measurement protocols.'''
+'''Module containing APIC Class with methods to control pyboard peripherals and the measurement protocols. It is the
+headless core of the package: it needs no display and imports no GUI or plotting modules, so scripts and daemons can
+use it without the startup cost of tkinter and matplotlib. Settings are only read from the config file by load_config.'''
 
-import matplotlib.pyplot as plt
-import tkinter.ttk as ttk
 from array import array
-from tkinter import *
 import datetime     # for measuring rates
 import socket       # Low level networking module
+import threading    # background data receiver
 import numpy
 import json
 import time
 import os           # for file saving
+import MAPIC_runfile
+import MAPIC_analysis
+import MAPIC_catalog
+import MAPIC_control
 
-fp = open("MAPIC_utils/MAPIC_config.json","r")              # open the json config file in read mode
-default = json.load(fp)                                     # load default settings dictionary
-fp.close()                                                  # close so we can open again later
+CONFIG_PATH = os.path.join('MAPIC_utils', 'MAPIC_config.json')    # settings file, relative to the repository folder
+DEFAULTS = {'timeout': 10, 'ipv4': ['192.168.4.1', 8080], 'savemode': True, 'codec': None, 'compact': False,
+    'histogram': None, 'histinterval': 100, 'rateaqtime': 4, 'ratewindow': 1.0, 'ratesmoothing': 2.0, 'deadtime': None,
+    'gainpos': 134, 'threshpos': 128, 'title': 'Internal Test Pulses', 'calibgradient': 1, 'caliboffset': 0, 'bins': 50,
+    'polarity': 1, 'testpulse': 0, 'peakfinder': [500, 0, 0, 0], 'units': 'ADU', 'xlabel': 'MAPIC output',
+    'ylabel': 'Counts', 'boundaries': [2450, 2525]}        # settings used until load_config, CONFIG_PATH starts as a copy
+default = dict(DEFAULTS)                                    # settings of new APIC objects, updated by load_config
+
+RECV_POLL = 0.2                                             # receiver thread socket timeout in seconds
+STOP_LINGER = 0.05                                          # seconds of quiet the stream is read for after a stop, the board
+                                                            # sends its last partly filled packet on the next half buffer
+MAX_PAYLOAD_SIZE = 1472                                     # largest DMA stream datagram, see MAX_PAYLOAD_SIZE in adc.c
+PEAK_BYTES = 8                                              # bytes per peak record: time_s word + (time_us << 12 | adc) word
+HEADER_WORDS = 4                                            # DMA stream packet header: seq, peaks in packet, peaks sent before, format
+HEADER_BYTES = 4*HEADER_WORDS
+STREAM_PEAKS = 0                                            # header format id of the 8 byte peak records
+PEAK_DTYPE = MAPIC_runfile.PEAK_DTYPE                       # 8 byte peak record, packed is (time_us << 12) | adc
+STREAM_COMPACT = 1                                          # header format id of the 4 byte delta encoded records
+COMPACT_HEADER_WORDS = HEADER_WORDS + 2                     # compact header adds the 64 bit time in us before the packet
+DELTA_BITS = 20                                             # bits of delta_us in a compact word, longer gaps use escape words
+STREAM_HIST = 2                                             # header format id of on-board histogram snapshots
+STREAM_HIST_DELTA = 3                                       # as STREAM_HIST, each snapshot holds the counts since the last one
+HIST_HEADER_WORDS = HEADER_WORDS + 2                        # histogram header adds the first bin and (packets << 16) | bins
+HIST_FINAL = 1 << 31                                        # flag on the snapshot number of the last snapshot of a run
+HIST_INTERVAL = 100                                         # default milliseconds between histogram snapshots
+IT_POLL_PAYLOAD_SIZE = 1000                                 # ADC_IT_poll datagram, 500 unsigned 16 bit samples
+CAL_PAIRS = 90                                              # pulse pairs in a full calibration datagram, see cbcal in main.py
+CAL_PAIR_BYTES = 16                                         # 4 output then 4 input unsigned 16 bit samples per pulse
+CAL_TIME = 10                                               # most seconds the board calibrates for
+CAL_TOL = 0.5                                               # standard error in ADU of the transfer curve at which calibration ends
+CAL_MIN_PAIRS = 200                                         # pulse pairs needed before the fit is checked
+CAL_MAX_PAIRS = 200000                                      # pulse pairs kept of one calibration
+WRITE_CHUNK = 1 << 16                                       # bytes received between run file writes
+DECODE_BLOCK = 1 << 16                                      # peaks decoded at a time where a temporary is needed
+CONTINUOUS_WINDOW = 1 << 20                                 # most recent peaks a continuous run keeps in memory
+SPILL_BUFFER = 1 << 20                                      # bytes a continuous run receives at most between spills
+SPILL_INTERVAL = 0.1                                        # seconds between spills of a continuous run
+SPILL_BYTES = 1 << 28                                       # size in bytes at which a continuous run starts its next part file
+SPILL_TIME = 3600                                           # seconds after which a continuous run starts its next part file
+
+def load_config(path=CONFIG_PATH):
+    '''Update default with the settings in the json config file at path and return it, settings missing from the\n
+    file keep their DEFAULTS value. A missing file is first written with DEFAULTS, so the shipped settings are only\n
+    kept here. The GUI and command line tools call this at startup, nothing is read at import.\n
+    load_config(path=CONFIG_PATH)'''
+    if not os.path.exists(path):
+        with open(path, 'w') as fp:
+            json.dump(DEFAULTS, fp, indent=1)
+    with open(path, 'r') as fp:
+        default.update(json.load(fp))
+    return default
+
+def decode_peaks(words,clock=None):
+    '''Decode raw DMA stream words into ADC values and integer peak times in microseconds from the start of the run.\n
+    The board sends its cycle counter cut to 20 bits as the time, see MAPIC_runfile.BoardClock for how it is\n
+    unwrapped and when the times are right.\n
+    decode_peaks(words, clock=None)\n
+    Arguments:
+        \t words: stream words of whole peak records, in the order they arrived
+        \t clock: MAPIC_runfile.BoardClock of the records before words when a run is decoded in pieces, None for a whole run\n
+    Returns (adc, time_us) numpy arrays of uint16 and int64.'''
+    records = words.view(PEAK_DTYPE)                        # zero-copy, one record per peak
+    clock = MAPIC_runfile.BoardClock() if clock is None else clock
+
+    # write each column straight into its final array, no float or full size temporaries
+    data = numpy.bitwise_and(records['packed'], 4095, out=numpy.empty(len(records), dtype='uint16'), casting='unsafe')
+    data_time = numpy.empty(len(records), dtype='int64')
+    for start in range(0, len(records), DECODE_BLOCK):      # blocks keep the unwrapping temporaries small
+        clock.times(records[start:start + DECODE_BLOCK], data_time[start:start + DECODE_BLOCK])
+    return data, data_time
+
+def decode_compact(words,bases,lengths):
+    '''Decode compact DMA stream words into ADC values and absolute peak times in microseconds, as decode_peaks.\n
+    decode_compact(words, bases, lengths)\n
+    Arguments:
+        \t words: compact words of consecutive packets, without their headers
+        \t bases: time in us of the peak before each packet, from the packet headers
+        \t lengths: number of words in each packet\n
+    Returns (adc, time_us) numpy arrays of uint16 and int64.'''
+    adc = numpy.bitwise_and(words, 4095, out=numpy.empty(len(words), dtype='uint16'), casting='unsafe')
+    escape = adc == 0                                       # escape words carry the high bits of a long gap
+    delta = (words >> 12).astype('int64')
+    delta[escape] <<= DELTA_BITS
+    elapsed = numpy.cumsum(delta)
+
+    # restart the running sum at the base time of every packet, so a lost packet does not shift the ones after it
+    starts = numpy.cumsum(lengths) - lengths
+    before = numpy.concatenate(([0], elapsed))[starts]
+    elapsed += numpy.repeat(numpy.asarray(bases, dtype='int64') - before, lengths)
+    return adc[~escape], elapsed[~escape]
+
+def encode_peaks(adc,time_us):
+    '''Encode ADC values and integer peak times in us as the 8 byte peak records of STREAM_PEAKS, the inverse\n
+    of decode_peaks. Used to save compact runs in the same format as every other run.'''
+    words = numpy.empty(2*len(adc), dtype='uint32')
+    words[0::2] = time_us // 1000000
+    words[1::2] = ((time_us % 1000000) << 12) | adc
+    return words
+
+class StreamReceiver(threading.Thread):
+    '''Background thread receiving a UDP data stream into one preallocated buffer so acquisition does not\n
+    depend on how fast tkinter redraws. The thread is the only writer and publishes the number of bytes\n
+    received after each datagram, readers only look at the buffer below that offset so no lock is needed.\n
+    StreamReceiver(sock, nbytes, chunk, dtype, tout, handshake=None)\n
+    Arguments:
+        \t sock: bound socket to receive from
+        \t nbytes: number of bytes after which the run is complete
+        \t chunk: largest datagram expected in bytes
+        \t dtype: numpy dtype of the buffer words
+        \t tout: seconds without any data before the run is abandoned
+        \t handshake: optional function run on the thread before receiving, used to start the board
+        \t writer: optional MAPIC_runfile.RunWriter the data is streamed to while it arrives
+        \t record: size in bytes of one record, only whole records are passed to the writer'''
+
+    def __init__(self,sock,nbytes,chunk,dtype,tout,handshake=None,writer=None,record=PEAK_BYTES):
+        threading.Thread.__init__(self,daemon=True)
+        self.sock = sock
+        self.nbytes = nbytes
+        self.chunk = chunk
+        self.tout = tout
+        self.handshake = handshake
+        self.writer = writer
+        self.record = record
+
+        # room for one extra datagram as the board only stops sending once it has passed nbytes
+        self.buffer = numpy.zeros(nbytes + chunk, dtype='uint8').view(dtype)
+        self.offset = 0                                     # number of bytes received so far
+        self.packets = 0                                    # number of datagrams received so far
+        self.written = 0                                    # number of bytes passed to the writer so far
+        self.error = None                                   # exception that ended the run early
+        self.linger = 0                                     # seconds of quiet to receive for once stopped
+        self.stopped = threading.Event()
+
+    def run(self):
+        bufview = memoryview(self.buffer).cast('B')         # byte view so recv_into can write at any offset
+        self.sock.settimeout(RECV_POLL)                     # short timeout so stop() is noticed quickly
+        idle = 0
+        try:
+            if self.handshake is not None:
+                self.handshake()
+
+            # Receive each datagram straight into the buffer at the current offset, only the bytes
+            # actually sent are counted so no stale words end up in the data.
+            while not self.complete() and not self.stopped.is_set():
+                try:
+                    self.step(bufview)
+                except socket.timeout:
+                    idle += RECV_POLL
+                    if idle >= self.tout:
+                        raise
+                    continue
+                idle = 0
+            self.receive_rest(bufview)
+        except Exception as err:
+            self.error = err
+        finally:
+            bufview.release()
+            self.finish()
+
+    def step(self,bufview):
+        '''Receive one datagram and publish it to readers. Used by run, and by MAPIC_manager to service the\n
+        receivers of several boards from one thread without starting them.'''
+        nrecv = self.receive(bufview)
+        self.packets += 1
+        self.offset += nrecv
+        if self.writer is not None and self.offset - self.written >= WRITE_CHUNK:
+            self.flush()
+
+    def receive_rest(self,bufview):
+        '''Once stopped, receive the datagrams the board sent before it stopped, until none has come for self.linger\n
+        seconds, or RECV_POLL has passed should the board not have stopped.'''
+        end = time.monotonic() + RECV_POLL
+        self.sock.settimeout(self.linger)
+        while self.linger and not self.complete() and time.monotonic() < end:
+            try:
+                self.step(bufview)
+            except socket.timeout:
+                break
+
+    def finish(self):
+        '''Pass the records left over to the writer once receiving has ended.'''
+        if self.writer is not None:
+            self.flush()
+
+    def receive(self,bufview):
+        '''Receive one datagram into bufview at the current offset and return the number of data bytes.'''
+        return self.sock.recv_into(bufview[self.offset:], self.chunk)
+
+    def complete(self):
+        '''Return True once the run has received all its data.'''
+        return self.offset >= self.nbytes
+
+    def flush(self):
+        '''Pass the whole records received since the last flush to the writer.'''
+        end = self.offset - self.offset%self.record
+        self.writer.write(self.buffer[self.written//self.buffer.itemsize:end//self.buffer.itemsize])
+        self.written = end
+
+    def stop(self,linger=0):
+        '''Ask the thread to stop receiving, the data received so far stays available. With linger it goes on\n
+        receiving until the stream has been quiet for linger seconds, for the last datagrams of a stopped board.'''
+        self.linger = linger
+        self.stopped.set()
+
+    def progress(self,recordbytes):
+        '''Return the number of complete records of recordbytes bytes received so far.'''
+        return self.offset//recordbytes
+
+    def received(self,recordwords):
+        '''Return a zero-copy view of the complete records of recordwords buffer words received so far.'''
+        nwords = self.offset//self.buffer.itemsize
+        return self.buffer[:nwords - nwords%recordwords]
+
+    def raise_error(self):
+        '''Re-raise an exception that ended the run on the receiver thread.'''
+        if self.error is not None:
+            raise self.error
+
+class PeakStreamReceiver(StreamReceiver):
+    '''StreamReceiver for the DMA peak stream of SendDataPeak. The header of each datagram is kept apart from the\n
+    peak records so the run can account for lost and reordered packets, see stats.\n
+    PeakStreamReceiver(sock, datpts, tout, handshake=None, writer=None, compact=False)\n
+    Arguments:
+        \t sock: bound DMA stream socket
+        \t datpts: number of peaks requested from the board
+        \t tout: seconds without any data before the run is abandoned
+        \t handshake: optional function run on the thread before receiving, used to start the board
+        \t writer: optional MAPIC_runfile.RunWriter the peak records are streamed to
+        \t compact: True if the board sends the 4 byte delta encoded records of STREAM_COMPACT\n
+    Compact records are decoded to 8 byte peak records before they are written, so every run file has the same format.'''
+
+    def __init__(self,sock,datpts,tout,handshake=None,writer=None,compact=False):
+        # a compact peak takes one word, or two after a long gap, so 8 bytes per peak always fits
+        StreamReceiver.__init__(self, sock, datpts*PEAK_BYTES, MAX_PAYLOAD_SIZE, 'uint32', tout, handshake, writer,
+            4 if compact else PEAK_BYTES)
+        self.datpts = datpts
+        self.compact = compact
+        self.recordwords = 1 if compact else 2              # buffer words per record
+        self.headerwords = COMPACT_HEADER_WORDS if compact else HEADER_WORDS
+        self.header = numpy.zeros(self.headerwords, dtype='uint32')    # header of the last datagram
+        self.headerview = memoryview(self.header).cast('B')
+        self.headers = bytearray()                          # headers of every datagram in arrival order
+        self.lengths = array('I')                           # words in every datagram in arrival order
+        self.peaks = 0                                      # peaks received so far
+        self.boardpeaks = 0                                 # peaks the board reports having sent so far
+        self.flushed = 0                                    # datagrams passed to the writer so far
+
+        # loss accounting kept up to date by stats, from the datagrams received since its last call
+        self.accounted = 0                                  # datagrams accounted so far
+        self.seen = numpy.zeros(1024, dtype=bool)           # sequence numbers received, grows as needed
+        self.peakends = numpy.zeros(1024, dtype='int64')    # peak number after the last peak of each packet received
+        self.seqend = 0                                     # one past the highest sequence number seen
+        self.lastseq = -1                                   # sequence number of the last datagram accounted
+        self.firstmissing = 0                               # lowest sequence number not received
+        self.losses = dict.fromkeys(('packets', 'packets_unique', 'packets_reordered', 'peaks'), 0)
+
+    def receive(self,bufview):
+        headerbytes = 4*self.headerwords
+        if hasattr(self.sock, 'recvmsg_into'):
+            # scatter the header and the peaks to their own buffers, no copy needed
+            nrecv = self.sock.recvmsg_into([self.headerview, bufview[self.offset:self.offset + self.chunk - headerbytes]])[0]
+        else:
+            # no recvmsg_into on windows, move the peaks back over the header instead
+            nrecv = self.sock.recv_into(bufview[self.offset:], self.chunk)
+            self.headerview[:] = bufview[self.offset:self.offset + headerbytes]
+            bufview[self.offset:self.offset + nrecv - headerbytes] = bufview[self.offset + headerbytes:self.offset + nrecv]
+        if nrecv < headerbytes:
+            return 0                                        # not a stream packet
+        self.headers += self.headerview
+        self.lengths.append((nrecv - headerbytes)//4)
+        self.peaks += int(self.header[1])
+        self.boardpeaks = max(self.boardpeaks, int(self.header[1]) + int(self.header[2]))
+        return nrecv - headerbytes
+
+    def complete(self):
+        # the board stops once it has sent more than datpts peaks, so lost packets do not leave us waiting
+        return self.peaks >= self.datpts or self.boardpeaks > self.datpts
+
+    def progress(self,recordbytes=PEAK_BYTES):
+        '''Return the number of peaks received so far.'''
+        return self.peaks
+
+    def flush(self):
+        if not self.compact:
+            return StreamReceiver.flush(self)
+        # only datagrams received before this point are complete, the thread may be adding the next one
+        npackets = len(self.lengths)
+        lengths = numpy.array(self.lengths[self.flushed:npackets], dtype='int64')    # copy, the thread appends to lengths
+        start = self.written//4
+        end = start + int(lengths.sum())
+        data, time_us = decode_compact(self.buffer[start:end], self.bases(self.flushed, npackets), lengths)
+        self.writer.write(encode_peaks(data, time_us))
+        self.written = 4*end
+        self.flushed = npackets
+
+    def bases(self,first=0,last=None):
+        '''Return the time in us of the peak before each compact datagram received so far, or of datagrams first to last.'''
+        headerbytes = 4*self.headerwords
+        end = len(self.headers) if last is None else last*headerbytes
+        headers = numpy.frombuffer(bytes(self.headers[first*headerbytes:end]), dtype='uint32').reshape(-1, self.headerwords)
+        return headers[:,HEADER_WORDS].astype('int64') | (headers[:,HEADER_WORDS + 1].astype('int64') << 32)
+
+    def adc(self,words):
+        '''Return the ADC values of the complete records in words, a slice of received(self.recordwords).'''
+        if not self.compact:
+            return words[1::2] & 4095
+        adc = words & 4095
+        return adc[adc != 0]                                # drop escape words
+
+    def decode(self):
+        '''Return (adc, time_us) numpy arrays of every peak received so far, see decode_peaks.'''
+        if not self.compact:
+            return decode_peaks(self.received(2))
+        npackets = len(self.lengths)
+        lengths = numpy.array(self.lengths[:npackets], dtype='int64')
+        return decode_compact(self.buffer[:int(lengths.sum())], self.bases()[:npackets], lengths)
+
+    def decode_from(self,position):
+        '''Decode the peaks of the datagrams received since position, as decode. Returns (adc, time_us, position)\n
+        with the position to pass to the next call, (0, 0, None) being the start of the run. Safe to call while the run\n
+        is going.'''
+        packets, start, clock = position
+        lengths = numpy.array(self.lengths[packets:], dtype='int64')   # copy, the thread appends to lengths
+        ends = start + numpy.cumsum(lengths)
+        npackets = int(numpy.searchsorted(ends, self.offset//4, side='right'))     # datagrams already published
+        end = int(ends[npackets - 1]) if npackets else start
+        if self.compact:
+            adc, time_us = decode_compact(self.buffer[start:end], self.bases(packets, packets + npackets), lengths[:npackets])
+        else:
+            clock = MAPIC_runfile.BoardClock(clock)
+            adc, time_us = decode_peaks(self.buffer[start:end], clock)
+            clock = clock.state()
+        return adc, time_us, (packets + npackets, end, clock)
+
+    def stats(self):
+        '''Return a dictionary accounting for the packets and peaks of the run so far:\n
+        packets received, packets the board sent (by sequence number), packets lost, duplicate and reordered\n
+        packets, peaks received, peaks the board sent (its totpeakNum), peaks lost, and the sequence number and\n
+        peak number where the first loss happened (None without loss).\n
+        Only the datagrams received since the last call are added to the counts, so the GUI can call it every frame\n
+        however long the run is.'''
+        headerbytes = 4*self.headerwords
+        npackets = len(self.headers)//headerbytes
+        headers = numpy.frombuffer(bytes(self.headers[self.accounted*headerbytes:npackets*headerbytes]),
+            dtype='uint32').reshape(-1, self.headerwords).astype('int64')
+        self.accounted = npackets
+        if len(headers):
+            seq, count, total = headers[:,0], headers[:,1], headers[:,2]
+            if int(seq.max()) >= len(self.seen):
+                grow = max(len(self.seen), int(seq.max()) + 1 - len(self.seen))
+                self.seen = numpy.concatenate((self.seen, numpy.zeros(grow, dtype=bool)))
+                self.peakends = numpy.concatenate((self.peakends, numpy.zeros(grow, dtype='int64')))
+            unique, first = numpy.unique(seq, return_index=True)
+            new = ~self.seen[unique]
+            self.seen[unique[new]] = True
+            self.peakends[unique[new]] = (total + count)[first][new]
+            self.losses['packets'] += len(seq)
+            self.losses['packets_unique'] += int(new.sum())
+            self.losses['packets_reordered'] += int((numpy.diff(seq, prepend=self.lastseq) < 0).sum())
+            self.losses['peaks'] += int(count[first][new].sum())
+            self.seqend = max(self.seqend, int(seq.max()) + 1)
+            self.lastseq = int(seq[-1])
+            while self.firstmissing < self.seqend and self.seen[self.firstmissing]:
+                self.firstmissing += 1
+
+        # loss begins where the peak numbers of consecutive packets stop joining up, at the first missing packet
+        lost = self.firstmissing < self.seqend
+        firstlost = (int(self.peakends[self.firstmissing - 1]) if self.firstmissing else 0) if lost else None
+        received = self.losses['peaks']
+        return {'packets': self.losses['packets'], 'packets_sent': self.seqend,
+            'packets_lost': self.seqend - self.losses['packets_unique'],
+            'packets_duplicate': self.losses['packets'] - self.losses['packets_unique'],
+            'packets_reordered': self.losses['packets_reordered'],
+            'peaks': received, 'peaks_sent': self.boardpeaks, 'peaks_lost': self.boardpeaks - received,
+            'first_lost_packet': self.firstmissing if lost else None, 'first_lost_peak': firstlost}
+
+class ContinuousReceiver(PeakStreamReceiver):
+    '''PeakStreamReceiver for an open ended run, read_dma with no peak limit, that lasts until stop is called. Memory\n
+    stays flat however long the run goes: every SPILL_INTERVAL seconds, or sooner if the buffer fills, the peaks\n
+    received are added to the histogram, rate monitor and loss counts of the whole run, kept in a window of the most\n
+    recent peaks and written to the current part of the run file, then the buffer and headers are reused. The parts\n
+    are numbered files in one folder per run, the next is started once a part reaches spillbytes or spilltime.\n
+    ContinuousReceiver(sock, hist, rate, handshake=None, directory=None, header=None, window=CONTINUOUS_WINDOW,\n
+        spillbytes=SPILL_BYTES, spilltime=SPILL_TIME, keep=None, codec=None, compact=False, tout=None, previous=None)\n
+    Arguments:
+        \t sock: bound DMA stream socket
+        \t hist: MAPIC_analysis.Histogram the peaks are added to, on the receiver thread
+        \t rate: MAPIC_analysis.RateMonitor the peak times are added to, on the receiver thread
+        \t handshake: optional function run on the thread before receiving, used to start the board
+        \t directory: folder the part files are written to, None to keep nothing on disk
+        \t header: dictionary of run settings saved in the header of every part
+        \t window: number of the most recent peaks kept in memory, returned by decode
+        \t spillbytes, spilltime: bytes and seconds after which the next part is started
+        \t keep: number of the latest parts kept on disk, older ones are deleted, None keeps all of them
+        \t codec: None or a MAPIC_runfile.CODECS key to compress the parts with
+        \t compact: True if the board sends the 4 byte delta encoded records of STREAM_COMPACT
+        \t tout: seconds without any data before the run is abandoned, None to wait for ever
+        \t previous: stopped ContinuousReceiver this one resumes, its counts, window and parts carry on'''
+
+    def __init__(self,sock,hist,rate,handshake=None,directory=None,header=None,window=CONTINUOUS_WINDOW,
+            spillbytes=SPILL_BYTES,spilltime=SPILL_TIME,keep=None,codec=None,compact=False,tout=None,previous=None):
+        PeakStreamReceiver.__init__(self, sock, SPILL_BUFFER//PEAK_BYTES, float('inf') if tout is None else tout,
+            handshake, None, compact)
+        self.hist = hist
+        self.rate = rate
+        self.directory = directory
+        self.runheader = {} if header is None else header   # self.header is the stream header of the last datagram
+        self.window = window
+        self.spillbytes = spillbytes
+        self.spilltime = spilltime
+        self.keep = keep
+        self.codec = codec
+        self.due = time.monotonic() + SPILL_INTERVAL        # time of the next spill
+
+        # loss accounting of this board stream, the board numbers its packets from 0 again on resume
+        self.seqend = 0                                     # one past the highest sequence number seen
+        self.lastseq = -1                                   # sequence number of the last datagram spilled
+        self.unique = 0                                     # distinct packets received
+        self.missing = numpy.zeros(0, dtype='int64')        # sequence numbers below seqend never received, may still arrive
+        self.firstlost = None                               # first sequence number found lost
+        self.tally = dict.fromkeys(('packets', 'packets_duplicate', 'packets_reordered', 'peaks'), 0)
+        self.base = previous.stats() if previous is not None else None     # accounting of the runs this one resumes
+        self.summary = self.account(numpy.zeros((0, self.headerwords), dtype='int64'))
+
+        if previous is not None and previous.window == window:
+            self.recent_adc, self.recent_time = previous.recent_adc, previous.recent_time
+            self.recentpos, self.recentlen = previous.recentpos, previous.recentlen
+        else:
+            self.recent_adc = numpy.zeros(window, dtype='uint16')
+            self.recent_time = numpy.zeros(window, dtype='int64')
+            self.recentpos = 0                              # next index of the ring to write
+            self.recentlen = 0                              # peaks in the ring
+        self.parts = list(previous.parts) if previous is not None else []    # paths of the part files kept
+        self.part = previous.part + 1 if previous is not None else 0
+        self.partstart = None                               # time the current part was started
+        self.writer = None
+        self.clock = MAPIC_runfile.BoardClock()             # the board starts its clock again on resume
+        self.counted = False                                # set once finish_peak_find has moved past the run number
+
+    def step(self,bufview):
+        nrecv = self.receive(bufview)
+        self.packets += 1
+        self.offset += nrecv
+        if self.offset + self.chunk > self.nbytes or time.monotonic() >= self.due:
+            self.spill()
+
+    def complete(self):
+        return False                                        # only ends once stopped
+
+    def finish(self):
+        '''Spill what is left once receiving has ended and close the last part.'''
+        self.spill(True)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def spill(self,final=False):
+        '''Add the peaks in the buffer to the run aggregates, the recent window and the part file, then empty it.'''
+        npackets = len(self.lengths)
+        headers = numpy.frombuffer(bytes(self.headers), dtype='uint32').reshape(-1, self.headerwords).astype('int64')
+        clock = self.clock.state()                          # saved with a part started by this spill
+        if self.compact:
+            adc, time_us = PeakStreamReceiver.decode(self)
+        else:
+            adc, time_us = decode_peaks(self.received(2), self.clock)
+        self.hist.add(adc)
+        self.rate.add(time_us)
+        self.remember(adc, time_us)
+        if self.directory is not None and npackets > 0:
+            self.save(adc, time_us, clock)
+        self.summary = self.account(headers, final)
+
+        # only this thread writes the buffer, so it can be reused straight away
+        self.offset = 0
+        self.written = 0
+        self.flushed = 0
+        self.headers = bytearray()
+        self.lengths = array('I')
+        self.due = time.monotonic() + SPILL_INTERVAL
+
+    def remember(self,adc,time_us):
+        '''Write the peaks into the ring of the most recent window peaks.'''
+        adc, time_us = adc[-self.window:], time_us[-self.window:]
+        index = (self.recentpos + numpy.arange(len(adc))) % self.window
+        self.recent_adc[index] = adc
+        self.recent_time[index] = time_us
+        self.recentpos = (self.recentpos + len(adc)) % self.window
+        self.recentlen = min(self.recentlen + len(adc), self.window)
+
+    def save(self,adc,time_us,clock):
+        '''Write the spilled peaks to the current part as 8 byte peak records, starting the next part when it is full.\n
+        A new part saves clock, the BoardClock state before these peaks, so its times can be read without the parts before.'''
+        if self.writer is None:
+            path = os.path.join(self.directory, 'part%04i.mapic' % self.part)
+            self.writer = MAPIC_runfile.RunWriter(path, dict(self.runheader, part=self.part, start=time.time(),
+                continuous=True, clock=clock), 'uint32', self.codec)
+            self.partstart = time.monotonic()
+            self.parts.append(path)
+            while self.keep is not None and len(self.parts) > self.keep:
+                old = self.parts.pop(0)
+                os.remove(old)
+                if os.path.exists(old + MAPIC_runfile.INDEX_SUFFIX):
+                    os.remove(old + MAPIC_runfile.INDEX_SUFFIX)     # time index left by a RunReader
+        self.writer.write(self.received(2) if not self.compact else encode_peaks(adc, time_us))
+        if self.writer.nbytes >= self.spillbytes or time.monotonic() - self.partstart >= self.spilltime:
+            self.writer.close()
+            self.writer = None
+            self.part += 1
+
+    def account(self,headers,final=False):
+        '''Add the datagrams of headers to the loss counts of this board stream and return the accounting of the whole\n
+        run, see stats. Packets missing at one spill are only counted lost if they are still missing at the next, or\n
+        at the final spill, as they may just have been reordered. The sequence numbers still missing are kept across\n
+        spills, so a packet received again after a spill is counted as a duplicate, at the cost of memory growing with\n
+        the packets lost.'''
+        if len(headers):
+            seq, count, total = headers[:,0], headers[:,1], headers[:,2]
+            unique, first = numpy.unique(seq, return_index=True)
+            new = (unique >= self.seqend) | numpy.isin(unique, self.missing)   # not received before this spill
+            lost = numpy.setdiff1d(self.missing, unique)
+            self.missing = numpy.union1d(lost, numpy.setdiff1d(numpy.arange(self.seqend, int(seq.max()) + 1), unique))
+            self.tally['packets'] += len(seq)
+            self.tally['packets_duplicate'] += len(seq) - int(new.sum())
+            self.tally['packets_reordered'] += int((numpy.diff(numpy.concatenate(([self.lastseq], seq))) < 0).sum())
+            self.tally['peaks'] += int(count[first][new].sum())
+            self.seqend = max(self.seqend, int(seq.max()) + 1)
+            self.lastseq = int(seq[-1])
+            self.unique += int(new.sum())
+            self.boardpeaks = max(self.boardpeaks, int((total + count).max()))
+            if self.firstlost is None and len(lost):
+                self.firstlost = int(lost[0])
+        if final and self.firstlost is None and len(self.missing):
+            self.firstlost = int(self.missing[0])
+
+        base = self.base if self.base is not None else dict.fromkeys(('packets', 'packets_sent', 'packets_lost',
+            'packets_duplicate', 'packets_reordered', 'peaks', 'peaks_sent', 'peaks_lost'), 0)
+        summary = {key: base[key] + n for key, n in self.tally.items()}
+        summary.update(packets_sent=base['packets_sent'] + self.seqend,
+            packets_lost=base['packets_lost'] + self.seqend - self.unique,
+            peaks_sent=base['peaks_sent'] + self.boardpeaks, peaks_lost=base['peaks_lost'] + self.boardpeaks - self.tally['peaks'],
+            first_lost_packet=base.get('first_lost_packet'), first_lost_peak=None)
+        if summary['first_lost_packet'] is None and self.firstlost is not None:
+            summary['first_lost_packet'] = base['packets_sent'] + self.firstlost
+        return summary
+
+    def progress(self,recordbytes=PEAK_BYTES):
+        '''Return the number of peaks in the recent window.'''
+        return self.recentlen
+
+    def decode(self):
+        '''Return (adc, time_us) numpy arrays of the most recent window peaks, oldest first.'''
+        index = (self.recentpos - self.recentlen + numpy.arange(self.recentlen)) % self.window
+        return self.recent_adc[index], self.recent_time[index]
+
+    def stats(self):
+        '''Return the loss accounting of the whole run as of the last spill, with the keys of\n
+        PeakStreamReceiver.stats. first_lost_peak is not tracked and always None.'''
+        return self.summary
+
+class HistogramStreamReceiver(StreamReceiver):
+    '''StreamReceiver for the histogram snapshots of read_dma modes 2 and 3, see peakfind.h. Each datagram is merged\n
+    into self.counts as it arrives so memory and bandwidth stay the same whatever the event rate, but the run has no\n
+    per-peak data. Full snapshots are merged with a maximum, counts only grow on the board, so a lost or late\n
+    packet is made up by the next snapshot. Delta snapshots are added, their losses show up in stats.\n
+    HistogramStreamReceiver(sock, datpts, tout, handshake=None, writer=None, delta=False)\n
+    Arguments:
+        \t sock: bound DMA stream socket
+        \t datpts: number of peaks the board counts before it stops
+        \t tout: seconds without any data before the run is abandoned
+        \t handshake: optional function run on the thread before receiving, used to start the board
+        \t writer: optional MAPIC_runfile.RunWriter the final counts are written to
+        \t delta: True if the board sends the snapshots of STREAM_HIST_DELTA'''
+
+    def __init__(self,sock,datpts,tout,handshake=None,writer=None,delta=False):
+        # the buffer holds one datagram, nothing is kept after it has been merged
+        StreamReceiver.__init__(self, sock, 0, MAX_PAYLOAD_SIZE, 'uint32', tout, handshake, writer)
+        self.datpts = datpts
+        self.delta = delta
+        self.recordwords = 1
+        self.counts = numpy.zeros(MAPIC_analysis.ADC_RANGE, dtype='int64')
+        self.headers = bytearray()                          # headers of every datagram in arrival order
+        self.boardpeaks = 0                                 # peaks the board had counted at its latest snapshot
+        self.final = None                                   # packets in the last snapshot, once one of them arrives
+        self.finalpackets = 0                               # packets of the last snapshot received
+        self.finaltime = None                               # time the first of them arrived
+
+    def receive(self,bufview):
+        headerbytes = 4*HIST_HEADER_WORDS
+        nrecv = self.sock.recv_into(bufview, self.chunk)
+        if nrecv < headerbytes:
+            return 0                                        # not a stream packet
+        seq, snapshot, peaks, fmt, first, size = (int(word) for word in self.buffer[:HIST_HEADER_WORDS])
+        nbins = min(size & 0xFFFF, (nrecv - headerbytes)//4, MAPIC_analysis.ADC_RANGE - first)
+        counts = self.buffer[HIST_HEADER_WORDS:HIST_HEADER_WORDS + nbins]
+        if self.delta:
+            self.counts[first:first + nbins] += counts
+        else:
+            numpy.maximum(self.counts[first:first + nbins], counts, out=self.counts[first:first + nbins])
+        self.headers += bufview[:headerbytes]
+        self.boardpeaks = max(self.boardpeaks, peaks)
+        if snapshot & HIST_FINAL:
+            self.final = size >> 16
+            self.finalpackets += 1
+            if self.finaltime is None:
+                self.finaltime = time.time()
+        return 0                                            # the next datagram goes to the start of the buffer again
+
+    def complete(self):
+        # done once the last snapshot is in, or has had RECV_POLL for its other packets to arrive
+        return self.final is not None and (self.finalpackets >= self.final or time.time() - self.finaltime >= RECV_POLL)
+
+    def finish(self):
+        '''Write the final counts once receiving has ended.'''
+        if self.writer is not None:
+            self.writer.write(self.counts)
+
+    def progress(self,recordbytes=PEAK_BYTES):
+        '''Return the number of peaks the board has counted so far.'''
+        return self.boardpeaks
+
+    def decode(self):
+        '''Return empty (adc, time_us) arrays, a histogram run has no per-peak data.'''
+        return numpy.empty(0, dtype='uint16'), numpy.empty(0, dtype='int64')
+
+    def stats(self):
+        '''Return the loss accounting of the run so far with the keys of PeakStreamReceiver.stats. peaks is the\n
+        number of counts received, so peaks_lost is only non zero for delta snapshots or a lost last snapshot.'''
+        headers = numpy.frombuffer(bytes(self.headers), dtype='uint32').reshape(-1, HIST_HEADER_WORDS).astype('int64')
+        seq = headers[:,0]
+        unique = numpy.unique(seq)
+        sent = int(seq.max()) + 1 if len(seq) else 0
+        missing = numpy.setdiff1d(numpy.arange(sent), unique)
+        received = int(self.counts.sum())
+        return {'packets': len(seq), 'packets_sent': sent, 'packets_lost': len(missing),
+            'packets_duplicate': len(seq) - len(unique), 'packets_reordered': int((numpy.diff(seq) < 0).sum()),
+            'peaks': received, 'peaks_sent': self.boardpeaks, 'peaks_lost': self.boardpeaks - received,
+            'first_lost_packet': int(missing[0]) if len(missing) else None, 'first_lost_peak': None}
+
+class CalibrationReceiver(StreamReceiver):
+    '''StreamReceiver for the calibration stream of cbcal in main.py: datagrams of up to CAL_PAIRS pulse pairs, each\n
+    of 4 output and 4 input samples, ended by an empty datagram. Every datagram is reduced to the average output and\n
+    input height of each pulse as it arrives and added to a MAPIC_analysis.TransferFit, and the run is complete once\n
+    the fit has converged, the board has ended the stream or CAL_MAX_PAIRS pairs have arrived.\n
+    CalibrationReceiver(sock, tout, handshake=None, tol=CAL_TOL, minpairs=CAL_MIN_PAIRS)\n
+    Arguments:
+        \t sock: bound socket the board streams the pulses to
+        \t tout: seconds without any data before the run is abandoned
+        \t handshake: optional function run on the thread before receiving, used to start the board
+        \t tol: standard error in ADU of the transfer curve at which the run is complete
+        \t minpairs: pulse pairs needed before the fit is checked, so a few pulses cannot end the run by chance'''
+
+    def __init__(self,sock,tout,handshake=None,tol=CAL_TOL,minpairs=CAL_MIN_PAIRS):
+        # the buffer holds one datagram, its pulses are reduced to heights before the next one arrives
+        StreamReceiver.__init__(self, sock, 0, CAL_PAIRS*CAL_PAIR_BYTES, 'uint16', tout, handshake, record=CAL_PAIR_BYTES)
+        self.tol = tol
+        self.minpairs = minpairs
+        self.fit = MAPIC_analysis.TransferFit()
+        self.outputs = numpy.zeros(CAL_MAX_PAIRS)           # average output height of each pulse in ADU
+        self.inputs = numpy.zeros(CAL_MAX_PAIRS)            # average input height of each pulse in ADU
+        self.pairs = 0
+        self.ended = False                                  # the board sent its end of stream datagram
+
+    def receive(self,bufview):
+        nrecv = self.sock.recv_into(bufview, self.chunk)
+        if nrecv == 0:
+            self.ended = True
+            return 0
+        # only the pairs actually received, each reduced to (output, input) heights in one vectorized step
+        heights = self.buffer[:8*(nrecv//CAL_PAIR_BYTES)].reshape(-1, 2, 4).mean(axis=2)
+        heights = heights[(heights > 0).all(axis=1)][:CAL_MAX_PAIRS - self.pairs]    # zeros are missed pulses
+        n = len(heights)
+        self.outputs[self.pairs:self.pairs + n] = heights[:,0]
+        self.inputs[self.pairs:self.pairs + n] = heights[:,1]
+        self.fit.add(heights[:,1], heights[:,0])
+        self.pairs += n                                     # published after the heights, as offset for the other receivers
+        return 0                                            # the next datagram goes to the start of the buffer again
+
+    def complete(self):
+        return self.ended or self.pairs >= CAL_MAX_PAIRS or self.fit.converged(self.tol, self.minpairs)
+
+    def progress(self,recordbytes=CAL_PAIR_BYTES):
+        '''Return the number of pulse pairs received so far.'''
+        return self.pairs
+
+    def decode(self):
+        '''Return (outputs, inputs) numpy arrays of the pulse heights in ADU received so far.'''
+        return self.outputs[:self.pairs], self.inputs[:self.pairs]
 
 class APIC:
     '''Class representing the APIC. Methods invoke measurement and information 
     requests to the board and manage communication over the network socket. I.e. control the board from the PC with this class.'''
-    def __init__(self,tout,ipv4):   # intialise connection variables.
-        
+    def __init__(self,tout,ipv4,port=8080,dmaport=9000,runprefix='run',config=None):   # intialise connection variables.
+        '''APIC(tout, ipv4, port=8080, dmaport=9000, runprefix='run', config=None)\n
+        \t tout: socket timeout in seconds
+        \t ipv4: (ip, port) tuple of the board
+        \t port: local port receiving replies, the board replies to the port commands come from
+        \t dmaport: local port receiving the DMA stream, the board sends to 9000 unless setdest is called
+        \t runprefix: start of the run file names in histdata, distinct for each board driven from one folder
+        \t config: settings dictionary as returned by load_config, the module default if None'''
+
         self.tout = tout                            # timeout for both serial and socket connections in seconds.
         self.ipv4 = tuple(ipv4)                     # tuple of IP string and port e.g. ('123.456.78.9',1234) (see readme & socket)
+        self.dmaport = dmaport
+        self.runprefix = runprefix
+        self.config = default if config is None else config
         
         # SOCKET OPERATIONS
         self.sock = socket.socket(socket.AF_INET
             ,socket.SOCK_DGRAM)                     # init socket obj in AF_INET (IPV4 addresses only) mode and send/receive data.
         self.sock.settimeout(tout)                  # set socket timeout setting
-        self.sock.bind(('',8080))
-        self.polarity = default['polarity']
+        self.sock.bind(('',port))
+        self.tag = 0                                # tag of the last acknowledged command, see command
+        self.cmdlock = threading.Lock()             # one command at a time on self.sock, commands may come from worker threads
+        self.polarity = self.config['polarity']
+        self.testpulse = self.config['testpulse']
+        self.peakfinder = tuple(self.config['peakfinder'])     # threshold, min width, max width, pile-up veto
 
         # Misc variables used by the ADC DAQ code
         self.raw_dat_count = 0                      #  counter for the number of raw data files
@@ -36,13 +738,13 @@ class APIC:
         
         # Default settings for GUI
         self.units = 'ADU'
-        self.calibgradient = default['calibgradient']
-        self.caliboffset = default['caliboffset']
-        self.title = default['title']
-        self.posGAIN = default['gainpos']
-        self.posTHRESH = default['threshpos']
-        self.boundaries = tuple(default['boundaries'])
-        self.bins = default['bins']
+        self.calibgradient = self.config['calibgradient']
+        self.caliboffset = self.config['caliboffset']
+        self.title = self.config['title']
+        self.posGAIN = self.config['gainpos']
+        self.posTHRESH = self.config['threshpos']
+        self.boundaries = tuple(self.config['boundaries'])
+        self.bins = self.config['bins']
         self.ylabel = ""
         self.xlabel = ""
 
@@ -50,6 +752,10 @@ class APIC:
         self.errorstatus = ""                       # currently unused
 
         # Gaussian fit parameters
+        self.hist = MAPIC_analysis.Histogram()      # full resolution histogram of the current run
+        self.histpos = (0, 0, None)                 # datagrams, words and clock of the stream already added to self.hist
+        self.rate = MAPIC_analysis.RateMonitor(self.config['ratewindow'], self.config['ratesmoothing'], self.config['deadtime'])
+        self.ratecount = (0, None)                  # peaks the board had counted and the time they were seen, see update_histogram
         self.binvals = []                           # histogram bin values
         self.binedges = []                          # histogram bin edge positions
         self.std = 0                                # standard deviation
@@ -58,15 +764,12 @@ class APIC:
         # ADC-DMA stream acceptor socket
         self.sockdma = socket.socket(socket.AF_INET
             ,socket.SOCK_DGRAM)                                     # reinit socket object
-        self.sockdma.bind(('', 9000))                                 # bind socket to receive
+        self.sockdma.bind(('', dmaport))                                 # bind socket to receive
 
 
-        # Find the number of files currently in the data directory, find latest file version number to use
-        for datafile in os.listdir('histdata'):
-            if datafile.startswith('ADC_count'):
-                self.raw_dat_count+=1
-            else:
-                pass
+        # The run catalog gives the next run number without listing the data directory, see MAPIC_catalog.
+        self.catalog = MAPIC_catalog.RunCatalog(os.path.join('histdata', MAPIC_catalog.CATALOG_NAME))
+        self.raw_dat_count = self.catalog.next_run(self.runprefix)
         
     def createfileno(self,fncount):
         '''A function used to create the 4 digit file number endings based on the latest file number 
@@ -87,16 +790,54 @@ class APIC:
             except:
                 break                   # when sock.recv timeout break loop
         
-        self.sock.settimeout(default['timeout'])
+        self.sock.settimeout(self.config['timeout'])
 
     def sendcmd(self,a,b):
-        '''Send a bytearray command using two 8 bit unsigned integers a,b.\n
+        '''Send a legacy 2 byte command using two 8 bit unsigned integers a,b, for routines that stream their data\n
+        back on this socket. Every other command goes through command.\n
         self.sendcmd(a,b)\n
         Arguments:\n
         \t a: first command byte for type of command \n
         \t b: second command byte for subsection.'''
         self.sock.sendto(bytearray([a,b]),self.ipv4)
 
+    def command(self,a,b,args=b'',timeout=MAPIC_control.CMD_TIMEOUT):
+        '''Send command a, b with its arguments in one datagram and return the reply data once the board\n
+        acknowledges it, resending on timeout. Blocking version of MAPIC_control.ControlClient.command.\n
+        self.command(a, b, args=b'', timeout=CMD_TIMEOUT)\n
+        Arguments:
+            \t a, b: command bytes, see commands in main.py
+            \t args: argument bytes
+            \t timeout: seconds to wait for each attempt\n
+        Safe to call from several threads, commands wait for the one in progress to finish.'''
+        with self.cmdlock:
+            return self.acknowledged(a, b, args, timeout)
+
+    def acknowledged(self,a,b,args,timeout):
+        self.tag = (self.tag + 1) % 65536
+        datagram = MAPIC_control.request(a, b, self.tag, args)
+        try:
+            for attempt in range(MAPIC_control.CMD_RETRIES + 1):
+                self.sock.sendto(datagram, self.ipv4)
+                deadline = time.time() + timeout
+                while time.time() < deadline:
+                    self.sock.settimeout(max(deadline - time.time(), 1E-03))
+                    try:
+                        reply = MAPIC_control.parse_reply(self.sock.recv(MAX_PAYLOAD_SIZE))
+                    except socket.timeout:
+                        break
+                    if reply is not None and reply[:3] == (a, b, self.tag):    # ignore late replies to earlier attempts
+                        MAPIC_control.check_status(a, b, reply[3])
+                        return reply[4]
+            raise socket.timeout('No reply from the board to command [%i,%i]' % (a, b))
+        finally:
+            self.sock.settimeout(self.tout)
+
+    def setdest(self):
+        '''Point the DMA stream of the board at self.dmaport of this host, needed when the stream is not received\n
+        on port 9000, e.g. for several boards. The board takes the host address from the command itself.'''
+        self.command(8,0,self.dmaport.to_bytes(2,'little',signed=False))
+
 #===================================================================================================
 # STATE OPERATIONS - CURRENTLY UNUSED BUT MAY BE USEFUL IN THE FUTURE
 # UPDATE BOARD STATE WITH SENDSTATE
@@ -105,14 +846,12 @@ class APIC:
 
     def checkstate(self):
         
-        self.sendcmd(7,0)
-        print(self.sock.recv(32).decode('utf-8'))
+        print(self.command(7,1).decode('utf-8'))
                            
     def sendstate(self, statestr):
         
         if isinstance(statestr,str):    
-            self.sendcmd(7,1)
-            self.sock.sendto(statestr.encode('utf-8'),self.ipv4)
+            self.command(7,0,statestr.encode('utf-8'))
             self.STATE = statestr
         
         else:
@@ -134,17 +873,16 @@ class APIC:
         '''Scan for discoverable I2C addresses to the board, returning a list of found I2C addresses in decimal.\n
         Takes no arguments but stores received addresses as a list object self.I2Caddrs.'''
         
-        self.sendcmd(0,2)
-        addresses = list(self.sock.recv(2))     # recieve a list of 2 I2C addresses in list of 8 bit nums
+        addresses = list(self.command(0,2))     # recieve a list of 2 I2C addresses in list of 8 bit nums
         self.I2Caddrs = addresses
 
     def readI2C(self):
         '''Read the two I2C digital potentiometers.\n 
         Creates two APIC variables self.posGAIN, self.posTHRESH storing the positions.'''
         
-        self.sendcmd(0,0)
-        self.posGAIN = int.from_bytes(self.sock.recv(1),'little')           # receive + update gain position variable
-        self.posTHRESH = int.from_bytes(self.sock.recv(1),'little')         # receive + update threhold position variable
+        positions = self.command(0,0)
+        self.posGAIN = positions[0]                 # update gain position variable
+        self.posTHRESH = positions[1]               # update threhold position variable
     
     def writeI2C(self,pos,pot):
         '''Writes 8 bit values to one the two digital potentiometers.\n 
@@ -153,9 +891,58 @@ class APIC:
             \t pos: desired position of pot 8 bit value
             \t pot: takes value 0,1 for threshold and gain pots respectively'''
         
-        self.sendcmd(1,pot)
-        time.sleep(0.2)         # NEED A DELAY OR UDP PACKET CAN BE MISSED
-        self.sock.sendto(bytearray([pos]),self.ipv4)
+        self.command(1,pot,bytes([pos]))
+
+    def apply_profile(self,gainpos,threshpos,polarity,testpulse=0):
+        '''Apply both potentiometer positions, the polarity and the test pulse state in one acknowledged command.\n
+        The board checks both potentiometers respond before changing anything, and replies with the positions\n
+        read back over I2C which update self.posGAIN and self.posTHRESH.\n
+        self.apply_profile(gainpos, threshpos, polarity, testpulse=0)\n
+        Arguments:
+            \t gainpos, threshpos: 8 bit potentiometer positions
+            \t polarity: 1 for positive, 0 for negative pulses
+            \t testpulse: 1 to enable the internal test pulses'''
+
+        readback = self.command(1,2,bytes([gainpos,threshpos,polarity,testpulse]))
+        self.posGAIN, self.posTHRESH = readback[0], readback[1]
+        self.polarity, self.testpulse = readback[2], readback[3]
+        if tuple(readback) != (gainpos,threshpos,polarity,testpulse):
+            raise RuntimeError('Profile read back as %s instead of %s' % (tuple(readback), (gainpos,threshpos,polarity,testpulse)))
+
+    def set_peak_finder(self,threshold,min_width=0,max_width=0,pileup=0):
+        '''Set the peak finder of the DMA stream, peaks it rejects are never sent, see peak_rejected.\n
+        self.set_peak_finder(threshold, min_width=0, max_width=0, pileup=0)\n
+        Arguments:
+            \t threshold: ADC counts a peak starts above and ends below
+            \t min_width: fewest samples above threshold of a peak, shorter blips are rejected as noise
+            \t max_width: most samples above threshold of a peak, 0 for no limit
+            \t pileup: ADC counts a peak may fall and rise again by before it is vetoed as piled up, 0 for no veto'''
+
+        self.command(9,0,b''.join(int(v).to_bytes(2,'little',signed=False) for v in (threshold,min_width,max_width,pileup)))
+        self.peakfinder = (threshold,min_width,max_width,pileup)
+
+    def dma_buffer(self,size=None):
+        '''Set the number of samples in the circular DMA buffer of the next stream if size is given, an even\n
+        number up to 4096. The board processes each half while the DMA fills the other, larger buffers allow\n
+        higher sample rates but peak times are taken once per half buffer.\n
+        Returns (size, overruns), overruns being the half buffers the last stream lost to the DMA.'''
+        reply = self.command(9,2,b'' if size is None else size.to_bytes(2,'little',signed=False))
+        return int.from_bytes(reply[:2],'little'), int.from_bytes(reply[2:6],'little')
+
+    def peak_rejected(self):
+        '''Return a dictionary of the peaks the board rejected in its last DMA stream: narrow and wide peaks\n
+        outside the width window and pileup vetoed peaks, see set_peak_finder.'''
+        reply = self.command(9,1)
+        narrow, wide, pileup = (int.from_bytes(reply[i:i+4],'little',signed=False) for i in range(0,12,4))
+        return {'narrow': narrow, 'wide': wide, 'pileup': pileup}
+
+    def udp_stats(self):
+        '''Return a dictionary of the datagrams of the board's last DMA stream: sent, errors it failed to send\n
+        (mostly with its pbuf pool empty) and busy ones it dropped as their buffer was still held by the network\n
+        stack. Datagrams lost after leaving the board are counted by stream_stats instead.'''
+        reply = self.command(9,3)
+        sent, errors, busy = (int.from_bytes(reply[i:i+4],'little',signed=False) for i in range(0,12,4))
+        return {'sent': sent, 'errors': errors, 'busy': busy}
     
 #===================================================================================================
 # POLTTING AND DATA ANALYSIS
@@ -178,21 +965,83 @@ class APIC:
         else:
             raise ValueError('Unit is not supported. Acceptable values are "mV" or "ADU"')
 
+    def rebin(self):
+        '''Update self.binvals, self.binedges from self.hist with the current bins, boundaries and units.'''
+        self.binvals, self.binedges = self.hist.rebin(self.bins, self.boundaries, self.units)
+        return self.binvals, self.binedges
+
     def curvecorrect(self, Input):
         return ((Input + self.caliboffset)/self.calibgradient)
 
     def setpolarity(self,setpolarity=1):
         '''Connection and byte transfer protocol testing. Send a byte command a receive a message back.'''
         
-        self.sendcmd(4,setpolarity)
+        self.command(4,setpolarity)
         self.polarity= setpolarity
 
+    def runpath(self,runno):
+        '''Return the path of the binary run file for run number runno.'''
+        return os.path.join('histdata',self.runprefix+self.createfileno(runno)+'.mapic')
+
+    def runheader(self,datpts):
+        '''Return the settings saved in the header of a run file.'''
+        return {'run': self.raw_dat_count, 'samples': datpts, 'start': time.time(), 'format': 'peak',
+            'units': 'ADU', 'polarity': self.polarity, 'gainpos': self.posGAIN, 'threshpos': self.posTHRESH,
+            'calibgradient': self.calibgradient, 'caliboffset': self.caliboffset}
+
+    def runfiles(self,runno):
+        '''Return the binary run files of saved run runno in order, found through the catalog: its run file, or the\n
+        part files of a start_continuous run. Every reader of saved runs goes through this.\n
+        self.runfiles(runno)'''
+        record = self.catalog.get(self.runprefix, runno)
+        paths = [path for path in record['paths'] if not path.endswith('.txt')] if record else []
+        return MAPIC_runfile.run_files(paths or [self.runpath(runno)])
+
+    def export_text(self,runno):
+        '''Convert saved run runno to the ADC_count####.txt and data_time####.txt text files written by savedata,\n
+        or to the counts of every ADC value in ADC_hist####.txt for a start_histogram run. The run files are found by\n
+        runfiles and converted one at a time, the parts of a resumed run follow each other in time as in RunReader.\n
+        self.export_text(runno)\n
+        \t runno: run number of the run in histdata to convert'''
+        files = self.runfiles(runno)
+        header, words = MAPIC_runfile.load_run(files[0])
+        if header.get('format') == 'histogram':                 # start_histogram run, counts of each ADC value
+            path = os.path.join('histdata','ADC_hist'+self.createfileno(runno)+'.txt')
+            numpy.savetxt(path,words,fmt='%d')
+            self.catalog.add_paths(self.runprefix, runno, [path])
+            return
+        paths = [os.path.join('histdata',name+self.createfileno(runno)+'.txt') for name in ('ADC_count','data_time')]
+        end = None                                              # time of the last peak written
+        with open(paths[0],'w') as adcfp, open(paths[1],'w') as timefp:
+            for i, path in enumerate(files):
+                if i > 0:
+                    header, words = MAPIC_runfile.load_run(path)
+                data, data_time = decode_peaks(words, MAPIC_runfile.BoardClock(header.get('clock')))
+                if len(data_time):
+                    if end is not None:
+                        data_time += max(end - int(data_time[0]), 0)    # a resumed part, the board clock started again
+                    end = int(data_time[-1])
+                numpy.savetxt(adcfp,data)
+                # exact seconds from the integer microseconds
+                numpy.savetxt(timefp,numpy.column_stack(divmod(data_time, 1000000)), fmt='%d.%06d')
+        self.catalog.add_paths(self.runprefix, runno, paths)
+
+    def open_run(self,runno):
+        '''Return a MAPIC_runfile.RunReader of saved run runno, its run file or the parts of a start_continuous run,\n
+        to read, histogram or fit any time span of the run without loading it.\n
+        self.open_run(runno)'''
+        return MAPIC_runfile.RunReader(self.runfiles(runno))
+
     def savedata(self,data,datatype):
         ''' Save numpy data, uses different names for data types.'''
         if datatype=='adc':
-            numpy.savetxt('histdata\ADC_count'+self.createfileno(self.raw_dat_count)+'.txt',data)
+            path = 'histdata\ADC_count'+self.createfileno(self.raw_dat_count)+'.txt'
         elif datatype=='time':
-            numpy.savetxt('histdata\data_time'+self.createfileno(self.raw_dat_count)+'.txt',data)
+            path = 'histdata\data_time'+self.createfileno(self.raw_dat_count)+'.txt'
+        else:
+            return
+        numpy.savetxt(path,data)
+        self.catalog.add_paths(self.runprefix, self.raw_dat_count, [path])
 
 #===================================================================================================
 # MISC FUNCTIONS
@@ -202,10 +1051,7 @@ class APIC:
         '''Acquire measured sample activity in Bq, does not work for activities lower than 1Bq.\n
         Returns the sample rate in Hz.'''
         
-        self.drain_socket()
-        self.sendcmd(5,1)
-
-        rateinb = self.sock.recv(32)
+        rateinb = self.command(5,1,timeout=MAPIC_control.RATE_TIME + MAPIC_control.CMD_TIMEOUT)
         rate = int.from_bytes(rateinb,'little',signed=False)
         
         return rate
@@ -218,118 +1064,300 @@ class APIC:
         
         return shapergain
 
-    def calibration(self):
-        '''Perform a calibration of the setup, arbitrary time and creates two items of the APIC class
-        containing the data received.'''
-        
-        self.sock.settimeout(5)
-        readm = array('H',[0]*720)
-        calibration_data = array("H",[])
-        # while loop to take data from the ADC until a timeout
-        self.sendcmd(5,0)
-        while True:
-            try:
-                self.sock.recv_into(readm)
-                print(readm)
-                calibration_data.extend(readm)
-            except:
-                break
+    def calibration(self,maxtime=CAL_TIME,tol=CAL_TOL,minpairs=CAL_MIN_PAIRS):
+        '''Perform a calibration of the setup, blocks until the transfer curve fit has converged or the board has\n
+        calibrated for maxtime seconds, see start_calibration and finish_calibration.'''
+        self.start_calibration(maxtime, tol, minpairs).join()
+        self.finish_calibration()
+
+    def start_calibration(self,maxtime=CAL_TIME,tol=CAL_TOL,minpairs=CAL_MIN_PAIRS):
+        '''Start measuring input and output pulse pairs of the shaper on a background CalibrationReceiver and return\n
+        it. The transfer curve is fitted as the pulses arrive, receiver.fit has the fit so far, and the run ends once\n
+        its standard error is below tol ADU or after maxtime seconds. Call finish_calibration once it is no longer alive.\n
+        self.start_calibration(maxtime=CAL_TIME, tol=CAL_TOL, minpairs=CAL_MIN_PAIRS)\n
+        \t maxtime: most seconds the board calibrates for
+        \t tol: standard error in ADU of the fitted curve over the inputs seen at which calibration ends
+        \t minpairs: pulse pairs needed before the fit is checked\n'''
 
-        calibration_data = numpy.array(calibration_data)
-        calibration_data = calibration_data[calibration_data != 0]
-        calibration_data.shape = (int(len(calibration_data)/4),4)
+        def handshake():
+            # the board streams the pulses to the DMA stream port of this host
+            self.command(5,0,self.dmaport.to_bytes(2,'little',signed=False) + maxtime.to_bytes(2,'little',signed=False))
 
-        calibration_data  = numpy.average(calibration_data, axis=1)
-        self.outputpulses = calibration_data[0::2]
-        self.inputpulses  = calibration_data[1::2]
+        self.calreceiver = CalibrationReceiver(self.sockdma, self.tout, handshake, tol, minpairs)
+        self.calreceiver.start()
+        return self.calreceiver
 
-        self.outputpulses = self.setunits(self.outputpulses,'mV')
-        self.inputpulses  = self.setunits(self.inputpulses,'mV')
-        calibration_data  = numpy.array([])
+    def finish_calibration(self):
+        '''Stop the board if the fit converged before it ended the run and set self.outputpulses and\n
+        self.inputpulses in mV, and self.calibfit to the (a, b, c) of the transfer curve in mV.'''
+
+        receiver = self.calreceiver
+        receiver.join()
+        if not receiver.ended:
+            self.command(5,2)
+            self.drain_stream()
+        receiver.raise_error()
+        fit = receiver.fit.coefficients()
+        if fit is None:
+            raise RuntimeError('Calibration ended with %i pulses, too few to fit the transfer curve' % receiver.pairs)
+
+        # mV without touching self.units, which belongs to self.data
+        outputs, inputs = receiver.decode()
+        self.outputpulses = outputs*MAPIC_analysis.MV_PER_ADU
+        self.inputpulses = inputs*MAPIC_analysis.MV_PER_ADU
+        a, b, c = fit
+        self.calibfit = (a/MAPIC_analysis.MV_PER_ADU, b, c*MAPIC_analysis.MV_PER_ADU)
 
 #===================================================================================================
 # ADC DAQ OPERATIONS
 #===================================================================================================
     
-    def ADC_IT_poll(self,datpts,progbar,rootwindow):
+    def ADC_IT_poll(self,datpts):
         '''Hardware interrupt routine for ADC measurement. Sends an 8 byte number for the  number of samples,\n 
         returns array of 4 samples of peaks in ADC counts. Uses read_timed polling method from Micropython. \n
-        self.ADC_IT_poll(datpts, progbar, rootwindow)\n
-        \t datpts: 64bit number for desired number of ADC samples\n
-        \t progbar: progressbar widget variable\n
-        \t rootwindow: tkinter.TK() object (root frame/window object)'''
-        
-        tick_count = 0
+        Blocks until the run is complete, see start_IT_poll for the non-blocking version used by the GUI.\n
+        self.ADC_IT_poll(datpts)\n
+        \t datpts: 64bit number for desired number of ADC samples'''
+
+        self.start_IT_poll(datpts).join()
+        self.finish_IT_poll()
+
+    def start_IT_poll(self,datpts):
+        '''Start an ADC_IT_poll run on a background receiver thread and return the StreamReceiver.\n
+        self.start_IT_poll(datpts)\n
+        \t datpts: 64bit number for desired number of ADC samples'''
+
         self.samples = datpts                                   # update samples item
-        progbar['maximum'] = int((4*datpts)/500)                    # update progress bar max value
-        rootwindow.update_idletasks()                              # force tkinter to refresh
-        
-        readm = array("H",[0]*500)                              # Bytearray for receiving ADC data (with no mem allocation)
-        self.data = array("H",[])                               # ADC values numpy array
         datptsb = datpts.to_bytes(8,'little',signed=False)      # convert data to an 8 byte integer for sending
 
-        print(self.sock.gettimeout())
-        self.sendcmd(2,1)
-        time.sleep(0.5)                                         # Send byte command
-        self.sock.sendto(datptsb,self.ipv4)                     # send num if data points to sample
-        
-        # Read data from socket into data and times in that order, given a predictable number of bytes coming through.
-        while int(len(self.data)/4) < datpts:
-            
-            self.sock.recv_into(readm)
-            tick_count+=1
-            self.data.extend(readm)
-            progbar['value'] = tick_count                           # update the progress bar value
-            rootwindow.update()                                    # force tkinter to update - non-ideal solution
-        
+        def handshake():
+            self.sendcmd(2,1)
+            time.sleep(0.5)                                     # Send byte command
+            self.sock.sendto(datptsb,self.ipv4)                 # send num if data points to sample
+
+        # 4 unsigned 16 bit samples per peak, datagrams of 500 samples from the board
+        self.receiver = StreamReceiver(self.sock, datpts*8, IT_POLL_PAYLOAD_SIZE, 'uint16', self.tout, handshake)
+        self.receiver.start()
+        return self.receiver
+
+    def finish_IT_poll(self):
+        '''Collect the data of a finished start_IT_poll run into self.data.'''
+
+        self.receiver.join()
         self.drain_socket()
+        self.receiver.raise_error()
         # Save and return the arrays.
-        self.data = numpy.array(self.data)
+        self.data = self.receiver.received(4)
         self.data.shape = (int(len(self.data)/4), 4)
         self.data = self.curvecorrect(self.data)                # apply linear fit corrections
-    
-    def adc_peak_find(self,datpts,progbar,rootwindow):
+        self.units = 'ADU'
+
+        # histogram the peak averages to the nearest ADU, zeros are left out
+        peaks = numpy.rint(numpy.average(self.data, axis=1)).astype('int64')
+        self.hist.reset()
+        self.hist.add(peaks[(peaks > 0) & (peaks < MAPIC_analysis.ADC_RANGE)])
+
+    def adc_peak_find(self,datpts,compact=False):
         '''DMA callback ADC measurement routine. Sends an 4 byte number for the  number of samples,\n 
         returns arrays of a single sample of peaks in ADC counts and times at the end of each peak in microseconds\n
-        from the start of the experiment.\n
-        self.adc_peak_find(datpts,progbar,rootwindow)\n
-        \t datpts: 64bit number for desired number of ADC samples\n
-        \t progbar: progressbar widget variable\n
-        \t rootwindow: tkinter.TK() object (root frame/window object)'''
-
-        tick_count = 0
-        self.sockdma.settimeout(5)                             # blocking socket waits for data
+        from the start of the experiment. Blocks until the run is complete, see start_peak_find for the\n
+        non-blocking version used by the GUI.\n
+        self.adc_peak_find(datpts, compact=False)\n
+        \t datpts: 64bit number for desired number of ADC samples
+        \t compact: ask the board for the 4 byte delta encoded records, see start_peak_find'''
+
+        self.start_peak_find(datpts, compact).join()
+        self.finish_peak_find()
+
+    def start_peak_find(self,datpts,compact=False,start=True,save=None):
+        '''Start an adc_peak_find run on a background receiver thread and return the StreamReceiver.\n
+        Poll receiver.progress() for the number of peaks received so far and call finish_peak_find once\n
+        the receiver is no longer alive.\n
+        self.start_peak_find(datpts, compact=False, start=True, save=None)\n
+        \t datpts: 64bit number for desired number of ADC samples
+        \t compact: ask the board for the 4 byte delta encoded records, twice the peaks per datagram
+        \t start: False to only create the receiver, the caller then starts the board with request_peak_find\n
+        \t and drives receiver.step itself, see MAPIC_manager
+        \t save: write the run to histdata, self.config['savemode'] if None'''
+
         self.samples = datpts                                   # update samples item
+        self.hist.reset()
+        self.histpos = (0, 0, None)
+        self.rate.reset()
 
-        progbar['value'] = 0
-        progbar['maximum'] = round(datpts/380)                  # update progress bar max value
-        rootwindow.update_idletasks()                           # force tkinter to refresh
-        
-        readm = array("I",[0]*380)                              # unsigned int array.array type to receive data
-        self.data = array("I",[])                               # unsigned int array to store data in RAM
-        datptsb = datpts.to_bytes(4,'little',signed=False)      # convert data to an 32 bit integer for sending
-
-        self.sendcmd(2,0)                                       # start adc_dma routine on board
-        time.sleep(0.5)                                         # ensure the board does not miss the data transmission below
-        self.sock.sendto(datptsb,self.ipv4)                     # send num if data points to sample
-        #a = datetime.datetime.now()
-        
-        # Read data from socket until we reach desired number of data points (*2 because 32bit second counter term also)
-        while len(self.data) < datpts*2:
+        def handshake():
+            self.request_peak_find(datpts, compact)
 
-            self.sockdma.recv_into(readm)
-            tick_count+=1
-            self.data.extend(readm)                             # extend array - faster than numpy
-            progbar['value'] = tick_count                       # update the progress bar value for 1 tick
-            rootwindow.update()                                 # force tkinter to update
+        writer = None
+        if self.config['savemode'] if save is None else save:      # stream the run to histdata while it arrives
+            writer = MAPIC_runfile.RunWriter(self.runpath(self.raw_dat_count), self.runheader(datpts),
+                'uint32', self.config.get('codec'))
+            self.catalog.start(self.runprefix, self.raw_dat_count, writer.header, [writer.path])
 
-        progbar['value'] = round(datpts/380)                    # ensure progress bar is full
-        rootwindow.update()
+        self.receiver = PeakStreamReceiver(self.sockdma, datpts, self.tout, handshake if start else None, writer, compact)
+        if start:
+            self.receiver.start()
+        return self.receiver
 
-        # TODO: Suppress terms with 0 adc measurement as these are result of recv_into buf not being filled?
-        
-        self.data = numpy.array(self.data,dtype='uint32')       #change data to numpy array
+    def request_peak_find(self,datpts,compact=False):
+        '''Start the adc_dma routine on the board, returns once the board acknowledges it is streaming.'''
+        self.command(2,3 if compact else 0,datpts.to_bytes(4,'little',signed=False))    # 32 bit integer
+
+    def start_histogram(self,datpts,interval=HIST_INTERVAL,delta=False,save=None):
+        '''Start a run counted in the on-board histogram, read_dma mode 2 or 3, and return its\n
+        HistogramStreamReceiver. The board sends snapshots of its counts every interval ms instead of every peak,\n
+        for rates too high to stream peak by peak when their times are not needed. Poll and finish the run as\n
+        for start_peak_find, self.data and self.data_time are left empty and self.hist has the counts.\n
+        self.start_histogram(datpts, interval=HIST_INTERVAL, delta=False, save=None)\n
+        \t datpts: number of peaks the board counts before it stops
+        \t interval: milliseconds between snapshots
+        \t delta: send the counts since the last snapshot, lost counts are gone where a full snapshot replaces them
+        \t save: write the final histogram to histdata, self.config['savemode'] if None'''
+
+        self.samples = datpts
+        self.hist.reset()
+        self.rate.reset()
+        self.ratecount = (0, None)
+
+        def handshake():
+            self.request_histogram(datpts, interval, delta)
+
+        writer = None
+        if self.config['savemode'] if save is None else save:
+            writer = MAPIC_runfile.RunWriter(self.runpath(self.raw_dat_count), dict(self.runheader(datpts),
+                format='histogram', interval=interval, delta=delta), 'int64', self.config.get('codec'))
+            self.catalog.start(self.runprefix, self.raw_dat_count, writer.header, [writer.path])
+
+        self.receiver = HistogramStreamReceiver(self.sockdma, datpts, self.tout, handshake, writer, delta)
+        self.receiver.start()
+        return self.receiver
+
+    def request_histogram(self,datpts,interval=HIST_INTERVAL,delta=False):
+        '''Start the on-board histogram routine, returns once the board acknowledges it is counting.'''
+        self.command(2,6 if delta else 5,datpts.to_bytes(4,'little',signed=False) + interval.to_bytes(2,'little',signed=False))
+
+    def start_continuous(self,window=CONTINUOUS_WINDOW,compact=False,resume=False,save=None,spillbytes=SPILL_BYTES,
+            spilltime=SPILL_TIME,keep=None):
+        '''Start an open ended run on a ContinuousReceiver and return it, the board streams until stop_peak_find.\n
+        self.hist and self.rate are kept up to date for the whole run by the receiver thread, so update_histogram\n
+        is not needed, and finish_peak_find leaves the last window peaks in self.data and self.data_time.\n
+        self.start_continuous(window=CONTINUOUS_WINDOW, compact=False, resume=False, save=None, spillbytes=SPILL_BYTES,
+            spilltime=SPILL_TIME, keep=None)\n
+        \t window: number of the most recent peaks kept in memory
+        \t compact: ask the board for the 4 byte delta encoded records
+        \t resume: carry on the last continuous run after stop_peak_find and finish_peak_find, with its counts,
+        \t run number, part files and settings, the other arguments are ignored
+        \t save: write the run to part files in a histdata folder, self.config['savemode'] if None
+        \t spillbytes, spilltime: bytes and seconds after which the next part file is started
+        \t keep: number of the latest part files kept, older ones are deleted, None keeps all of them'''
+
+        previous = getattr(self, 'receiver', None) if resume else None
+        if resume and not isinstance(previous, ContinuousReceiver):
+            raise ValueError('There is no continuous run to resume')
+        if resume:
+            window, compact, spillbytes, spilltime, keep = (previous.window, previous.compact, previous.spillbytes,
+                previous.spilltime, previous.keep)
+        self.samples = 0
+        if not resume:
+            self.hist.reset()
+            self.rate.reset()
+
+        directory = None
+        header = dict(self.runheader(0), continuous=True)
+        if resume and previous.directory is not None:
+            directory = previous.directory
+            if previous.counted:
+                self.raw_dat_count -= 1                         # the run keeps its number, finish_peak_find moved past it
+        elif not resume and (self.config['savemode'] if save is None else save):
+            directory = os.path.splitext(self.runpath(self.raw_dat_count))[0]
+            os.makedirs(directory)
+            self.catalog.start(self.runprefix, self.raw_dat_count, header, [directory])
+
+        def handshake():
+            self.request_peak_find(0, compact)                  # no peak limit, the board streams until stopped
+
+        self.receiver = ContinuousReceiver(self.sockdma, self.hist, self.rate, handshake, directory, header, window,
+            spillbytes, spilltime, keep, self.config.get('codec'), compact, previous=previous)
+        self.receiver.start()
+        return self.receiver
+
+    def stop_peak_find(self):
+        '''End a start_peak_find, start_histogram or start_continuous run before all its peaks have arrived, the peaks received\n
+        so far are kept.\n
+        Returns once the board has stopped streaming, after receiving the last partly filled packet it sends when it\n
+        stops. Any datagrams still on their way after that are discarded.'''
+
+        self.command(2,4)
+        self.receiver.stop(STOP_LINGER)
+        if self.receiver.ident is not None:
+            self.receiver.join()
+        self.drain_stream()
+
+    def drain_stream(self):
+        '''Drop the datagrams of a stopped stream still waiting on the stream socket.'''
+        self.sockdma.settimeout(0)                              # nonblocking, drop what is left of the stream
+        while True:
+            try:
+                self.sockdma.recv(MAX_PAYLOAD_SIZE)
+            except OSError:
+                break
+        self.sockdma.settimeout(RECV_POLL)
+
+    def finish_peak_find(self):
+        '''Decode the data of a finished start_peak_find or start_histogram run into self.data and self.data_time (microseconds).\n
+        If the run was saved the run file is closed, the run is completed in the catalog and self.raw_dat_count\n
+        moves to the next run.'''
+
+        if self.receiver.ident is not None:                     # never started when driven by MAPIC_manager
+            self.receiver.join()
+        if isinstance(self.receiver, ContinuousReceiver):
+            saved = self.receiver.directory is not None         # its parts are closed by the receiver, even between parts
+            self.receiver.counted = saved
+        else:
+            saved = self.receiver.writer is not None
+            if saved:
+                self.receiver.writer.close()
+        if saved:
+            self.raw_dat_count += 1
+        self.receiver.raise_error()
+        self.update_histogram()
+        self.data, self.data_time = self.receiver.decode()
+        self.units = 'ADU'
+        if saved:
+            self.record_run(self.raw_dat_count - 1)
+
+    def record_run(self,runno):
+        '''Complete the catalog record of run runno with the event count, files and summary of the run just finished:\n
+        the highest line of self.hist, the mean rate and dead time of self.rate and the stream losses.'''
+        line = self.hist.peak()
+        rate = self.rate.stats()
+        stats = self.stream_stats()
+        summary = {'centroid': line['centroid'], 'sigma': line['sigma'], 'resolution': line['resolution'],
+            'rate': rate['mean'], 'deadtime': rate['deadtime'], 'packets_lost': stats['packets_lost'],
+            'peaks_lost': stats['peaks_lost']}
+        paths = self.receiver.parts if isinstance(self.receiver, ContinuousReceiver) else None
+        self.catalog.finish(self.runprefix, runno, self.hist.total(), summary, paths)
+
+    def stream_stats(self):
+        '''Return the packet and peak loss accounting of the last start_peak_find run, see PeakStreamReceiver.stats.'''
+        return self.receiver.stats()
 
-        # Bitwise operations to extract the encoded data from the UDP stream.
-        self.data_time = self.data[0::2] + (1E-06 *  numpy.bitwise_and(numpy.right_shift(self.data[1::2],12),1048575))  
-        self.data = (self.data[1::2] & 4095)                    # ADC data
+    def update_histogram(self):
+        '''Add the peaks received since the last call to self.hist and their times to the rate monitor self.rate,\n
+        safe to call while a start_peak_find run is going.'''
+        if isinstance(self.receiver, ContinuousReceiver):
+            return                                              # the receiver thread keeps them up to date
+        if isinstance(self.receiver, HistogramStreamReceiver):
+            self.hist.counts[:] = self.receiver.counts          # the board already histogrammed the peaks
+            self.hist.version += 1
+            # no peak times in snapshots, the rate comes from the peaks the board counted between updates
+            peaks, now = self.receiver.boardpeaks, time.time()
+            counted, then = self.ratecount
+            if peaks > counted:
+                if then is not None:                            # the first snapshot only starts the clock
+                    self.rate.add_counts(peaks - counted, now - then)
+                self.ratecount = (peaks, now)
+            return
+        adc, time_us, self.histpos = self.receiver.decode_from(self.histpos)
+        self.hist.add(adc)
+        self.rate.add(time_us)
@@ -0,0 +1,144 @@
+'''Module containing the BoardManager class, used to run several MAPIC boards from one process. Each board keeps its
+own APIC on distinct local ports, and the DMA streams of all boards are received by a single selectors loop (epoll on
+linux) into the buffers of their PeakStreamReceivers, so adding a board does not add a thread.
+
+    >>> manager = BoardManager(10, [('192.168.4.1', 8080), ('192.168.5.1', 8080)])
+    >>> manager.setdest()                   # board i streams to port 9000 + i of this host
+    >>> manager.peak_find(100000)
+    >>> manager.hist.total(), manager.devices[0].data'''
+
+import selectors
+import socket
+import time
+
+import MAPIC_functions as MAPIC
+import MAPIC_analysis
+
+RECV_BUFFER = 1 << 22                               # kernel receive buffer of each stream socket in bytes, absorbs
+                                                    # bursts from one board while the others are serviced
+
+class BoardManager:
+    '''Several MAPIC boards driven together. The peaks of each board are stored by its APIC in self.devices, as for a\n
+    single board, and self.hist is the sum of the histograms of every board.\n
+    BoardManager(tout, boards, port=8080, dmaport=9000)\n
+    Arguments:
+        \t tout: socket timeout in seconds
+        \t boards: list of (ip, port) tuples, one for each board
+        \t port: local control port of the first board, board i uses port + i
+        \t dmaport: local DMA stream port of the first board, board i uses dmaport + i'''
+
+    def __init__(self, tout, boards, port=8080, dmaport=9000):
+        self.devices = [MAPIC.APIC(tout, ipv4, port + i, dmaport + i, 'board%i_run' % i) for i, ipv4 in enumerate(boards)]
+        self.hist = MAPIC_analysis.Histogram()      # aggregated histogram of every board
+        self.selector = selectors.DefaultSelector()
+        self.lastrecv = {}                          # time of the last datagram of each streaming board
+        for apic in self.devices:
+            apic.sockdma.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+
+    def setdest(self):
+        '''Point the DMA stream of every board at its own port on this host, see APIC.setdest.'''
+        for apic in self.devices:
+            apic.setdest()
+
+    def start_peak_find(self, datpts, compact=False):
+        '''Start a run of datpts peaks on every board. Call poll until it returns False, then finish_peak_find.\n
+        self.start_peak_find(datpts, compact=False)\n
+        \t datpts: number of peaks from each board
+        \t compact: ask the boards for the 4 byte delta encoded records, see APIC.start_peak_find'''
+        self.hist.reset()
+        for apic in self.devices:
+            receiver = apic.start_peak_find(datpts, compact, start=False)
+            apic.sockdma.setblocking(False)         # poll drains each socket until it would block
+            self.selector.register(apic.sockdma, selectors.EVENT_READ, (apic, memoryview(receiver.buffer).cast('B')))
+        started = []
+        try:
+            for apic in self.devices:
+                apic.request_peak_find(datpts, compact)     # acknowledged within milliseconds
+                self.lastrecv[apic] = time.time()
+                started.append(apic)
+        except Exception:
+            for apic in started:                    # stop the boards that did start streaming
+                try:
+                    apic.stop_peak_find()
+                except Exception:
+                    pass                            # the first error is the one raised
+            for key in list(self.selector.get_map().values()):
+                self.release(key)
+            for apic in self.devices:
+                if apic.receiver.writer is not None:
+                    apic.receiver.writer.close()
+            raise
+
+    def poll(self, timeout=MAPIC.RECV_POLL):
+        '''Receive every datagram waiting on any stream socket, waiting at most timeout seconds for the first one.\n
+        Returns True while any board is still streaming.'''
+        for key, events in self.selector.select(timeout):
+            apic, bufview = key.data
+            receiver = apic.receiver
+            try:
+                while not receiver.complete():
+                    receiver.step(bufview)
+            except BlockingIOError:
+                pass                                # socket drained
+            self.lastrecv[apic] = time.time()
+
+        now = time.time()
+        for key in list(self.selector.get_map().values()):
+            apic = key.data[0]
+            receiver = apic.receiver
+            if now - self.lastrecv[apic] >= receiver.tout:
+                receiver.error = socket.timeout('timed out')    # as the receiver thread would raise
+            if receiver.complete() or receiver.stopped.is_set() or receiver.error is not None:
+                self.release(key)
+        return len(self.selector.get_map()) > 0
+
+    def release(self, key):
+        '''Stop receiving the stream of the board of selector key and finish its receiver.'''
+        apic, bufview = key.data
+        self.selector.unregister(apic.sockdma)
+        bufview.release()
+        apic.sockdma.settimeout(MAPIC.RECV_POLL)
+        apic.receiver.finish()
+
+    def stop(self):
+        '''Stop receiving from every board, the data received so far stays available.'''
+        for apic in self.devices:
+            apic.receiver.stop()
+
+    def update_histogram(self):
+        '''Add the peaks received since the last call to the histogram of each board and to self.hist.'''
+        for apic in self.devices:
+            apic.update_histogram()
+        self.hist.counts[:] = sum(apic.hist.counts for apic in self.devices)
+        self.hist.version += 1
+
+    def finish_peak_find(self):
+        '''Decode the peaks of every board into its APIC, see APIC.finish_peak_find. The first error that ended a\n
+        board's run early is raised once every board has been finished.'''
+        errors = []
+        for apic in self.devices:
+            try:
+                apic.finish_peak_find()
+            except Exception as err:
+                errors.append(err)
+        self.update_histogram()
+        if errors:
+            raise errors[0]
+
+    def peak_find(self, datpts, compact=False):
+        '''Run datpts peaks on every board, blocking until all of them are complete.'''
+        self.start_peak_find(datpts, compact)
+        while self.poll():
+            pass
+        self.finish_peak_find()
+
+    def stream_stats(self):
+        '''Return the loss accounting of the last run of each board, see PeakStreamReceiver.stats.'''
+        return [apic.stream_stats() for apic in self.devices]
+
+    def close(self):
+        '''Close the sockets of every board.'''
+        self.selector.close()
+        for apic in self.devices:
+            apic.sock.close()
+            apic.sockdma.close()
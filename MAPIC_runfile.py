@@ -0,0 +1,357 @@
+'''Module containing the binary run file format used to save DAQ runs, with the RunWriter class to stream a run to
+disk while packets arrive, load_run to read it back, scan_run to size it and the RunReader class to explore the peaks
+of a run from the file pages without loading it.
+
+File layout, all integers little endian:
+    MAGIC (6 bytes) + header length (uint32) + JSON header
+    then any number of chunks: stored length (uint32) + raw length (uint32) + stored bytes
+
+The header holds the run settings (units, polarity, pot positions...) and the numpy dtype of the words. Chunks are raw
+words exactly as received from the board, optionally compressed with a stdlib codec. A chunk cut short by a crash is
+ignored by the loader so everything written before it can still be recovered.'''
+
+import struct
+import os
+import numpy
+import json
+import zlib
+import bz2
+import lzma
+
+import MAPIC_analysis
+
+MAGIC = b'MAPIC\x01'                                # file signature + format version
+CHUNK = struct.Struct('<II')                        # stored length, raw length
+CODECS = {'zlib': zlib, 'bz2': bz2, 'lzma': lzma}   # stdlib codecs, each with compress/decompress
+PEAK_DTYPE = numpy.dtype([('time_s','<u4'), ('packed','<u4')])  # 8 byte peak record, packed is (time_us << 12) | adc
+PEAK_RECORD = PEAK_DTYPE.itemsize                   # bytes of one peak record in a peak run
+INDEX_SUFFIX = '.index.npy'                         # sidecar time index of a run file, written by RunReader
+WRAP_US = 1 << 20                                   # the 20 bit time_us of a STREAM_PEAKS record wraps after this many us
+CLOCK_MHZ = 216                                     # PP_CLK_MHZ, rate of the 32 bit cycle counter time_us is taken from
+CYCLE_WRAPS = -(-(1 << 32)//(CLOCK_MHZ*WRAP_US))    # time_us wraps in one cycle counter period of 19.88 s, the last early
+
+class RunWriter:
+    '''Append-only writer for a binary run file, chunks are written as soon as write is called.\n
+    RunWriter(path, header, dtype, codec=None)\n
+    Arguments:
+        \t path: file path to create
+        \t header: dictionary of JSON serialisable run settings
+        \t dtype: numpy dtype string of the words written e.g. "uint32"
+        \t codec: None for raw chunks or a key of CODECS to compress each chunk'''
+
+    def __init__(self, path, header, dtype, codec=None):
+        if codec is not None and codec not in CODECS:
+            raise ValueError('Codec is not supported. Acceptable values are None or one of %s' % (sorted(CODECS),))
+
+        self.path = path
+        self.codec = codec
+        self.header = dict(header, dtype=numpy.dtype(dtype).str, codec=codec)
+        self.nbytes = 0                             # raw bytes written so far
+
+        headerb = json.dumps(self.header).encode('utf-8')
+        self.fp = open(path, 'wb')
+        self.fp.write(MAGIC + struct.pack('<I', len(headerb)) + headerb)
+
+    def write(self, words):
+        '''Append a chunk of words (numpy array or buffer) to the file.'''
+        raw = memoryview(words).cast('B')
+        if len(raw) == 0:
+            return
+        stored = raw if self.codec is None else CODECS[self.codec].compress(raw)
+        self.fp.write(CHUNK.pack(len(stored), len(raw)))
+        self.fp.write(stored)
+        self.nbytes += len(raw)
+
+    def close(self):
+        self.fp.close()
+
+def load_header(fp):
+    '''Read and return the JSON header from an open run file, leaving fp at the first chunk.'''
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a MAPIC run file' % (fp.name,))
+    size, = struct.unpack('<I', fp.read(4))
+    return json.loads(fp.read(size).decode('utf-8'))
+
+def scan_run(path):
+    '''Return the header dictionary and the number of raw bytes of a binary run file, reading only the chunk lengths.\n
+    scan_run(path)'''
+    with open(path, 'rb') as fp:
+        header = load_header(fp)
+        size = os.fstat(fp.fileno()).st_size
+        nbytes = 0
+        while True:
+            lengths = fp.read(CHUNK.size)
+            if len(lengths) < CHUNK.size:
+                break
+            storedlen, rawlen = CHUNK.unpack(lengths)
+            if fp.tell() + storedlen > size:
+                break                               # partial chunk at the end of an interrupted run
+            fp.seek(storedlen, 1)
+            nbytes += rawlen
+    return header, nbytes
+
+def load_run(path):
+    '''Load a binary run file, returning the header dictionary and a numpy array of all words in the run.\n
+    load_run(path)'''
+    with open(path, 'rb') as fp:
+        header = load_header(fp)
+        codec = header['codec']
+        chunks = []
+        while True:
+            lengths = fp.read(CHUNK.size)
+            if len(lengths) < CHUNK.size:
+                break
+            storedlen, rawlen = CHUNK.unpack(lengths)
+            stored = fp.read(storedlen)
+            if len(stored) < storedlen:
+                break                               # partial chunk at the end of an interrupted run
+            chunks.append(stored if codec is None else CODECS[codec].decompress(stored))
+
+    return header, numpy.frombuffer(b''.join(chunks), dtype=header['dtype'])
+
+def recode_run(path, out, codec=None):
+    '''Copy a binary run file to out with its chunks stored with codec, one chunk at a time, e.g. to turn a compressed\n
+    run into a raw one that RunReader can map.\n
+    recode_run(path, out, codec=None)'''
+    with open(path, 'rb') as fp:
+        header = load_header(fp)
+        settings = {key: value for key, value in header.items() if key not in ('dtype', 'codec')}
+        writer = RunWriter(out, settings, header['dtype'], codec)
+        while True:
+            lengths = fp.read(CHUNK.size)
+            if len(lengths) < CHUNK.size:
+                break
+            storedlen, rawlen = CHUNK.unpack(lengths)
+            stored = fp.read(storedlen)
+            if len(stored) < storedlen:
+                break                               # partial chunk at the end of an interrupted run
+            writer.write(stored if header['codec'] is None else CODECS[header['codec']].decompress(stored))
+        writer.close()
+
+def run_files(paths):
+    '''Return the run files of paths in order, paths being a run file, the folder of the parts of a start_continuous\n
+    run, or a list of them.\n
+    run_files(paths)'''
+    files = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.mapic')]
+        else:
+            files.append(path)
+    return files
+
+class BoardClock:
+    '''Time in us from the start of the run of STREAM_PEAKS records in the order they arrived. The board sends time_s 0\n
+    and as time_us its 32 bit cycle counter in us, cut to 20 bits, so time_us wraps every WRAP_US and again early when\n
+    the cycle counter wraps every 2^32 cycles, 19.88 s. Both are unwrapped here: a step back of more than WRAP_US/2 is\n
+    taken as a wrap, every CYCLE_WRAPS wraps make one cycle counter period. Times are right to 1 us as long as peaks\n
+    are less than about 0.48 s apart, the shortest gap that can hide a wrap, and a packet is not reordered by more.\n
+    Records with a non zero time_s, as written by encode_peaks, hold whole seconds and are taken as they are.\n
+    BoardClock(state=None)\n
+    Arguments:
+        \t state: the state of a clock after the records before these, None at the start of a run'''
+
+    def __init__(self, state=None):
+        self.last, self.wraps = (None, 0) if state is None else state
+
+    def state(self):
+        '''Return the time_us of the last record and the wraps so far, JSON serialisable to save with a part file.'''
+        return self.last, self.wraps
+
+    def times(self, records, out=None):
+        '''Return the times in us of records, a PEAK_DTYPE array following the records seen so far, written to out\n
+        if it is given.'''
+        out = numpy.empty(len(records), dtype='int64') if out is None else out
+        if len(records) == 0:
+            return out
+        numpy.right_shift(records['packed'], 12, out=out, casting='unsafe')
+        steps = numpy.diff(out, prepend=out[0] if self.last is None else self.last)
+        wraps = numpy.cumsum(steps < -WRAP_US//2, dtype='int64')
+        wraps += self.wraps
+        self.last, self.wraps = int(out[-1]), int(wraps[-1])
+
+        periods = wraps//CYCLE_WRAPS
+        out += (wraps - periods*CYCLE_WRAPS)*WRAP_US + (periods << 32)//CLOCK_MHZ
+        exact = numpy.flatnonzero(records['time_s'])
+        if len(exact):
+            out[exact] = records['time_s'][exact].astype('int64')*1000000 + (records['packed'][exact] >> 12)
+        return out
+
+class RunReader:
+    '''Memory mapped reader of the peaks of a saved run, to explore runs larger than memory. Peak records are read\n
+    from the pages of the run files only when used, and a time index finds the peaks of any time span with a binary\n
+    search, so a span is histogrammed or fitted without decoding the rest of the run.\n
+    The index holds the time of every peak in us from the start of the run, unwrapped by a BoardClock started from\n
+    the clock saved in the file header, and made non decreasing, so the peaks of a reordered packet take the time of\n
+    the latest peak before them. The index of each file is written next to it with INDEX_SUFFIX the first time it is\n
+    read, and built again if the file changed.\n
+    Files whose clock started again, the parts of a resumed continuous run, are moved to start where the file before\n
+    ends. Only raw chunks can be mapped, convert compressed runs with recode_run first.\n
+    RunReader(paths)\n
+    Arguments:
+        \t paths: peak run file or folder of a start_continuous run, or a list of them read one after the other'''
+
+    def __init__(self, paths):
+        self.paths = run_files(paths)
+        if not self.paths:
+            raise ValueError('No run files to read in %s' % (paths,))
+
+        self.files = []
+        self.ends = []                              # time of the last peak of each file, non decreasing
+        total, end = 0, None
+        for path in self.paths:
+            run = self.map(path)
+            run['first'] = total
+            run['shift'] = 0
+            if len(run['index']):
+                if end is not None:
+                    run['shift'] = max(end - int(run['index'][0]), 0)
+                end = int(run['index'][-1]) + run['shift']
+            total += int(run['starts'][-1])
+            self.files.append(run)
+            self.ends.append(end if end is not None else -1)
+        self.header = self.files[0]['header']
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def map(self, path):
+        '''Map one run file, returning a dictionary of its header, pages, chunk offsets, first record of each chunk\n
+        and time index.'''
+        with open(path, 'rb') as fp:
+            header = load_header(fp)
+            pos = fp.tell()
+        if header.get('codec') is not None:
+            raise ValueError('%s is compressed with %s and cannot be mapped, convert it with recode_run first'
+                % (path, header['codec']))
+        if header.get('format') != 'peak':
+            raise ValueError('%s is a %s run, only peak runs hold peak times' % (path, header.get('format')))
+
+        pages = numpy.memmap(path, dtype='uint8', mode='r')
+        offsets, counts = [], []
+        while pos + CHUNK.size <= len(pages):
+            storedlen, rawlen = CHUNK.unpack_from(pages, pos)
+            pos += CHUNK.size
+            if pos + storedlen > len(pages):
+                break                               # partial chunk at the end of an interrupted run
+            offsets.append(pos)
+            counts.append(storedlen//PEAK_RECORD)
+            pos += storedlen
+        run = {'path': path, 'header': header, 'pages': pages, 'offsets': offsets,
+            'starts': numpy.concatenate(([0], numpy.cumsum(counts, dtype='int64')))}
+        run['index'] = self.load_index(run)
+        return run
+
+    def chunk(self, run, chunk):
+        '''Return the peak records of one chunk of run, a view of the mapped pages.'''
+        count = int(run['starts'][chunk + 1] - run['starts'][chunk])
+        offset = run['offsets'][chunk]
+        return run['pages'][offset:offset + count*PEAK_RECORD].view(PEAK_DTYPE)
+
+    def load_index(self, run):
+        '''Return the time index of run, mapped from its index file, which is written first if it is missing or older\n
+        than the run file. The index is kept in memory if the folder cannot be written.'''
+        path = run['path'] + INDEX_SUFFIX
+        npeaks = int(run['starts'][-1])
+        if npeaks == 0:
+            return numpy.zeros(0, dtype='int64')
+        try:
+            if os.path.getmtime(path) >= os.path.getmtime(run['path']):
+                index = numpy.load(path, mmap_mode='r')
+                if index.shape == (npeaks,):
+                    return index
+        except (OSError, ValueError):
+            pass                                    # no index yet, or a broken one
+
+        try:
+            index = numpy.lib.format.open_memmap(path + '.tmp', mode='w+', dtype='int64', shape=(npeaks,))
+        except OSError:
+            index = numpy.empty(npeaks, dtype='int64')
+        self.build_index(run, index)
+        if not isinstance(index, numpy.memmap):
+            return index
+        index.flush()
+        del index
+        os.replace(path + '.tmp', path)             # never leave a half written index behind
+        return numpy.load(path, mmap_mode='r')
+
+    def build_index(self, run, index):
+        '''Fill index with the unwrapped, non decreasing time of every peak of run, one chunk at a time.'''
+        clock, latest = BoardClock(run['header'].get('clock')), None
+        for chunk in range(len(run['offsets'])):
+            records = self.chunk(run, chunk)
+            if len(records) == 0:
+                continue
+            times = clock.times(records)
+            numpy.maximum.accumulate(times, out=times)
+            if latest is not None:
+                numpy.maximum(times, latest, out=times)
+            latest = int(times[-1])
+            index[run['starts'][chunk]:run['starts'][chunk + 1]] = times
+
+    def bounds(self):
+        '''Return the times in us of the first and last peaks of the run, (0, 0) if it has none.'''
+        if self.total == 0:
+            return 0, 0
+        first = next(run for run in self.files if len(run['index']))
+        return int(first['index'][0]) + first['shift'], self.ends[-1]
+
+    def position(self, t):
+        '''Return the first record with a time of at least t us.'''
+        i = int(numpy.searchsorted(self.ends, t))
+        if i == len(self.files):
+            return self.total
+        run = self.files[i]
+        return run['first'] + int(numpy.searchsorted(run['index'], t - run['shift']))
+
+    def span(self, t0=None, t1=None):
+        '''Return the (start, stop) records of the peaks with t0 <= time < t1 in us, None for the start or end of\n
+        the run, with two binary searches of the index.'''
+        return (0 if t0 is None else self.position(t0)), (self.total if t1 is None else max(self.position(t1), 0))
+
+    def blocks(self, start, stop):
+        '''Yield the peak records from record start to stop as views of the mapped pages, one per chunk, each with\n
+        its run and the position of its first record in that run.'''
+        for run in self.files:
+            low, high = max(start - run['first'], 0), min(stop - run['first'], int(run['starts'][-1]))
+            if low >= high:
+                continue
+            for chunk in range(int(numpy.searchsorted(run['starts'], low, 'right')) - 1, len(run['offsets'])):
+                first, end = int(run['starts'][chunk]), int(run['starts'][chunk + 1])
+                if first >= high:
+                    break
+                yield self.chunk(run, chunk)[max(low - first, 0):min(high, end) - first], run, max(low, first)
+
+    def decode(self, start=0, stop=None):
+        '''Return (adc, time_us) numpy arrays of uint16 and int64 of the peaks from record start to stop, as\n
+        MAPIC_functions.decode_peaks with the times of the index.'''
+        adc, time_us = [numpy.zeros(0, dtype='uint16')], [numpy.zeros(0, dtype='int64')]
+        for records, run, pos in self.blocks(start, self.total if stop is None else stop):
+            adc.append(numpy.bitwise_and(records['packed'], 4095, out=numpy.empty(len(records), dtype='uint16'),
+                casting='unsafe'))
+            time_us.append(run['index'][pos:pos + len(records)] + run['shift'])
+        return numpy.concatenate(adc), numpy.concatenate(time_us)
+
+    def read(self, t0=None, t1=None):
+        '''Return (adc, time_us) of the peaks with t0 <= time < t1 in us, see decode.'''
+        return self.decode(*self.span(t0, t1))
+
+    def histogram(self, t0=None, t1=None, hist=None):
+        '''Return a MAPIC_analysis.Histogram of the peaks with t0 <= time < t1 in us, counted chunk by chunk from the\n
+        mapped pages. The peaks are added to hist if one is given.'''
+        hist = MAPIC_analysis.Histogram() if hist is None else hist
+        for records, run, pos in self.blocks(*self.span(t0, t1)):
+            hist.add(records['packed'] & 4095)
+        return hist
+
+    def fit(self, window, lines=1, units='ADU', t0=None, t1=None):
+        '''Fit lines in window of the histogram of the peaks with t0 <= time < t1 in us, see\n
+        MAPIC_analysis.PeakFitter.fit for the arguments and the result.'''
+        return MAPIC_analysis.PeakFitter(self.histogram(t0, t1)).fit(window, lines, units)
+
+    def close(self):
+        '''Release the mapped files, the reader cannot be used after.'''
+        self.files = []
+        self.ends = []
+        self.total = 0
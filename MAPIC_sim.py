@@ -0,0 +1,442 @@
+'''Pure python stand-in for the Pyboard D running main.py, used to exercise and load test the host code without the
+board. Binds the board control port and acknowledges the commands of the commands table in main.py (see
+MAPIC_control), streaming simulated peaks in the SendDataPeak payload layout of extension/adc.c or histogram
+snapshots as extension/peakfind.c.
+
+Replies go back to the address each command came from and the DMA stream to port 9000 of that host, so on one machine
+the host APIC must bind a different control port than the simulator, e.g.
+
+    $ python MAPIC_sim.py --rate 50000 --loss 0.01
+    >>> apic = APIC(10, ('127.0.0.1', 8080), port=8081)'''
+
+import threading
+import argparse
+import socket
+import numpy
+import time
+
+import MAPIC_control
+
+MAX_PAYLOAD_SIZE = 1472                             # see MAX_PAYLOAD_SIZE in adc.c
+HEADER_WORDS = 4                                    # seq, peaks in packet, peaks sent before, stream format
+STREAM_PEAKS = 0                                    # stream format id of the 8 byte peak records
+STREAM_COMPACT = 1                                  # stream format id of the 4 byte delta encoded records
+SEND_PEAKS = (MAX_PAYLOAD_SIZE//4 - HEADER_WORDS)//2    # PACKET_PEAKS, SendDataPeak sends once a packet is full
+COMPACT_HEADER_WORDS = HEADER_WORDS + 2             # header + 64 bit time in us of the peak before the packet
+SEND_COMPACT = MAX_PAYLOAD_SIZE//4 - COMPACT_HEADER_WORDS - 3   # AddCompactPeak sends once this many words are used
+DELTA_BITS = 20                                     # bits of delta_us in a compact word
+PP_CLK_MHZ = 216                                    # rate of the 32 bit cycle counter peak times are taken from, peakfind.h
+STREAM_HIST = 2                                     # stream format id of full histogram snapshots
+STREAM_HIST_DELTA = 3                               # stream format id of histogram snapshots of the counts since the last
+HIST_HEADER_WORDS = HEADER_WORDS + 2                # header + first bin + (packets in snapshot << 16) | bins in packet
+HIST_CHUNK = 256                                    # bins per histogram packet, chunks without counts are not sent
+HIST_FINAL = 1 << 31                                # flag on the snapshot number of the last snapshot
+PP_THR = 500                                        # board peak finder threshold in ADC counts
+DMA_BUFFER_SIZE = 40                                # words in the circular DMA buffer at boot
+DMA_BUFFER_MAX = 4096                               # largest DMA buffer adc.dma_buffer accepts
+I2C_GAIN = 0x2D                                     # gain potentiometer address
+I2C_THRESH = 0x2C                                   # threshold potentiometer address
+GAIN_POS = 134                                      # gain pot position the spectrum lines are given at
+REPLY_CACHE = 8                                     # replies kept to answer retries, as main.py
+CAL_PAIRS = 90                                      # pulse pairs per calibration datagram, as cbcal in main.py
+CAL_CURVE = (2E-05, 0.9, 30)                        # simulated shaper transfer curve, output = a*input**2 + b*input + c in ADU
+CAL_NOISE = 3                                       # ADC noise of each calibration sample in ADU
+
+class Spectrum:
+    '''Amplitude distribution of simulated peaks: a sum of gaussian lines on a flat background.\n
+    Spectrum(lines, background)\n
+    Arguments:
+        \t lines: list of (mean, sigma, weight) tuples in ADC counts
+        \t background: fraction of events drawn uniformly between PP_THR and 4095'''
+
+    def __init__(self, lines=((2480, 12, 1),), background=0.05):
+        self.lines = numpy.array(lines, dtype='float64').reshape(-1, 3)
+        self.background = background
+
+    def sample(self, rng, n, gain=1):
+        '''Return n integer ADC peak values above the board threshold, line positions and widths scaled by gain.'''
+        weights = self.lines[:, 2]/self.lines[:, 2].sum()
+        line = rng.choice(len(self.lines), n, p=weights)
+        adc = rng.normal(self.lines[line, 0]*gain, self.lines[line, 1]*gain)
+        flat = rng.random_sample(n) < self.background
+        adc[flat] = rng.uniform(PP_THR, 4095, flat.sum())
+        return numpy.clip(numpy.rint(adc), PP_THR + 1, 4095).astype('uint32')
+
+class PyboardSim:
+    '''Simulated pyboard, call serve to answer commands until stop is called.\n
+    PyboardSim(addr, rate, spectrum, loss, dmaport, seed, reorder, cmdloss, speed)\n
+    Arguments:
+        \t addr: (ip, port) tuple to bind the control socket to
+        \t rate: mean event rate in Hz, events arrive as a poisson process
+        \t spectrum: Spectrum of peak amplitudes
+        \t loss: probability each stream datagram is dropped
+        \t dmaport: port on the host the DMA stream is sent to
+        \t seed: random seed, None for a random run
+        \t reorder: probability each stream datagram is held back and sent after the next one
+        \t cmdloss: probability each command datagram is dropped before the board sees it
+        \t speed: simulated seconds of peak stream sent per second, above 1 to reach the board clock wraps sooner'''
+
+    def __init__(self, addr=('127.0.0.1', 8080), rate=1000, spectrum=None, loss=0, dmaport=9000, seed=None, reorder=0,
+            cmdloss=0, speed=1):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(tuple(addr))
+        self.sock.settimeout(0.2)
+        self.sockdma = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self.rate = rate
+        self.spectrum = spectrum if spectrum is not None else Spectrum()
+        self.loss = loss
+        self.reorder = reorder
+        self.cmdloss = cmdloss
+        self.speed = speed
+        self.dmaport = dmaport
+        self.rng = numpy.random.RandomState(seed)
+
+        # board state, as the globals and pins of main.py
+        self.pots = {I2C_GAIN: GAIN_POS, I2C_THRESH: 128}
+        self.polarity = 0
+        self.testpulse = 0
+        self.STATE = "STARTUP"
+        self.peakfinder = (PP_THR, 0, 0, 0)         # threshold, min width, max width, pile-up veto
+        self.dmasize = DMA_BUFFER_SIZE              # words in the circular DMA buffer
+        self.sent = 0                               # stream datagrams sent
+        self.txsent = 0                             # stream datagrams sent since the last read_DMA, as adc.udp_stats
+        self.txerrors = 0                           # stream datagrams the socket failed to send since then
+        self.dropped = 0                            # stream datagrams dropped on purpose
+        self.reordered = 0                          # stream datagrams sent late on purpose
+        self.stopped = threading.Event()
+        self.streamstop = threading.Event()         # set by stop_DMA to end the running stream
+        self.stream = None                          # thread of the running read_DMA
+
+        self.commands = {
+            bytes([0,0]) : self.Ir,                 # read first gain potentiometer, then threshold
+            bytes([0,2]) : self.Is,                 # scan I2C addresses
+            bytes([1,0]) : lambda addr, args : self.Iw(I2C_GAIN, args),
+            bytes([1,1]) : lambda addr, args : self.Iw(I2C_THRESH, args),
+            bytes([1,2]) : self.apply_profile,
+            bytes([2,0]) : self.read_DMA,
+            bytes([2,3]) : lambda addr, args : self.read_DMA(addr, args, STREAM_COMPACT),
+            bytes([2,4]) : self.stop_DMA,
+            bytes([2,5]) : lambda addr, args : self.read_DMA(addr, args, STREAM_HIST),
+            bytes([2,6]) : lambda addr, args : self.read_DMA(addr, args, STREAM_HIST_DELTA),
+            bytes([4,0]) : lambda addr, args : self.setpin('polarity', 0),
+            bytes([4,1]) : lambda addr, args : self.setpin('polarity', 1),
+            bytes([5,0]) : self.calibrate,
+            bytes([5,1]) : self.rateaq,
+            bytes([5,2]) : self.stop_DMA,
+            bytes([6,0]) : lambda addr, args : self.setpin('testpulse', 0),
+            bytes([6,1]) : lambda addr, args : self.setpin('testpulse', 1),
+            bytes([7,1]) : self.checkstate,
+            bytes([7,0]) : self.setstate,
+            bytes([8,0]) : self.setdest,
+            bytes([9,0]) : self.peak_config,
+            bytes([9,1]) : self.peak_rejected,
+            bytes([9,2]) : self.dma_buffer,
+            bytes([9,3]) : self.udp_stats,
+        }
+        self.replies = []                           # (request header, sender, reply) of the last commands
+
+    def serve(self):
+        '''Main loop of main.py: wait for a command, run it and acknowledge it.'''
+        while not self.stopped.is_set():
+            try:
+                msg, addr = self.sock.recvfrom(MAX_PAYLOAD_SIZE)
+            except socket.timeout:
+                continue
+            if self.rng.random_sample() < self.cmdloss:
+                continue                            # lost on the way to the board
+            if len(msg) < MAPIC_control.REQUEST.size:
+                print('UNKNOWN COMMAND', list(msg))
+                continue
+            self.sock.sendto(self.acknowledge(msg, addr), addr)
+
+    def acknowledge(self, msg, addr):
+        '''Run the command in msg and return its reply, or the earlier reply if msg is a retry, as main.py.'''
+        header = msg[:MAPIC_control.REQUEST.size]
+        for last in self.replies:
+            if last[0] == header and last[1] == addr:
+                return last[2]
+        command = header[:2]
+        if command in self.commands:
+            try:
+                reply = header + bytes([MAPIC_control.ACK_OK]) + self.commands[command](addr, msg[len(header):])
+            except Exception:
+                reply = header + bytes([MAPIC_control.ACK_ERROR])
+        else:
+            reply = header + bytes([MAPIC_control.ACK_UNKNOWN])
+        self.replies = self.replies[-(REPLY_CACHE - 1):] + [(header, addr, reply)]
+        return reply
+
+    def stop(self):
+        self.stopped.set()
+        if self.stream is not None:
+            self.stream.join()
+
+    def close(self):
+        self.stop()
+        self.sock.close()
+        self.sockdma.close()
+
+    def setpin(self, name, value):
+        setattr(self, name, value)
+        return b''
+
+    # I2C CONTROL
+    def Ir(self, addr, args):
+        return bytes([self.pots[I2C_GAIN], self.pots[I2C_THRESH]])
+
+    def Iw(self, address, args):
+        self.pots[address] = args[0]
+        return b''
+
+    def apply_profile(self, addr, args):
+        self.pots[I2C_GAIN], self.pots[I2C_THRESH], self.polarity, self.testpulse = args[:4]
+        return self.Ir(addr, args) + bytes([self.polarity, self.testpulse])
+
+    def Is(self, addr, args):
+        return bytes(sorted(self.pots))
+
+    # STATE
+    def checkstate(self, addr, args):
+        return self.STATE.encode('utf-8')
+
+    def setstate(self, addr, args):
+        self.STATE = args.decode('utf-8')
+        return b''
+
+    def setdest(self, addr, args):
+        '''Send the DMA stream to the port in args, on the host the command came from.'''
+        self.dmaport = int.from_bytes(args, 'little')
+        return b''
+
+    # PEAK FINDER
+    def peak_config(self, addr, args):
+        self.peakfinder = tuple(int.from_bytes(args[i:i + 2], 'little') for i in range(0, 8, 2))
+        return b''
+
+    def peak_rejected(self, addr, args):
+        '''Simulated peaks are drawn as the finder would accept them, so none are ever rejected.'''
+        return bytes(12)
+
+    def dma_buffer(self, addr, args):
+        '''Set the DMA buffer size as adc.dma_buffer, the simulated stream never overruns.'''
+        if len(args) >= 2:
+            size = int.from_bytes(args[:2], 'little')
+            if size < 2 or size > DMA_BUFFER_MAX or size % 2:
+                raise ValueError('DMA buffer size must be even and at most %i' % DMA_BUFFER_MAX)
+            self.dmasize = size
+        return self.dmasize.to_bytes(2, 'little') + bytes(4)
+
+    def udp_stats(self, addr, args):
+        '''Stream datagrams sent and failed since the last read_DMA, a socket holds no pbufs so none are busy.'''
+        return b''.join(count.to_bytes(4, 'little') for count in (self.txsent, self.txerrors, 0))
+
+    # RATE MEASUREMENT
+    def rateaq(self, addr, args, ratetime=MAPIC_control.RATE_TIME):
+        '''Count simulated events for ratetime seconds like rateaq in main.py.'''
+        time.sleep(ratetime)
+        finalrate = round(self.rng.poisson(self.rate*ratetime)/ratetime)
+        return finalrate.to_bytes(4, 'little')
+
+    # DMA STREAM
+    def read_DMA(self, addr, args, mode=STREAM_PEAKS):
+        '''Stream the number of peaks in args from a thread, the command loop keeps running as the DMA callbacks\n
+        on the board run from interrupts.'''
+        mnum = int.from_bytes(args[:4], 'little')
+        if self.stream is not None:
+            self.stream.join()
+        self.streamstop.clear()
+        self.txsent = self.txerrors = 0
+        if mode in (STREAM_HIST, STREAM_HIST_DELTA):
+            target, streamargs = self.send_hist, (mnum, (addr[0], self.dmaport), mode, int.from_bytes(args[4:6], 'little'))
+        else:
+            target, streamargs = self.send_peaks, (mnum, (addr[0], self.dmaport), mode)
+        self.stream = threading.Thread(target=target, args=streamargs, daemon=True)
+        self.stream.start()
+        return b''
+
+    def calibrate(self, addr, args):
+        '''Stream input and output pulse pairs to the port in args for at most the seconds in args, as calibrate in main.py.'''
+        if self.stream is not None:
+            self.stream.join()
+        self.streamstop.clear()
+        dest = (addr[0], int.from_bytes(args[:2], 'little'))
+        self.stream = threading.Thread(target=self.send_calibration, args=(dest, int.from_bytes(args[2:4], 'little')),
+            daemon=True)
+        self.stream.start()
+        return b''
+
+    def send_calibration(self, dest, maxtime):
+        '''Send a datagram of 4 output and 4 input samples per pulse for every CAL_PAIRS pulses at the event rate, and\n
+        an empty datagram once maxtime seconds have passed or stop_DMA is called.'''
+        start = time.time()
+        while not self.stopped.is_set() and not self.streamstop.is_set() and time.time() - start < maxtime:
+            time.sleep(CAL_PAIRS/self.rate)
+            inputs = self.rng.uniform(200, 3500, CAL_PAIRS)
+            outputs = numpy.polyval(CAL_CURVE, inputs)*self.gain()
+            samples = numpy.stack((outputs, inputs), axis=1)[:, :, None] + self.rng.normal(0, CAL_NOISE, (CAL_PAIRS, 2, 4))
+            self.send_datagram(numpy.clip(numpy.rint(samples), 1, 4095).astype('<u2'), dest)
+        self.sockdma.sendto(b'', dest)
+
+    def stop_DMA(self, addr, args):
+        '''End the running stream or calibration, acknowledged once it has stopped.'''
+        self.streamstop.set()
+        if self.stream is not None:
+            self.stream.join()
+        return b''
+
+    def gain(self):
+        '''Return the amplitude scale of the gain pot position relative to GAIN_POS.'''
+        return self.pots[I2C_GAIN]/GAIN_POS
+
+    def peak_payload(self, times, seqNum, totpeakNum):
+        '''Return the datagram of SendPacket for peaks at times in seconds from the start of the stream. As SendDataPeak\n
+        time_s is always 0 and time_us is the 32 bit cycle counter in us, of which only 20 bits fit in the record.'''
+        n = len(times)
+        payload = numpy.empty(HEADER_WORDS + 2*n, dtype='<u4')
+        payload[:HEADER_WORDS] = (seqNum, n, totpeakNum, STREAM_PEAKS)
+        peaks = payload[HEADER_WORDS:]
+        peaks[0::2] = 0                                                                 # time_s, never set on the board
+        cycles = numpy.floor(times*PP_CLK_MHZ*1E6).astype('int64') & 0xFFFFFFFF        # DWT->CYCCNT, zeroed by read_dma
+        time_us = (cycles//PP_CLK_MHZ).astype('uint32') & 0xFFFFF
+        peaks[1::2] = (time_us << 12) | self.spectrum.sample(self.rng, n, self.gain())  # (time_us << 12) | max_adc
+        return payload
+
+    def compact_payload(self, times, seqNum, totpeakNum, last_us):
+        '''Return the datagram of SendCompactPacket and the number of peaks in it, as many of the peaks at times\n
+        in seconds as AddCompactPeak fits in one packet.'''
+        time_us = numpy.rint(times*1E6).astype('int64')
+        delta = numpy.diff(time_us, prepend=last_us)
+        escape = (delta >> DELTA_BITS) != 0                  # one escape word holds gaps up to 2^40 us
+        n = min(int(numpy.searchsorted(numpy.cumsum(1 + escape), SEND_COMPACT)) + 1, len(times))
+        delta, escape = delta[:n], escape[:n]
+        words = (delta & ((1 << DELTA_BITS) - 1)) << 12 | self.spectrum.sample(self.rng, n, self.gain())
+        words = numpy.insert(words, numpy.nonzero(escape)[0], (delta[escape] >> DELTA_BITS) << 12)
+        payload = numpy.empty(COMPACT_HEADER_WORDS + len(words), dtype='<u4')
+        payload[:COMPACT_HEADER_WORDS] = (seqNum, n, totpeakNum, STREAM_COMPACT, last_us & 0xFFFFFFFF, last_us >> 32)
+        payload[COMPACT_HEADER_WORDS:] = words
+        return payload, n
+
+    def hist_payloads(self, counts, seqNum, snapshot, peaks, mode, final):
+        '''Return the datagrams of hist_snapshot in peakfind.c for the counts of the on-board histogram.'''
+        chunks = [first for first in range(0, len(counts), HIST_CHUNK) if counts[first:first + HIST_CHUNK].any()]
+        if not chunks:
+            header = (seqNum, snapshot | (HIST_FINAL if final else 0), peaks, mode, 0, 1 << 16)
+            return [numpy.array(header, dtype='<u4')]
+        payloads = []
+        for i, first in enumerate(chunks):
+            payload = numpy.empty(HIST_HEADER_WORDS + HIST_CHUNK, dtype='<u4')
+            payload[:HIST_HEADER_WORDS] = (seqNum + i, snapshot | (HIST_FINAL if final else 0), peaks, mode, first,
+                (len(chunks) << 16) | HIST_CHUNK)
+            payload[HIST_HEADER_WORDS:] = counts[first:first + HIST_CHUNK]
+            payloads.append(payload)
+        return payloads
+
+    def send_datagram(self, payload, dest):
+        '''Send one stream datagram, counting it as sent or failed as mp_send_udp_ref.'''
+        try:
+            self.sockdma.sendto(payload.tobytes(), dest)
+        except OSError:
+            self.txerrors += 1
+            return
+        self.sent += 1
+        self.txsent += 1
+
+    def send_hist(self, mnum, dest, mode, interval):
+        '''Count peaks in an on-board histogram until more than mnum have been counted (until stopped if mnum is 0),\n
+        sending a snapshot every interval ms and a last one when the run ends, as read_dma modes 2 and 3.'''
+        counts = numpy.zeros(4096, dtype='uint32')
+        start = time.time()
+        peaks = 0
+        seqNum = 0
+        snapshot = 0
+        while True:
+            time.sleep(max(start + (snapshot + 1)*interval/1000 - time.time(), 0))
+            n = self.rng.poisson(self.rate*interval/1000)
+            counts += numpy.bincount(self.spectrum.sample(self.rng, n, self.gain()), minlength=4096).astype('uint32')
+            peaks += n
+            final = (mnum != 0 and peaks > mnum) or self.stopped.is_set() or self.streamstop.is_set()
+            for payload in self.hist_payloads(counts, seqNum, snapshot, peaks, mode, final):
+                if self.rng.random_sample() < self.loss:
+                    self.dropped += 1
+                else:
+                    self.send_datagram(payload, dest)
+                seqNum += 1
+            if mode == STREAM_HIST_DELTA:
+                counts[:] = 0
+            snapshot += 1
+            if final:
+                break
+
+    def send_peaks(self, mnum, dest, mode=STREAM_PEAKS):
+        '''Stream peaks in real time until more than mnum have been sent, or until stopped if mnum is 0, a full packet\n
+        per datagram with the stream header as SendPacket, or SendCompactPacket for mode STREAM_COMPACT. When stopped\n
+        the peaks found so far of the packet being filled are sent, as stream_dma_half does.'''
+        start = time.time()
+        t = 0.0                                         # time of the last simulated event
+        last_us = 0                                     # t in us as the compact stream sees it
+        totpeakNum = 0
+        seqNum = 0
+        held = None                                     # datagram held back to be sent out of order
+        while (mnum == 0 or totpeakNum <= mnum) and not self.stopped.is_set() and not self.streamstop.is_set():
+            times = t + numpy.cumsum(self.rng.exponential(1/self.rate, SEND_PEAKS if mode == STREAM_PEAKS else SEND_COMPACT))
+            payload, n = self.packet(times, seqNum, totpeakNum, last_us, mode)
+            wait = start + times[n - 1]/self.speed - time.time()
+            stopped = wait > 0 and self.streamstop.wait(wait)
+            if stopped:
+                n = int(numpy.searchsorted(times[:n], (time.time() - start)*self.speed, 'right'))
+                if n == 0:
+                    break                               # no peak since the last packet, nothing to send
+                payload = self.packet(times[:n], seqNum, totpeakNum, last_us, mode)[0]
+            last_us = int(numpy.rint(times[n - 1]*1E6))
+            t = times[n - 1]                            # peaks that did not fit are not needed, arrivals are memoryless
+            seqNum += 1
+            totpeakNum += n
+
+            if self.rng.random_sample() < self.loss:
+                self.dropped += 1
+            elif held is None and not stopped and (mnum == 0 or totpeakNum <= mnum) and self.rng.random_sample() < self.reorder:
+                held = payload
+                self.reordered += 1
+            else:
+                self.send_datagram(payload, dest)
+                if held is not None:
+                    self.send_datagram(held, dest)
+                    held = None
+        if held is not None:
+            self.send_datagram(held, dest)              # stopped right after holding it back
+
+    def packet(self, times, seqNum, totpeakNum, last_us, mode):
+        '''Return the datagram of mode for the peaks at times and the number of peaks in it, see peak_payload and\n
+        compact_payload.'''
+        if mode == STREAM_PEAKS:
+            return self.peak_payload(times, seqNum, totpeakNum), len(times)
+        return self.compact_payload(times, seqNum, totpeakNum, last_us)
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated MAPIC pyboard.')
+    parser.add_argument('--ip', default='127.0.0.1', help='address to bind the control socket to')
+    parser.add_argument('--port', type=int, default=8080, help='control port')
+    parser.add_argument('--dmaport', type=int, default=9000, help='host port the DMA stream is sent to')
+    parser.add_argument('--rate', type=float, default=1000, help='mean event rate in Hz')
+    parser.add_argument('--loss', type=float, default=0, help='probability of dropping each stream datagram')
+    parser.add_argument('--reorder', type=float, default=0, help='probability of sending each stream datagram late')
+    parser.add_argument('--cmdloss', type=float, default=0, help='probability of dropping each command datagram')
+    parser.add_argument('--line', action='append', default=None, metavar='MEAN,SIGMA,WEIGHT',
+        help='gaussian line in ADC counts, may be repeated')
+    parser.add_argument('--background', type=float, default=0.05, help='fraction of flat background events')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    parser.add_argument('--speed', type=float, default=1, help='simulated seconds of peak stream sent per second')
+    args = parser.parse_args()
+
+    lines = [tuple(float(v) for v in line.split(',')) for line in args.line] if args.line else ((2480, 12, 1),)
+    board = PyboardSim((args.ip, args.port), args.rate, Spectrum(lines, args.background), args.loss, args.dmaport, args.seed,
+        args.reorder, args.cmdloss, args.speed)
+    print("SOCKET BOUND")
+    try:
+        board.serve()
+    except KeyboardInterrupt:
+        board.close()
+
+if __name__ == '__main__':
+    main()
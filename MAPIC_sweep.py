@@ -0,0 +1,161 @@
+'''Module containing the Sweep class, an automated scan of gain and threshold potentiometer positions used to find a
+working point. At each point of the grid the profile is applied, a short peak find run is taken and the rate, centroid
+and resolution of the highest line are recorded. A run ends once its centroid is known to the requested precision,
+and the next profile is applied as soon as it does, so each point is analysed on a worker thread while the next one
+settles and acquires.
+
+    $ python MAPIC_sweep.py --gain 100:200:10 --thresh 120 --output sweep.json
+    >>> sweep = Sweep(apic, grid(range(100, 201, 10), [120]))
+    >>> sweep.run(); sweep.best()'''
+
+import concurrent.futures
+import argparse
+import json
+import time
+
+import MAPIC_functions as MAPIC
+import MAPIC_analysis
+
+SETTLE = 0.1                                        # seconds for the shaper to settle after a profile change
+POLL = 0.1                                          # seconds between convergence checks, as the GUI frame period
+
+def grid(gains, thresholds):
+    '''Return the list of (gainpos, threshpos) points of every gain with every threshold.'''
+    return [(gainpos, threshpos) for gainpos in gains for threshpos in thresholds]
+
+def positions(text):
+    '''Parse "start:stop:step" (stop included) or a comma separated list of pot positions.'''
+    if ':' in text:
+        start, stop, step = (int(v) for v in text.split(':'))
+        return list(range(start, stop + 1, step))
+    return [int(v) for v in text.split(',')]
+
+class Sweep:
+    '''Scan of pot positions with one short acquisition per point, see run.\n
+    Sweep(apic, points, maxpeaks=20000, minpeaks=500, tol=0.5, settle=SETTLE, compact=False, boardrate=False)\n
+    Arguments:
+        \t apic: connected APIC, its polarity and test pulse state are kept at every point
+        \t points: list of (gainpos, threshpos) tuples, see grid
+        \t maxpeaks: peaks requested at each point, the run ends there if it has not converged
+        \t minpeaks: peaks needed in the line before convergence is checked
+        \t tol: standard error of the centroid in ADU at which a point has converged
+        \t settle: seconds to wait after applying each profile
+        \t compact: use the compact delta encoded stream
+        \t boardrate: also measure the rate with APIC.rateaq, which takes 4 seconds per point'''
+
+    def __init__(self, apic, points, maxpeaks=20000, minpeaks=500, tol=0.5, settle=SETTLE, compact=False, boardrate=False):
+        self.apic = apic
+        self.points = list(points)
+        self.maxpeaks = maxpeaks
+        self.minpeaks = minpeaks
+        self.tol = tol
+        self.settle = settle
+        self.compact = compact
+        self.boardrate = boardrate
+        self.results = []                           # one dictionary per point, see analyse
+        self.error = None                           # error that stopped the sweep early, see run
+
+    def run(self):
+        '''Measure every point in order and return self.results. As soon as the board has stopped streaming for a\n
+        point the next profile is applied, and the point is analysed on a worker thread while that profile settles\n
+        and acquires, so the settle time only runs from when the profile was applied. A profile is never changed\n
+        during a run, the pots are shared by the whole board. A run ended by an error, such as a board that stopped\n
+        streaming, stops the sweep there: its point is recorded with the error, which is kept in self.error.'''
+        pending = []
+        self.error = None
+        applied = self.apply(*self.points[0]) if self.points else None
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            for i, (gainpos, threshpos) in enumerate(self.points):
+                time.sleep(max(applied + self.settle - time.time(), 0))
+                start = time.time()
+                converged = self.acquire()
+                elapsed = time.time() - start
+                failed = self.apic.receiver.error is not None
+                rate = self.apic.rateaq() if self.boardrate and not failed else None    # at this profile
+                if not failed and i + 1 < len(self.points):
+                    applied = self.apply(*self.points[i + 1])
+                # the receiver and a copy of the counts are all the analysis needs, the next point gets new ones
+                pending.append(pool.submit(self.analyse, self.apic.receiver, self.apic.hist.counts.copy(),
+                    gainpos, threshpos, converged, elapsed, rate))
+                if failed:
+                    self.error = self.apic.receiver.error
+                    break
+            self.results = [future.result() for future in pending]
+        return self.results
+
+    def apply(self, gainpos, threshpos):
+        '''Apply the profile of a point, keeping the polarity and test pulse state, and return the time it was applied.'''
+        self.apic.apply_profile(gainpos, threshpos, self.apic.polarity, self.apic.testpulse)
+        return time.time()
+
+    def acquire(self):
+        '''Take a run at the current profile until maxpeaks or until the centroid converges, returning True if it did.'''
+        receiver = self.apic.start_peak_find(self.maxpeaks, self.compact, save=False)
+        while receiver.is_alive():
+            receiver.join(POLL)
+            self.apic.update_histogram()
+            line = self.apic.hist.peak()
+            if line['peaks'] >= self.minpeaks and line['stderr'] <= self.tol:
+                self.apic.stop_peak_find()
+                self.apic.update_histogram()
+                return True
+        return False
+
+    def analyse(self, receiver, counts, gainpos, threshpos, converged, elapsed, boardrate):
+        '''Return the result dictionary of one point: pot positions, peaks received, acquisition seconds, rate in\n
+        Hz from the peak times (and from rateaq if measured), the line statistics of Histogram.peak, whether the\n
+        point converged and the error that ended its run, if any.'''
+        hist = MAPIC_analysis.Histogram()
+        hist.counts = counts
+        data, data_time = receiver.decode()
+        rate = MAPIC_analysis.RateMonitor(deadtime=0)
+        rate.add(data_time)
+        result = {'gainpos': gainpos, 'threshpos': threshpos, 'peaks': len(data), 'seconds': elapsed,
+            'rate': rate.mean(), 'boardrate': boardrate, 'converged': converged,
+            'error': repr(receiver.error) if receiver.error is not None else None}
+        result.update(('line_' + key, value) for key, value in hist.peak().items())
+        return result
+
+    def best(self, key='line_resolution'):
+        '''Return the converged result with the smallest value of key, the best resolution by default.'''
+        converged = [result for result in self.results if result['converged']]
+        return min(converged, key=lambda result: result[key]) if converged else None
+
+    def save(self, path):
+        '''Write the results to a JSON file.'''
+        with open(path, 'w') as fp:
+            json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'maxpeaks': self.maxpeaks, 'minpeaks': self.minpeaks,
+                'tol': self.tol, 'settle': self.settle, 'results': self.results}, fp, indent=1)
+
+def main():
+    MAPIC.load_config()
+    parser = argparse.ArgumentParser(description='Sweep MAPIC gain and threshold pot positions.')
+    parser.add_argument('--ip', default=MAPIC.default['ipv4'][0], help='board address')
+    parser.add_argument('--port', type=int, default=MAPIC.default['ipv4'][1], help='board control port')
+    parser.add_argument('--localport', type=int, default=8080, help='local control port')
+    parser.add_argument('--gain', default=str(MAPIC.default['gainpos']), help='gain positions, start:stop:step or a list')
+    parser.add_argument('--thresh', default=str(MAPIC.default['threshpos']), help='threshold positions, start:stop:step or a list')
+    parser.add_argument('--maxpeaks', type=int, default=20000, help='most peaks taken at each point')
+    parser.add_argument('--minpeaks', type=int, default=500, help='peaks in the line before checking convergence')
+    parser.add_argument('--tol', type=float, default=0.5, help='centroid standard error in ADU to stop at')
+    parser.add_argument('--settle', type=float, default=SETTLE, help='seconds to wait after each profile change')
+    parser.add_argument('--compact', action='store_true', help='use the compact stream format')
+    parser.add_argument('--boardrate', action='store_true', help='also measure each rate on the board (4s per point)')
+    parser.add_argument('--output', default='sweep.json', help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    apic = MAPIC.APIC(MAPIC.default['timeout'], (args.ip, args.port), port=args.localport)
+    sweep = Sweep(apic, grid(positions(args.gain), positions(args.thresh)), args.maxpeaks, args.minpeaks, args.tol,
+        args.settle, args.compact, args.boardrate)
+    start = time.time()
+    for result in sweep.run():
+        print('gain %3i  thresh %3i  %7i peaks  %9.1f Hz  centroid %7.1f +- %5.2f  resolution %6.2f%%  %s' % (
+            result['gainpos'], result['threshpos'], result['peaks'], result['rate'], result['line_centroid'],
+            result['line_stderr'], 100*result['line_resolution'], 'converged' if result['converged'] else result['error'] or ''))
+    if sweep.error is not None:
+        print('Sweep stopped after %i of %i points: %r' % (len(sweep.results), len(sweep.points), sweep.error))
+    print('%i points in %.1f s, best %s' % (len(sweep.results), time.time() - start, sweep.best()))
+    sweep.save(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,7 @@
 #include "dma.h"
 #include "led.h"
 #include "udpsend.h"
+#include "peakfind.h"
 #if MICROPY_HW_ENABLE_ADC
 
 /// \moduleref pyb
@@ -167,40 +168,47 @@
 #define ADC_SCALE (ADC_SCALE_V / ((1 << ADC_CAL_BITS) - 1))
 #define VREFIN_CAL ((uint16_t *)ADC_CAL_ADDRESS)
 
-#define DMA_BUFFER_SIZE ((uint32_t)40)
-#define MAX_PAYLOAD_SIZE 1472
-#define NUMBER_PEAKS MAX_PAYLOAD_SIZE/8
-#define NUMBER_WORDS MAX_PAYLOAD_SIZE/4
-#define PP_THR 500
-#define PP_WINDOW_MAX 10
-#define PP_WINDOW_MIN 5
-#define PP_CLK_MHZ 216
-
 //static void adc_dma_DeInit(ADC_HandleTypeDef *adch);
 static void Error_Handler(void);
-static void SendDataPeak(void);
+static void DMA_Half(ADC_HandleTypeDef *adch, int half);
+static void SendStreamPacket(const uint32_t *words, uint32_t nwords);
+static uint32_t DWT_cycles(void);
 static void DWT_config(void);
 static void adc_dma_DeInit(ADC_HandleTypeDef *adch); 
 
-__IO uint32_t aADCConvertedValues[DMA_BUFFER_SIZE];
-uint8_t in_peak = 0;
-uint16_t max_adc = 0;
-uint32_t cycl = 0;
-uint32_t peakNum = 0;
-uint32_t seconds = 0;
-uint32_t last_cycles = 0;
-uint32_t time_s = 0;
-uint32_t totpeakNum = 0;
-uint32_t tot_samples = 0;
+__IO uint32_t aADCConvertedValues[DMA_BUFFER_MAX];
+peak_stream_t stream = {
+    .buffer = aADCConvertedValues,
+    .size = DMA_BUFFER_SIZE,            // set with dma_buffer
+    .finder = {.threshold = PP_THR},    // settings from peak_config, no width window or pile-up veto at boot
+    .cycles = DWT_cycles,
+    .ticks_ms = HAL_GetTick,
+    .send = SendStreamPacket,
+};
 bool udpinit = false;
-u32_t payload[NUMBER_WORDS];
 udp_send_obj_t *UDPS;
 
+// Each half of the circular buffer is processed while the DMA fills the other one
+void HAL_ADC_ConvHalfCpltCallback(ADC_HandleTypeDef *adch){
+    DMA_Half(adch, 0);
+}
+
 void HAL_ADC_ConvCpltCallback(ADC_HandleTypeDef *adch){
-    SendDataPeak();
-    if (totpeakNum > tot_samples){
-    adc_dma_DeInit(adch);
-    printf("DMA_FIN\n");
+    DMA_Half(adch, 1);
+}
+
+static void DMA_Half(ADC_HandleTypeDef *adch, int half){
+    uint32_t pos = 0;
+
+    if (stream_dma_half(&stream, half)) {
+        adc_dma_DeInit(adch);
+        printf("DMA_FIN\n");
+        return;
+    }
+    // the DMA should still be filling the other half, if not it has overwritten samples not yet processed
+    pos = stream.size - __HAL_DMA_GET_COUNTER(adch->DMA_Handle);
+    if ((pos < stream.size/2) == (half == 0)) {
+        stream.overruns++;
     }
 }
 
@@ -208,6 +216,10 @@ static void Error_Handler(void){
     printf("ERROR!\n");
 }
 
+static uint32_t DWT_cycles(void){
+    return DWT->CYCCNT;
+}
+
 // Reset system ticks
 static void DWT_config(void){
     CoreDebug->DEMCR |= CoreDebug_DEMCR_TRCENA_Msk;
@@ -215,52 +227,10 @@ static void DWT_config(void){
     DWT->CTRL |= DWT_CTRL_CYCCNTENA_Msk;
 }
 
-void SendDataPeak(void){
-  if (peakNum < NUMBER_PEAKS-8) {
-    
-    uint32_t time_us = 0;
-    uint32_t val1 = 0;
-  
-    for (int n = 0; n < DMA_BUFFER_SIZE; n++) {
-      val1 = (0xFFFF & aADCConvertedValues[n]);
-      if (in_peak == 0) {
-        if (val1 > PP_THR){
-          //sampleIdx = 0;
-          in_peak = 1;
-          time_s = seconds;
-          cycl = DWT->CYCCNT;
-        }
-      } 
-      else {
-        if (val1 > max_adc) {
-          max_adc = val1;
-        }
-        //sampleIdx++;
-        if (val1 < PP_THR) {
-          in_peak = 0;
-          //if (sampleIdx >= PP_WINDOW_MIN && sampleIdx <= PP_WINDOW_MAX) {
-            //found peak
-            if ((cycl - last_cycles) > 0) {
-              time_us = (cycl - last_cycles) / PP_CLK_MHZ;
-            } else {
-              time_us = (4294967296 + cycl - last_cycles) / PP_CLK_MHZ;
-            }
-            payload[peakNum * 2] = time_s;
-            payload[peakNum * 2 + 1] = (time_us << 12) | (max_adc);
-            peakNum++;
-            max_adc = 0;
-            //Pull stretcher pulse down again
-          //}
-        }
-      }
-    }
-    if (peakNum >= NUMBER_PEAKS - 8) {
-      //udp_send_data((u8_t *)payload, peakNum*8);
-        mp_send_udp(UDPS->pcb, (u8_t*)payload, &UDPS->destip, UDPS->port, peakNum*8);
-        totpeakNum = totpeakNum + peakNum;
-        peakNum = 0;
-    }
-  }
+// Send one datagram of the stream by reference, called by stream_dma_half which leaves words alone until the next
+// send. Failed sends are counted in UDPS, see udp_stats.
+static void SendStreamPacket(const uint32_t *words, uint32_t nwords){
+    mp_send_udp_ref(UDPS, (const u8_t*)words, nwords*4);
 }
 
 static void adc_dma_DeInit(ADC_HandleTypeDef *adch){
@@ -765,19 +735,17 @@ STATIC mp_obj_t adc_read_timed(mp_obj_t self_in, mp_obj_t buf_in, mp_obj_t freq_
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_3(adc_read_timed_obj, adc_read_timed);
 
-STATIC mp_obj_t adc_read_dma(mp_obj_t self_in, mp_obj_t sample_num) {
+/// \method read_dma(sample_num, mode=0, interval_ms=100)
+/// Stream peaks to the host until more than sample_num have been sent, or until stop_dma if sample_num is 0.
+/// mode 0 sends 8 byte peak records, mode 1 the compact delta encoded records.
+/// mode 2 counts the peaks in an on-board histogram instead and sends a snapshot of it every interval_ms,
+/// mode 3 the same but each snapshot holds only the counts since the previous one.
+STATIC mp_obj_t adc_read_dma(size_t n_args, const mp_obj_t *args) {
 
-    pyb_obj_adc_t *self = MP_OBJ_TO_PTR(self_in);
-    tot_samples = mp_obj_get_int(sample_num);
-
-    totpeakNum = 0;
-
-    for(int n = 0; n < DMA_BUFFER_SIZE; n++){
-    aADCConvertedValues[n]=0;
-    }
-    for(int n = 0; n < NUMBER_PEAKS; n++){
-    payload[n]=0;
-    }
+    pyb_obj_adc_t *self = MP_OBJ_TO_PTR(args[0]);
+    stream_start(&stream, (n_args > 2) ? mp_obj_get_int(args[2]) : STREAM_PEAKS, mp_obj_get_int(args[1]),
+        (n_args > 3) ? mp_obj_get_int(args[3]) : HIST_INTERVAL);
+    mp_reset_udp_stats(UDPS);
 
     static DMA_HandleTypeDef DMAHandle;
 
@@ -791,7 +759,7 @@ STATIC mp_obj_t adc_read_dma(mp_obj_t self_in, mp_obj_t sample_num) {
 
     DWT_config();
 
-    if(HAL_ADC_Start_DMA(&self->handle, (uint32_t *)aADCConvertedValues, 40) != HAL_OK){
+    if(HAL_ADC_Start_DMA(&self->handle, (uint32_t *)aADCConvertedValues, stream.size) != HAL_OK){
         Error_Handler();
     }
 
@@ -799,23 +767,98 @@ STATIC mp_obj_t adc_read_dma(mp_obj_t self_in, mp_obj_t sample_num) {
 
 }
 
-STATIC MP_DEFINE_CONST_FUN_OBJ_2(adc_read_dma_obj, adc_read_dma);
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(adc_read_dma_obj, 2, 4, adc_read_dma);
+
+/// \method stop_dma()
+/// End a read_dma stream early, the DMA is stopped after the next half buffer of samples, once the peaks of the
+/// last partly filled packet have been sent.
+STATIC mp_obj_t adc_stop_dma(mp_obj_t self_in) {
+    stream.stop = 1;
+    return mp_const_none;
+}
 
+STATIC MP_DEFINE_CONST_FUN_OBJ_1(adc_stop_dma_obj, adc_stop_dma);
 
-// CAN'T READOUT INTERLEAVED MODE IN POLLING //
-STATIC mp_obj_t adc_read_interleaved(mp_obj_t self_in, mp_obj_t sample_num) {
+/// \method peak_config(threshold, min_width, max_width, pileup)
+/// Set the peak finder of read_dma: peaks start above and end below threshold ADC counts, peaks with fewer than
+/// min_width or more than max_width samples above threshold are rejected, and so are peaks that fall and rise
+/// again by more than pileup ADC counts. max_width 0 and pileup 0 turn those checks off. Applies from the next
+/// read_dma.
+STATIC mp_obj_t adc_peak_config(size_t n_args, const mp_obj_t *args) {
+    peak_finder_init(&stream.finder, mp_obj_get_int(args[1]), mp_obj_get_int(args[2]), mp_obj_get_int(args[3]),
+        mp_obj_get_int(args[4]));
+    return mp_const_none;
+}
 
-    pyb_obj_adc_t *self = MP_OBJ_TO_PTR(self_in);
-    tot_samples = mp_obj_get_int(sample_num);
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(adc_peak_config_obj, 5, 5, adc_peak_config);
+
+/// \method peak_rejected()
+/// Return a tuple of the peaks rejected since the last read_dma started: (narrow, wide, pileup).
+STATIC mp_obj_t adc_peak_rejected(mp_obj_t self_in) {
+    mp_obj_t rejected[3] = {
+        mp_obj_new_int_from_uint(stream.finder.narrow),
+        mp_obj_new_int_from_uint(stream.finder.wide),
+        mp_obj_new_int_from_uint(stream.finder.piledup),
+    };
+    return mp_obj_new_tuple(3, rejected);
+}
 
-    totpeakNum = 0;
+STATIC MP_DEFINE_CONST_FUN_OBJ_1(adc_peak_rejected_obj, adc_peak_rejected);
 
-    for(int n = 0; n < DMA_BUFFER_SIZE; n++){
-    aADCConvertedValues[n]=0;
+/// \method dma_buffer([size])
+/// Set the words in the circular DMA buffer of the next read_dma, an even number up to DMA_BUFFER_MAX. Larger
+/// buffers mean fewer callbacks for higher sample rates, peak times are taken once per half buffer.
+/// Returns (size, overruns): the buffer size and the halves the DMA overwrote before the last read_dma could
+/// process them.
+STATIC mp_obj_t adc_dma_buffer(size_t n_args, const mp_obj_t *args) {
+    if (n_args > 1) {
+        mp_int_t size = mp_obj_get_int(args[1]);
+        if (size < 2 || size > DMA_BUFFER_MAX || size % 2 != 0) {
+            nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, "DMA buffer size must be even and at most 4096"));
+        }
+        stream.size = size;
     }
-    for(int n = 0; n < NUMBER_PEAKS; n++){
-    payload[n]=0;
+    mp_obj_t info[2] = {
+        mp_obj_new_int_from_uint(stream.size),
+        mp_obj_new_int_from_uint(stream.overruns),
+    };
+    return mp_obj_new_tuple(2, info);
+}
+
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(adc_dma_buffer_obj, 1, 2, adc_dma_buffer);
+
+/// \method udp_stats()
+/// Return a tuple of the stream datagrams since the last read_dma started: (sent, errors, busy). errors failed
+/// in udp_sendto, mostly ERR_MEM with the pbuf pool empty, busy were dropped as their pbuf was still held.
+STATIC mp_obj_t adc_udp_stats(mp_obj_t self_in) {
+    mp_obj_t stats[3] = {
+        mp_obj_new_int_from_uint(UDPS->sent),
+        mp_obj_new_int_from_uint(UDPS->errors),
+        mp_obj_new_int_from_uint(UDPS->busy),
+    };
+    return mp_obj_new_tuple(3, stats);
+}
+
+STATIC MP_DEFINE_CONST_FUN_OBJ_1(adc_udp_stats_obj, adc_udp_stats);
+
+/// \method stream_dest(ip, port)
+/// Send the DMA stream to ip (dotted quad string) and port instead of 192.168.4.16:9000.
+STATIC mp_obj_t adc_stream_dest(mp_obj_t self_in, mp_obj_t ip_in, mp_obj_t port_in) {
+    if (!mp_set_udp_dest(UDPS, mp_obj_str_get_str(ip_in), mp_obj_get_int(port_in))) {
+        nlr_raise(mp_obj_new_exception_msg(&mp_type_ValueError, "invalid IP address"));
     }
+    return mp_const_none;
+}
+
+STATIC MP_DEFINE_CONST_FUN_OBJ_3(adc_stream_dest_obj, adc_stream_dest);
+
+
+// CAN'T READOUT INTERLEAVED MODE IN POLLING //
+STATIC mp_obj_t adc_read_interleaved(mp_obj_t self_in, mp_obj_t sample_num) {
+
+    pyb_obj_adc_t *self = MP_OBJ_TO_PTR(self_in);
+    stream_start(&stream, STREAM_PEAKS, mp_obj_get_int(sample_num), HIST_INTERVAL);
+    mp_reset_udp_stats(UDPS);
 
     // configure + link DMA
     static DMA_HandleTypeDef DMAHandle;
@@ -850,7 +893,7 @@ STATIC mp_obj_t adc_read_interleaved(mp_obj_t self_in, mp_obj_t sample_num) {
     DWT_config();
 
     // Start triple interleaved mode with ADC1
-    if (HAL_ADCEx_MultiModeStart_DMA(&self->handle, (uint32_t *)aADCConvertedValues, 40) != HAL_OK) {
+    if (HAL_ADCEx_MultiModeStart_DMA(&self->handle, (uint32_t *)aADCConvertedValues, stream.size) != HAL_OK) {
         Error_Handler();
     }
 
@@ -974,6 +1017,12 @@ STATIC MP_DEFINE_CONST_STATICMETHOD_OBJ(adc_read_timed_multi_obj, MP_ROM_PTR(&ad
 STATIC const mp_rom_map_elem_t adc_locals_dict_table[] = {
     { MP_ROM_QSTR(MP_QSTR_read), MP_ROM_PTR(&adc_read_obj) },
     { MP_ROM_QSTR(MP_QSTR_read_dma), MP_ROM_PTR(&adc_read_dma_obj) },
+    { MP_ROM_QSTR(MP_QSTR_stream_dest), MP_ROM_PTR(&adc_stream_dest_obj) },
+    { MP_ROM_QSTR(MP_QSTR_stop_dma), MP_ROM_PTR(&adc_stop_dma_obj) },
+    { MP_ROM_QSTR(MP_QSTR_peak_config), MP_ROM_PTR(&adc_peak_config_obj) },
+    { MP_ROM_QSTR(MP_QSTR_peak_rejected), MP_ROM_PTR(&adc_peak_rejected_obj) },
+    { MP_ROM_QSTR(MP_QSTR_dma_buffer), MP_ROM_PTR(&adc_dma_buffer_obj) },
+    { MP_ROM_QSTR(MP_QSTR_udp_stats), MP_ROM_PTR(&adc_udp_stats_obj) },
     { MP_ROM_QSTR(MP_QSTR_read_timed), MP_ROM_PTR(&adc_read_timed_obj) },
     { MP_ROM_QSTR(MP_QSTR_deinit_setup), MP_ROM_PTR(&adc_deinit_setup_obj) },
     { MP_ROM_QSTR(MP_QSTR_read_interleaved), MP_ROM_PTR(&adc_read_interleaved_obj) },
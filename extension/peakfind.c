@@ -0,0 +1,304 @@
+#include "peakfind.h"
+/************************************************************
+ * PEAK FINDING AND THE DMA PEAK STREAM
+ * Peaks are found in each half of the DMA buffer by
+ * peak_sample, its state carries over from one half to the
+ * next. They are sent as peak records, compact records, or
+ * counted in RAM by the histogram stream which sends
+ * snapshots of the counts at a fixed interval, so the data
+ * rate does not grow with the event rate.
+************************************************************/
+
+void peak_finder_init(peak_finder_t *finder, uint32_t threshold, uint32_t min_width, uint32_t max_width, uint32_t pileup){
+
+    finder->threshold = threshold;
+
+    finder->min_width = min_width;
+
+    finder->max_width = max_width;
+
+    finder->pileup = pileup;
+
+    peak_finder_reset(finder);
+
+}
+
+// Clear the state of the peak in progress and the rejected peak counts, the settings are kept
+void peak_finder_reset(peak_finder_t *finder){
+
+    finder->in_peak = 0;
+
+    finder->piled = 0;
+
+    finder->max_adc = 0;
+
+    finder->valley = 0;
+
+    finder->width = 0;
+
+    finder->narrow = 0;
+
+    finder->wide = 0;
+
+    finder->piledup = 0;
+
+}
+
+void hist_reset(peak_hist_t *hist){
+
+    memset(hist->counts, 0, sizeof(hist->counts));
+
+    hist->peaks = 0;
+
+    hist->seq = 0;
+
+    hist->snapshot = 0;
+
+}
+
+// Count the peaks ending in n samples, returns the number found
+uint32_t hist_fill(peak_finder_t *finder, peak_hist_t *hist, const volatile uint32_t *samples, uint32_t n){
+
+    uint32_t found = 0;
+    uint16_t adc = 0;
+
+    for (uint32_t i = 0; i < n; i++) {
+        if (peak_sample(finder, 0xFFFF & samples[i], &adc) == PEAK_END) {
+            hist->counts[adc & (HIST_BINS - 1)]++;
+            found++;
+        }
+    }
+    hist->peaks += found;
+    return found;
+
+}
+
+static int chunk_empty(const uint32_t *counts){
+    for (int i = 0; i < HIST_CHUNK; i++) {
+        if (counts[i] != 0) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+// Send the payload being filled and switch to the other one, so the one sent is not written again before the
+// next send: the board sends it by reference without copying
+static void stream_send(peak_stream_t *stream, uint32_t nwords){
+    stream->send(stream->payload, nwords);
+    stream->payload = stream->payloads[stream->payload == stream->payloads[0]];
+}
+
+// Send the counts as STREAM_HIST, or as STREAM_HIST_DELTA and clear them so the next snapshot holds only the
+// peaks counted after this one. A snapshot without counts is sent as one header only packet, so the host
+// still sees the stream is alive and where the last snapshot is.
+void hist_snapshot(peak_stream_t *stream, int final){
+
+    peak_hist_t *hist = &stream->hist;
+    uint32_t packets = 0;
+    uint32_t nbins = 0;
+
+    for (uint32_t first = 0; first < HIST_BINS; first += HIST_CHUNK) {
+        packets += !chunk_empty(&hist->counts[first]);
+    }
+
+    for (uint32_t first = 0; first < HIST_BINS; first += HIST_CHUNK) {
+        uint32_t *payload = stream->payload;
+
+        if (packets != 0 && chunk_empty(&hist->counts[first])) {
+            continue;
+        }
+        nbins = (packets != 0) ? HIST_CHUNK : 0;
+        payload[0] = hist->seq;
+        payload[1] = hist->snapshot | (final ? HIST_FINAL : 0);
+        payload[2] = hist->peaks;
+        payload[3] = stream->mode;
+        payload[4] = first;
+        payload[5] = ((packets != 0 ? packets : 1) << 16) | nbins;
+        memcpy(&payload[HIST_HEADER_WORDS], &hist->counts[first], nbins*4);
+        stream_send(stream, HIST_HEADER_WORDS + nbins);
+        hist->seq++;
+
+        if (stream->mode == STREAM_HIST_DELTA) {
+            memset(&hist->counts[first], 0, nbins*4);
+        }
+        if (packets == 0) {
+            break;
+        }
+    }
+    hist->snapshot++;
+
+}
+
+// 64 bit time in us since the stream started, must be called more often than every cycle counter wrap (20s)
+static uint64_t stream_us(peak_stream_t *stream){
+    uint32_t cycles = stream->cycles();
+    if (cycles < stream->cyc_last) {
+        stream->cyc_hi++;
+    }
+    stream->cyc_last = cycles;
+    return ((((uint64_t)stream->cyc_hi) << 32) | cycles) / PP_CLK_MHZ;
+}
+
+// Send the peaks collected in payload with the stream header so the host can account for lost packets
+static void SendPacket(peak_stream_t *stream){
+    stream->payload[0] = stream->seqNum;
+    stream->payload[1] = stream->peakNum;
+    stream->payload[2] = stream->totpeakNum;
+    stream->payload[3] = STREAM_PEAKS;
+    stream_send(stream, HEADER_WORDS + stream->peakNum*2);
+    stream->seqNum++;
+    stream->totpeakNum = stream->totpeakNum + stream->peakNum;
+    stream->peakNum = 0;
+}
+
+// Send the compact payload, header word 1 counts peaks not words so loss accounting matches STREAM_PEAKS
+static void SendCompactPacket(peak_stream_t *stream){
+    stream->payload[0] = stream->seqNum;
+    stream->payload[1] = stream->peakNum;
+    stream->payload[2] = stream->totpeakNum;
+    stream->payload[3] = STREAM_COMPACT;
+    stream_send(stream, COMPACT_HEADER_WORDS + stream->compactWords);
+    stream->seqNum++;
+    stream->totpeakNum = stream->totpeakNum + stream->peakNum;
+    stream->peakNum = 0;
+    stream->compactWords = 0;
+}
+
+static void AddCompactPeak(peak_stream_t *stream, uint64_t peak_us, uint32_t adc){
+    uint32_t *payload = stream->payload;
+    uint64_t delta = peak_us - stream->last_us;
+    uint64_t high = 0;
+
+    if (stream->compactWords == 0) {
+        // time reference of the packet, so each packet decodes on its own even if others are lost
+        payload[HEADER_WORDS] = (uint32_t)stream->last_us;
+        payload[HEADER_WORDS + 1] = (uint32_t)(stream->last_us >> 32);
+    }
+    while (delta > DELTA_MAX) {
+        high = delta >> DELTA_BITS;
+        if (high > DELTA_MAX) {
+            high = DELTA_MAX;
+        }
+        payload[COMPACT_HEADER_WORDS + stream->compactWords++] = (uint32_t)(high << 12);
+        delta -= high << DELTA_BITS;
+    }
+    payload[COMPACT_HEADER_WORDS + stream->compactWords++] = ((uint32_t)delta << 12) | adc;
+    stream->last_us = peak_us;
+    stream->peakNum++;
+
+    // leave room for a peak with an escape word
+    if (stream->compactWords >= COMPACT_WORDS - 3) {
+        SendCompactPacket(stream);
+    }
+}
+
+static void SendDataPeak(peak_stream_t *stream, const volatile uint32_t *samples, uint32_t n){
+    uint32_t time_us = 0;
+    uint16_t max_adc = 0;
+
+    if (stream->mode == STREAM_COMPACT) {
+        stream_us(stream);              // keep track of cycle counter wraps even without peaks
+    }
+
+    for (uint32_t i = 0; i < n; i++) {
+      switch (peak_sample(&stream->finder, 0xFFFF & samples[i], &max_adc)) {
+        case PEAK_START:
+          stream->time_s = stream->seconds;
+          stream->cycl = stream->cycles();
+          if (stream->mode == STREAM_COMPACT) {
+            stream->peak_us = stream_us(stream);
+          }
+          break;
+        case PEAK_REJECT:
+          break;                        // counted by the finder
+        case PEAK_END:
+          //found peak
+          if (stream->mode == STREAM_COMPACT) {
+            AddCompactPeak(stream, stream->peak_us, max_adc);
+            break;
+          }
+          // time_s stays 0 and only the low 20 bits of time_us fit in the record, so the time wraps every 2^20 us
+          // and early at each cycle counter wrap, the host unwraps both (BoardClock in MAPIC_runfile.py)
+          if ((stream->cycl - stream->last_cycles) > 0) {
+            time_us = (stream->cycl - stream->last_cycles) / PP_CLK_MHZ;
+          } else {
+            time_us = (4294967296 + stream->cycl - stream->last_cycles) / PP_CLK_MHZ;
+          }
+          stream->payload[HEADER_WORDS + stream->peakNum * 2] = stream->time_s;
+          stream->payload[HEADER_WORDS + stream->peakNum * 2 + 1] = (time_us << 12) | (max_adc);
+          stream->peakNum++;
+          // send as soon as the packet is full so payload can never overflow
+          if (stream->peakNum >= PACKET_PEAKS) {
+              SendPacket(stream);
+          }
+          break;
+      }
+    }
+}
+
+// Reset the stream for a new read_dma run, the peak finder settings, buffer and functions are kept
+void stream_start(peak_stream_t *stream, uint32_t mode, uint32_t tot_samples, uint32_t interval){
+
+    stream->mode = mode;
+    stream->tot_samples = tot_samples;
+    stream->interval = interval;
+    stream->stop = 0;
+    stream->seqNum = 0;
+    stream->peakNum = 0;
+    stream->totpeakNum = 0;
+    stream->compactWords = 0;
+    stream->cyc_hi = 0;
+    stream->cyc_last = 0;
+    stream->last_us = 0;
+    stream->overruns = 0;
+    peak_finder_reset(&stream->finder);
+    hist_reset(&stream->hist);
+    stream->hist_ms = stream->ticks_ms();
+    memset((uint32_t *)stream->buffer, 0, stream->size*4);
+    memset(stream->payloads, 0, sizeof(stream->payloads));
+    stream->payload = stream->payloads[0];
+    stream->running = 1;
+
+}
+
+// The stream ends once more than tot_samples peaks have been found, or when stopped if tot_samples is 0
+static int stream_done(peak_stream_t *stream){
+    return (stream->tot_samples != 0 && stream->totpeakNum > stream->tot_samples) || stream->stop;
+}
+
+// Process half 0 or 1 of the DMA buffer, called from the half and full transfer callbacks. Returns 1 once the
+// stream has ended and the DMA should be stopped, the last histogram snapshot has been sent by then.
+int stream_dma_half(peak_stream_t *stream, int half){
+
+    const volatile uint32_t *samples = stream->buffer + half*(stream->size/2);
+    int done = 0;
+
+    if (!stream->running) {
+        return 0;                       // a callback still pending after the stream ended
+    }
+    if (stream->mode == STREAM_HIST || stream->mode == STREAM_HIST_DELTA) {
+        stream->totpeakNum += hist_fill(&stream->finder, &stream->hist, samples, stream->size/2);
+        done = stream_done(stream);
+        if (done || stream->ticks_ms() - stream->hist_ms >= stream->interval) {
+            hist_snapshot(stream, done);
+            stream->hist_ms = stream->ticks_ms();
+        }
+    } else {
+        SendDataPeak(stream, samples, stream->size/2);
+        done = stream_done(stream);
+        // packets are only sent full, send the peaks of the last one before the stream ends so none are lost
+        if (done && stream->peakNum > 0) {
+            if (stream->mode == STREAM_COMPACT) {
+                SendCompactPacket(stream);
+            } else {
+                SendPacket(stream);
+            }
+        }
+    }
+    if (done) {
+        stream->running = 0;
+    }
+    return done;
+
+}
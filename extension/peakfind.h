@@ -0,0 +1,208 @@
+#include <stdint.h>
+#include <string.h>
+
+/************************************************************
+ * PEAK FINDING AND THE DMA PEAK STREAM
+ * No HAL or lwIP calls, the cycle counter, millisecond tick
+ * and datagram send are passed in as functions, so this
+ * builds and runs on the host as well, see peakfind_host.c.
+************************************************************/
+
+#define PP_THR 500
+#define PP_CLK_MHZ 216
+#define MAX_PAYLOAD_SIZE 1472
+#define NUMBER_PEAKS MAX_PAYLOAD_SIZE/8
+#define NUMBER_WORDS MAX_PAYLOAD_SIZE/4
+// Circular DMA buffer, each half is processed while the DMA fills the other one
+#define DMA_BUFFER_SIZE 40
+#define DMA_BUFFER_MAX 4096
+// Stream packet header: sequence number, peaks in packet, peaks sent before this packet, stream format
+#define HEADER_WORDS 4
+#define PACKET_PEAKS ((NUMBER_WORDS - HEADER_WORDS)/2)
+#define STREAM_PEAKS 0
+// Compact stream: header + 64 bit time in us of the peak before the packet, then one word per peak of
+// (delta_us << 12) | max_adc. Gaps longer than DELTA_MAX us are sent first as escape words with adc 0
+// holding (delta >> DELTA_BITS) << 12.
+#define STREAM_COMPACT 1
+#define COMPACT_HEADER_WORDS (HEADER_WORDS + 2)
+#define COMPACT_WORDS (NUMBER_WORDS - COMPACT_HEADER_WORDS)
+#define DELTA_BITS 20
+#define DELTA_MAX ((1 << DELTA_BITS) - 1)
+// Histogram stream: snapshots of the peak height histogram every interval ms
+#define HIST_INTERVAL 100
+#define HIST_BINS 4096
+#define HIST_CHUNK 256
+// Histogram stream packet: seq, snapshot number (| HIST_FINAL on the last one), peaks counted when the snapshot
+// was taken, stream format, first bin, (packets in the snapshot << 16) | bins in the packet, then one uint32
+// count per bin. Chunks of HIST_CHUNK bins with no counts are not sent.
+#define HIST_HEADER_WORDS 6
+#define HIST_FINAL 0x80000000
+#define STREAM_HIST 2
+#define STREAM_HIST_DELTA 3
+
+enum { PEAK_NONE, PEAK_START, PEAK_END, PEAK_REJECT };
+
+// STRUCT FOR THE SETTINGS AND STATE OF THE PEAK FINDER BETWEEN DMA BUFFERS
+typedef struct _peak_finder_t {
+
+    uint32_t threshold;         // a peak starts above and ends below threshold ADC counts
+
+    uint32_t min_width;         // fewest samples above threshold of a peak, shorter blips are noise
+
+    uint32_t max_width;         // most samples above threshold of a peak, 0 for no limit
+
+    uint32_t pileup;            // a fall and then a rise of more than pileup ADC counts within a peak vetoes it
+                                // as two piled up pulses, 0 for no veto
+    uint8_t in_peak;
+
+    uint8_t piled;
+
+    uint16_t max_adc;
+
+    uint16_t valley;            // lowest sample since max_adc
+
+    uint32_t width;
+
+    uint32_t narrow;            // peaks rejected since peak_finder_reset, below min_width
+
+    uint32_t wide;              // above max_width
+
+    uint32_t piledup;           // vetoed as pile-up
+
+} peak_finder_t;
+
+// STRUCT FOR THE ON-BOARD HISTOGRAM
+typedef struct _peak_hist_t {
+
+    uint32_t counts[HIST_BINS];
+
+    uint32_t peaks;
+
+    uint32_t seq;
+
+    uint32_t snapshot;
+
+} peak_hist_t;
+
+typedef void (*stream_send_t)(const uint32_t *words, uint32_t nwords);
+
+typedef uint32_t (*stream_clock_t)(void);
+
+// STRUCT FOR THE STATE OF A read_dma STREAM
+typedef struct _peak_stream_t {
+
+    volatile uint32_t *buffer;  // circular DMA buffer of size words
+
+    uint32_t size;
+
+    uint32_t mode;
+
+    uint32_t tot_samples;       // the stream ends once more peaks than this have been found, 0 for no limit
+
+    uint32_t interval;          // ms between histogram snapshots
+
+    volatile uint8_t stop;      // set to end the stream at the next half buffer
+
+    uint8_t running;
+
+    uint32_t seqNum;
+
+    uint32_t peakNum;
+
+    uint32_t totpeakNum;
+
+    uint32_t compactWords;      // peak and escape words in the compact payload
+
+    uint32_t cycl;
+
+    uint32_t seconds;
+
+    uint32_t last_cycles;
+
+    uint32_t time_s;
+
+    uint32_t cyc_hi;            // the cycle counter wraps every 20s at 216MHz, count the wraps
+
+    uint32_t cyc_last;
+
+    uint64_t peak_us;           // start time of the current peak in us
+
+    uint64_t last_us;           // time of the previous compact peak
+
+    uint32_t hist_ms;           // tick of the last histogram snapshot
+
+    uint32_t overruns;          // halves the DMA wrote again before they were processed, counted by the caller
+
+    peak_finder_t finder;
+
+    peak_hist_t hist;
+
+    uint32_t payloads[2][NUMBER_WORDS]; // sent by reference, one is filled while the other may still be in flight
+
+    uint32_t *payload;          // the one being filled
+
+    stream_clock_t cycles;      // 32 bit cycle counter at PP_CLK_MHZ, DWT->CYCCNT on the board
+
+    stream_clock_t ticks_ms;    // millisecond tick, HAL_GetTick on the board
+
+    stream_send_t send;         // send one datagram, words must stay untouched until the next send returns
+
+} peak_stream_t;
+
+void peak_finder_init(peak_finder_t *finder, uint32_t threshold, uint32_t min_width, uint32_t max_width, uint32_t pileup);
+
+void peak_finder_reset(peak_finder_t *finder);
+
+// Feed one sample, returns PEAK_START when a peak starts and PEAK_END (with the peak height in *adc) when it
+// ends, or PEAK_REJECT if it ends outside the width window or piled up
+static inline int peak_sample(peak_finder_t *finder, uint32_t val, uint16_t *adc){
+    if (finder->in_peak == 0) {
+        if (val > finder->threshold) {
+            finder->in_peak = 1;
+            finder->piled = 0;
+            finder->width = 1;
+            finder->valley = 0;
+            return PEAK_START;
+        }
+        return PEAK_NONE;
+    }
+    if (finder->pileup != 0 && finder->max_adc > finder->valley + finder->pileup && val > finder->valley + finder->pileup) {
+        finder->piled = 1;
+    }
+    if (val > finder->max_adc) {
+        finder->max_adc = val;
+        finder->valley = val;
+    } else if (val < finder->valley) {
+        finder->valley = val;
+    }
+    if (val < finder->threshold) {
+        finder->in_peak = 0;
+        *adc = finder->max_adc;
+        finder->max_adc = 0;
+        if (finder->width < finder->min_width) {
+            finder->narrow++;
+            return PEAK_REJECT;
+        }
+        if (finder->max_width != 0 && finder->width > finder->max_width) {
+            finder->wide++;
+            return PEAK_REJECT;
+        }
+        if (finder->piled) {
+            finder->piledup++;
+            return PEAK_REJECT;
+        }
+        return PEAK_END;
+    }
+    finder->width++;
+    return PEAK_NONE;
+}
+
+void hist_reset(peak_hist_t *hist);
+
+uint32_t hist_fill(peak_finder_t *finder, peak_hist_t *hist, const volatile uint32_t *samples, uint32_t n);
+
+void hist_snapshot(peak_stream_t *stream, int final);
+
+void stream_start(peak_stream_t *stream, uint32_t mode, uint32_t tot_samples, uint32_t interval);
+
+int stream_dma_half(peak_stream_t *stream, int half);
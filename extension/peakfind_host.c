@@ -0,0 +1,205 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "peakfind.h"
+/************************************************************
+ * HOST HARNESS FOR THE DMA PEAK STREAM
+ * Feeds a synthetic waveform through the circular DMA buffer
+ * and the half and full transfer callbacks exactly as the
+ * ADC DMA does, decodes the datagrams the stream sends and
+ * checks the peaks against one pass of the peak finder over
+ * the whole waveform. Build and run on the host with
+ *
+ *   cc -std=c99 -O2 -o peakfind_host peakfind_host.c peakfind.c
+ *   ./peakfind_host [size] [mode] [peaks] [latency] [seed]
+ *
+ * size: DMA buffer words, mode: read_dma mode 0-3, peaks:
+ * peaks the stream sends, latency: samples the DMA writes
+ * between the end of a half and its callback. Exits with 1
+ * if the stream lost or changed any peak, or wrote into a
+ * datagram before the next one was sent.
+************************************************************/
+
+#define CYCLES_PER_SAMPLE 120           // 1.8MS/s at PP_CLK_MHZ
+#define BASELINE 100
+#define MAX_PENDING 8
+
+peak_stream_t stream;
+volatile uint32_t buffer[DMA_BUFFER_MAX];
+uint64_t written = 0;                   // samples written by the DMA so far
+
+uint16_t *sent;                         // peak heights decoded from the datagrams
+uint32_t nsent = 0;
+uint32_t maxsent = 0;
+uint64_t counts[HIST_BINS];             // histogram decoded from the datagrams
+uint32_t packets = 0;
+const uint32_t *inflight = NULL;        // datagram sent last, the stream must not write it before the next send
+uint32_t inflight_copy[NUMBER_WORDS];
+uint32_t inflight_words = 0;
+uint32_t overwritten = 0;               // sent datagrams changed before the next send
+
+static uint32_t host_cycles(void){
+    return (uint32_t)(written*CYCLES_PER_SAMPLE);
+}
+
+static uint32_t host_ticks_ms(void){
+    return (uint32_t)(written*CYCLES_PER_SAMPLE/(PP_CLK_MHZ*1000));
+}
+
+// Decode each datagram as the host receivers do, and check the one before was left alone while it was in flight
+static void host_send(const uint32_t *words, uint32_t nwords){
+    packets++;
+    if (inflight != NULL && memcmp(inflight, inflight_copy, inflight_words*4) != 0) {
+        overwritten++;
+    }
+    inflight = words;
+    inflight_words = nwords;
+    memcpy(inflight_copy, words, nwords*4);
+    if (words[3] == STREAM_PEAKS) {
+        for (uint32_t i = HEADER_WORDS + 1; i < nwords; i += 2) {
+            sent[nsent++] = words[i] & 4095;
+        }
+    } else if (words[3] == STREAM_COMPACT) {
+        for (uint32_t i = COMPACT_HEADER_WORDS; i < nwords; i++) {
+            if ((words[i] & 4095) != 0) {
+                sent[nsent++] = words[i] & 4095;        // escape words have adc 0
+            }
+        }
+    } else {
+        for (uint32_t i = 0; i < (words[5] & 0xFFFF); i++) {
+            if (words[3] == STREAM_HIST_DELTA) {
+                counts[words[4] + i] += words[HIST_HEADER_WORDS + i];
+            } else {
+                counts[words[4] + i] = words[HIST_HEADER_WORDS + i];
+            }
+        }
+    }
+}
+
+// Stand-ins for HAL_ADC_ConvHalfCpltCallback and HAL_ADC_ConvCpltCallback, as DMA_Half in adc.c
+static int dma_half(int half){
+    uint32_t pos = 0;
+
+    if (stream_dma_half(&stream, half)) {
+        return 1;
+    }
+    pos = written % stream.size;
+    if ((pos < stream.size/2) == (half == 0)) {
+        stream.overruns++;
+    }
+    return 0;
+}
+
+// Synthetic ADC samples: flat topped stretcher pulses from two lines and a flat background on a noisy
+// baseline, with some short noise blips and piled up pulses for the peak finder to reject
+static uint32_t waveform(void){
+    static uint32_t left = 0;           // samples left of the current pulse or gap
+    static uint32_t height = 0;
+    static uint32_t second = 0;         // height of a piled up pulse after a dip, 0 for none
+    static int in_pulse = 0;
+    uint32_t noise = rand() % 9;
+
+    if (left == 0) {
+        in_pulse = !in_pulse;
+        if (in_pulse) {
+            left = 6 + rand() % 4;
+            if (rand() % 50 == 0) {
+                left = 1 + rand() % 2;  // noise blip
+            }
+            height = (rand() % 10 == 0) ? 600 + rand() % 3400 : ((rand() % 3 == 0) ? 1800 : 2480) + rand() % 41 - 20;
+            second = (rand() % 40 == 0) ? 1000 + rand() % 2000 : 0;
+        } else {
+            left = 1 + rand() % 60;
+        }
+    }
+    left--;
+    if (!in_pulse) {
+        return BASELINE + noise;
+    }
+    if (second != 0 && left < 3) {
+        return (left == 2) ? height/2 : second + noise;
+    }
+    return height + noise;
+}
+
+int main(int argc, char **argv){
+    uint32_t size = (argc > 1) ? atoi(argv[1]) : DMA_BUFFER_SIZE;
+    uint32_t mode = (argc > 2) ? atoi(argv[2]) : STREAM_PEAKS;
+    uint32_t npeaks = (argc > 3) ? atoi(argv[3]) : 100000;
+    uint32_t latency = (argc > 4) ? atoi(argv[4]) : 0;
+    uint64_t pending[MAX_PENDING];      // sample count at which each queued callback runs
+    uint32_t npending = 0;
+    uint32_t nref = 0;
+    uint32_t mismatch = 0;
+    uint16_t adc = 0;
+    uint16_t *ref;
+    uint64_t *refcounts;
+    peak_finder_t finder;
+    clock_t start;
+    double seconds;
+    int done = 0;
+
+    srand((argc > 5) ? atoi(argv[5]) : 1);
+    if (size < 2 || size > DMA_BUFFER_MAX || size % 2 != 0 || latency/(size/2) >= MAX_PENDING) {
+        fprintf(stderr, "size must be even and at most %d, latency under %d half buffers\n", DMA_BUFFER_MAX, MAX_PENDING);
+        return 2;
+    }
+    maxsent = npeaks + 2*PACKET_PEAKS;
+    sent = malloc(maxsent*sizeof(uint16_t));
+    ref = malloc(maxsent*sizeof(uint16_t));
+    refcounts = calloc(HIST_BINS, sizeof(uint64_t));
+
+    stream.buffer = buffer;
+    stream.size = size;
+    stream.cycles = host_cycles;
+    stream.ticks_ms = host_ticks_ms;
+    stream.send = host_send;
+    peak_finder_init(&stream.finder, PP_THR, 3, 12, 200);
+    peak_finder_init(&finder, PP_THR, 3, 12, 200);
+    stream_start(&stream, mode, npeaks, HIST_INTERVAL);
+
+    // the DMA writes one sample at a time, each half's callback runs latency samples after the half is full
+    start = clock();
+    while (!done) {
+        uint32_t sample = waveform();
+        buffer[written % size] = sample;
+        written++;
+        if (peak_sample(&finder, sample, &adc) == PEAK_END && nref < maxsent) {
+            ref[nref++] = adc;
+        }
+        if (written % (size/2) == 0) {
+            pending[npending++] = written + latency;
+        }
+        while (npending > 0 && written >= pending[0]) {
+            done = dma_half(((pending[0] - latency)/(size/2) + 1) % 2);
+            npending--;
+            for (uint32_t i = 0; i < npending; i++) {
+                pending[i] = pending[i + 1];
+            }
+            if (done) {
+                break;
+            }
+        }
+    }
+    seconds = (double)(clock() - start)/CLOCKS_PER_SEC;
+
+    // peaks the stream counted must be the first peaks of the single pass, in order
+    if (mode == STREAM_HIST || mode == STREAM_HIST_DELTA) {
+        for (uint32_t i = 0; i < stream.totpeakNum && i < nref; i++) {
+            refcounts[ref[i]]++;
+        }
+        for (uint32_t i = 0; i < HIST_BINS; i++) {
+            mismatch += counts[i] != refcounts[i];
+            nsent += counts[i];
+        }
+    } else {
+        for (uint32_t i = 0; i < nsent; i++) {
+            mismatch += i >= nref || sent[i] != ref[i];
+        }
+    }
+    printf("size %u mode %u latency %u: %llu samples, %u packets, %u peaks sent, %u counted, "
+        "%u narrow %u wide %u piled up rejected, %u overruns, %u mismatches, %u overwritten, %.1f Msamples/s\n",
+        size, mode, latency, (unsigned long long)written, packets, nsent, stream.totpeakNum, stream.finder.narrow,
+        stream.finder.wide, stream.finder.piledup, stream.overruns, mismatch, overwritten, written/seconds/1e6);
+    return mismatch != 0 || overwritten != 0 || nsent == 0;
+}
@@ -1,7 +1,10 @@
 #include "udpsend.h"
 /************************************************************
  * UDP SEND PAYLOAD
- * Send a payload to port 9000 through UDP
+ * Send a payload to port 9000 through UDP, or the destination
+ * set with mp_set_udp_dest. mp_send_udp copies the payload,
+ * mp_send_udp_ref sends it by reference from a preallocated
+ * pbuf and counts the datagrams that could not be sent.
 ************************************************************/
 
 void mp_init_udp(udp_send_obj_t *UDP){
@@ -12,6 +15,38 @@ void mp_init_udp(udp_send_obj_t *UDP){
     
     IP4_ADDR(&UDP->destip,192,168,4,16);
 
+    for (int i = 0; i < UDP_TX_PBUFS; i++) {
+        UDP->tx[i] = pbuf_alloc(PBUF_RAW, 0, PBUF_REF);
+    }
+
+    UDP->next = 0;
+
+    mp_reset_udp_stats(UDP);
+
+}
+
+void mp_reset_udp_stats(udp_send_obj_t *UDP){
+
+    UDP->sent = 0;
+
+    UDP->errors = 0;
+
+    UDP->busy = 0;
+
+}
+
+// ip is a dotted quad string, returns 0 if it could not be parsed
+int mp_set_udp_dest(udp_send_obj_t *UDP, const char *ip, u16_t port){
+
+    ip_addr_t destip;
+
+    if (!ipaddr_aton(ip, &destip)) {
+        return 0;
+    }
+    UDP->destip = destip;
+    UDP->port = port;
+    return 1;
+
 }
 
 
@@ -27,4 +62,36 @@ void mp_send_udp(struct udp_pcb *udppcb ,const u8_t *payload, ip_addr_t *dest_ip
 
     pbuf_free(p);
 
-}
\ No newline at end of file
+}
+
+// Send payload without copying it, it must not change until the next call returns. udp_sendto chains the UDP
+// header in a pbuf of its own and lets go of the payload pbuf before returning, lwIP copies it if it has to
+// queue it for ARP, so the pbuf is free again for the next payload.
+err_t mp_send_udp_ref(udp_send_obj_t *UDP, const u8_t *payload, u16_t payloadsize){
+
+    struct pbuf *p = UDP->tx[UDP->next];
+    err_t err;
+
+    if (p == NULL) {
+        p = UDP->tx[UDP->next] = pbuf_alloc(PBUF_RAW, 0, PBUF_REF);    // the pool was empty at mp_init_udp
+    }
+    if (p == NULL || p->ref != 1) {
+        UDP->busy++;
+        return ERR_MEM;
+    }
+    UDP->next = (UDP->next + 1) % UDP_TX_PBUFS;
+
+    p->payload = (void*)payload;
+    p->len = payloadsize;
+    p->tot_len = payloadsize;
+
+    err = udp_sendto(UDP->pcb, p, &UDP->destip, UDP->port);
+    UDP->errorstate = err;
+    if (err == ERR_OK) {
+        UDP->sent++;
+    } else {
+        UDP->errors++;
+    }
+    return err;
+
+}
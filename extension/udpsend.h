@@ -4,6 +4,9 @@
 #include "lwip/init.h"
 #include "lwip/udp.h"
 
+// Preallocated pbufs mp_send_udp_ref takes in turn, one per payload buffer of the sender
+#define UDP_TX_PBUFS 2
+
 // STRUCT FOR STORING INFO
 typedef struct _udp_send_obj_t {
         
@@ -15,8 +18,24 @@ typedef struct _udp_send_obj_t {
     
     u16_t port;
 
+    struct pbuf *tx[UDP_TX_PBUFS];  // PBUF_REF pbufs pointed at each payload as it is sent
+
+    u8_t next;
+
+    u32_t sent;                     // datagrams sent since mp_reset_udp_stats
+
+    u32_t errors;                   // datagrams udp_sendto failed to send, ERR_MEM when the pbuf pool is empty
+
+    u32_t busy;                     // datagrams dropped as their pbuf was still held by the stack
+
 } udp_send_obj_t;
 
 void mp_init_udp(udp_send_obj_t *UDP);
 
-void mp_send_udp(struct udp_pcb *udppcb ,const u8_t *payload, ip_addr_t *dest_ip, u16_t port, const int payloadsize);
\ No newline at end of file
+int mp_set_udp_dest(udp_send_obj_t *UDP, const char *ip, u16_t port);
+
+void mp_send_udp(struct udp_pcb *udppcb ,const u8_t *payload, ip_addr_t *dest_ip, u16_t port, const int payloadsize);
+
+err_t mp_send_udp_ref(udp_send_obj_t *UDP, const u8_t *payload, u16_t payloadsize);
+
+void mp_reset_udp_stats(udp_send_obj_t *UDP);
\ No newline at end of file
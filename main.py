@@ -44,10 +44,12 @@ testpulsepin = Pin('X4',Pin.OUT)        # pin to enable internal test pulses on
 polarpin.value(0)                       # set to 1 for positive polarity
 
 # DATA STORAGE AND COUNTERS
-sendbuf = array('H',[720])              # 1440 byte buffer for calibration routine
+sendbuf = array('H',[0]*720)            # 1440 byte buffer for calibration routine, 90 pulses of 4 output + 4 input samples
 data = array('H',[0]*4)                 # buffer for writing adc interrupt data from adc.read_timed() in calibration() and ADC_IT_poll()
 calibdata = array('H',[0]*4)            # buffer to store ADC data from calibadc
 count=0                                 # counter for pulses read
+caldest = None                          # (ip, port) the calibration pulses are sent to
+caldeadline = 0                         # ticks_ms at which calibration stops
 peakcount = 0
 ratecounter = 0                         # counter for rate measurements
 STATE = "STARTUP"                       # state variable for applying startup settings etc. 
@@ -66,16 +68,24 @@ while wl_ap.status('stations')==[]:
 # SET UP THE NETWORK SOCKET FOR UDP
 s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 s.bind(('',8080))                           # network listens on port 8080, any IP
-destipv4 = ('192.168.4.16', 8080)           # destination for sending data
+destipv4 = ('192.168.4.16', 8080)           # destination for sending data, replaced by the sender of each command
 print("SOCKET BOUND")
 
+# ACKNOWLEDGED COMMANDS
+# Request datagram: 2 command bytes, 2 byte tag, arguments.
+# Reply datagram: 2 command bytes, 2 byte tag, status byte, reply data.
+ACK_OK = 0                              # command ran, reply data follows
+ACK_ERROR = 1                           # command raised an exception
+ACK_UNKNOWN = 2                         # no such command
+REPLY_CACHE = 8                         # replies kept to answer retries without running a command twice
+replies = []                            # (request header, sender, reply) of the last commands
+
 #==================================================================================#
 # BOARD STATE CHECKING
 #==================================================================================#
 
-def checkstate():
-    a = STATE.encode('utf-8')
-    s.sendto(a, destipv4)
+def checkstate(args):
+    return STATE.encode('utf-8')
 
 def adc_setstate(state):
     #assert(state == 'SingleDMA' or state == "TripleDMA" or state == "Single" or state =="NONE")
@@ -88,9 +98,14 @@ def adc_setstate(state):
     else:
         print("ADC STATE UNCHANGED")
 
-def setstate():
-    utime.sleep(0.1)
-    STATE = s.recv(32).decode('utf-8')
+def setstate(args):
+    global STATE
+    STATE = bytes(args).decode('utf-8')
+    return b''
+
+def setpin(pin, value):
+    pin.value(value)
+    return b''
 
 def drain_socket():
     s.settimeout(0)
@@ -109,27 +124,35 @@ def drain_socket():
 # If the I2C chips are not connected, an exception will be raised.
 #==================================================================================#
 
-def Ir():
+def Ir(args):
     if i2c.is_ready(0x2D) and i2c.is_ready(0x2C):
         gain = i2c.recv(1,addr=0x2D)
         threshold = i2c.recv(1,addr=0x2C)
-        s.sendto(gain,destipv4)
-        s.sendto(threshold,destipv4)
     else:
         raise Exception
-    return None
+    return bytes(gain) + bytes(threshold)
 
-def Iw(address):
+def Iw(address, args):
     if i2c.is_ready(address):
-        recvd = s.recv(1)
-        value = int.from_bytes(recvd,'little',False)
+        value = args[0]
         b = bytearray([0x00,value])
         i2c.send(b,addr=address)
     else:
         raise Exception
-    return None
+    return b''
 
-def Is():
+def apply_profile(args):
+    # check both pots first so a profile is applied completely or not at all
+    if i2c.is_ready(0x2D) and i2c.is_ready(0x2C):
+        i2c.send(bytearray([0x00,args[0]]),addr=0x2D)
+        i2c.send(bytearray([0x00,args[1]]),addr=0x2C)
+        polarpin.value(args[2])
+        testpulsepin.value(args[3])
+    else:
+        raise Exception
+    return Ir(args) + bytes([polarpin.value(), testpulsepin.value()])   # read back gain, threshold, polarity, test pulses
+
+def Is(args):
     scan = bytearray(2)
     i2clist = i2c.scan()
     if i2clist == []:
@@ -137,24 +160,39 @@ def Is():
     else:
         for idx,chip in enumerate(i2clist):
             scan[idx] = chip
-    s.sendto(scan, destipv4)
-    return None
+    return bytes(scan)
 
 #==================================================================================#
 # CALIBRATION CURVE CODE FIXME: Find a way to measure this properly
 #==================================================================================#
 
 
-def calibrate():
-    global calibint
+def calibrate(args):
+    # 16 bit port of the sending host the pulses go to and 16 bit most seconds, acknowledged once measuring
     global count
     global calibadc
+    global caldest
+    global caldeadline
     count = 0                               # reset counter
+    caldest = (destipv4[0], int.from_bytes(args[:2],'little'))
+    caldeadline = utime.ticks_add(utime.ticks_ms(), 1000*int.from_bytes(args[2:4],'little'))
     adc_setstate("Single")                  # set state of adc obj to mode Single
     calibadc = ADC(calibpin, "Single")      # init the second ADC in mode Single
     calibint.enable()
-    utime.sleep(10)                         # 10s of calibration
+    return b''
+
+def stop_calibration(args):
     calibint.disable()
+    sendcal()
+    return b''
+
+def sendcal():
+    # send the pulses measured since the last full datagram, then an empty datagram to end the stream
+    global count
+    if count > 0:
+        s.sendto(memoryview(sendbuf)[:8*count],caldest)
+    s.sendto(b'',caldest)
+    count = 0
 
 def cbcal(line):
     global count
@@ -162,21 +200,24 @@ def cbcal(line):
     adc.read_timed(data,ti)
     calibadc.read_timed(calibdata,ti)
     
-    # Add data to UDP packet buffer
-    sendbuf[4*count:4*count+4] = data
-    sendbuf[4*(count+1):4*(count+1)+4] = calibdata
+    # Add data to UDP packet buffer, output then input samples of each pulse
+    sendbuf[8*count:8*count+4] = data
+    sendbuf[8*count+4:8*count+8] = calibdata
     count += 1
 
     # send UDP buffer + reset counter
     if count == 90:
-        s.sendto(sendbuf,destipv4)
+        s.sendto(sendbuf,caldest)
         count = 0
+    if utime.ticks_diff(utime.ticks_ms(), caldeadline) >= 0:
+        calibint.disable()
+        sendcal()
 
 #==================================================================================#
 # RATE MEASUREMENT CODE
 #==================================================================================#
 
-def rateaq():
+def rateaq(args):
     print('COUNTING RATE')
     global ratecounter
     global rateint
@@ -189,8 +230,7 @@ def rateaq():
     
     b = utime.ticks_ms()-a
     finalrate = round((ratecounter/(b/1000)))
-    finalratebyte = finalrate.to_bytes(4,'little',False)
-    s.sendto(finalratebyte,destipv4)
+    return finalrate.to_bytes(4,'little',False)
 
 def ratecount(line):
     global ratecounter
@@ -269,50 +309,122 @@ pyb.enable_irq(irqstate)                        # re-enable interrupts
 # Uses a different ADC setup from python level ADC_IT_poll.
 #==================================================================================#
 
-def read_DMA():
-    msg = s.recv(4)
-    mnum = int.from_bytes(msg,'little')
-    mnum = mnum
+def setdest(args):
+    port = int.from_bytes(args,'little')
+    adc.stream_dest(destipv4[0],port)       # DMA stream to the host that sent the command
+    return b''
+
+def stop_DMA(args):
+    adc.stop_dma()
+    utime.sleep_ms(1)                       # let the next DMA callback stop the stream before acknowledging
+    return b''
+
+def peak_config(args):
+    # 16 bit threshold, min width, max width and pile-up veto, see adc.peak_config
+    settings = [int.from_bytes(args[i:i+2],'little') for i in range(0,8,2)]
+    adc.peak_config(*settings)
+    return b''
+
+def peak_rejected(args):
+    # peaks rejected by the last DMA stream as 32 bit narrow, wide and pile-up counts
+    return b''.join(count.to_bytes(4,'little') for count in adc.peak_rejected())
+
+def dma_buffer(args):
+    # optional 16 bit DMA buffer size, replies with the 16 bit size and 32 bit overruns of the last stream
+    if len(args) >= 2:
+        size, overruns = adc.dma_buffer(int.from_bytes(args[:2],'little'))
+    else:
+        size, overruns = adc.dma_buffer()
+    return size.to_bytes(2,'little') + overruns.to_bytes(4,'little')
+
+def udp_stats(args):
+    # stream datagrams since the last read_dma as 32 bit sent, failed and busy (pbuf still held) counts
+    return b''.join(count.to_bytes(4,'little') for count in adc.udp_stats())
+
+def read_DMA(args, mode=0):
+    mnum = int.from_bytes(args[:4],'little')
     print(mnum)
     adc_setstate("SingleDMA")
-    adc.read_dma(mnum)
+    if len(args) > 4:
+        interval = int.from_bytes(args[4:6],'little')   # ms between histogram snapshots
+        adc.read_dma(mnum,mode,interval)    # mode 2: full histogram snapshots, 3: counts since the last snapshot
+    else:
+        adc.read_dma(mnum,mode)             # mode 0: 8 byte peak records, 1: compact 4 byte delta records
+    return b''                              # acknowledged once the stream has started
 
 #==================================================================================#
 # COMMAND CODES:
-# Bytearrays used by main loop to execute functions
-# expect a 2-byte command.
+# Bytearrays used by main loop to execute functions.
+# commands take the argument bytes of the request and return the reply bytes,
+# legacy commands are 2 byte datagrams for routines that talk to the host themselves.
 #==================================================================================#
 
 commands = {
     # bytes(bytearray([a,b])) : command function,
     bytes(bytearray([0,0])) : Ir,                               # read first gain potentiometer, then threshold
     bytes(bytearray([0,2])) : Is,                               # scan I2C addresses
-    bytes(bytearray([1,0])) : lambda : Iw(0x2D),                # write gain pot
-    bytes(bytearray([1,1])) : lambda : Iw(0x2C),                # write threshold pot
+    bytes(bytearray([1,0])) : lambda args : Iw(0x2D, args),     # write gain pot
+    bytes(bytearray([1,1])) : lambda args : Iw(0x2C, args),     # write threshold pot
+    bytes(bytearray([1,2])) : apply_profile,                    # write both pots, polarity and test pulses, read back
     
     bytes(bytearray([2,0])) : read_DMA,                         # testing DMA interrupts measurements,
-    bytes(bytearray([2,1])) : ADC_IT_poll,                      # legacy python ADC interrupts method
-    
-    bytes(bytearray([2,2])) : adc.read_interleaved,             # TODO: Implement this feature properly - requires deinit adc ability??
+    bytes(bytearray([2,3])) : lambda args : read_DMA(args, 1),  # DMA peak stream with compact delta encoded records
+    bytes(bytearray([2,4])) : stop_DMA,                         # end a DMA peak stream early
+    bytes(bytearray([2,5])) : lambda args : read_DMA(args, 2),  # on-board histogram, full snapshots
+    bytes(bytearray([2,6])) : lambda args : read_DMA(args, 3),  # on-board histogram, delta snapshots
     
-    bytes(bytearray([4,0])) : lambda : polarpin.value(0),       # Negative polarity
-    bytes(bytearray([4,1])) : lambda : polarpin.value(1),       # Positive polarity
+    bytes(bytearray([4,0])) : lambda args : setpin(polarpin, 0),        # Negative polarity
+    bytes(bytearray([4,1])) : lambda args : setpin(polarpin, 1),        # Positive polarity
 
-    #bytes(bytearray([5,0])) : calibrate,                       # FIXME: measure detector/apic gain profile 
+    bytes(bytearray([5,0])) : calibrate,                        # stream input/output pulse pairs of the shaper
     bytes(bytearray([5,1])) : rateaq,                           # measure sample rate
+    bytes(bytearray([5,2])) : stop_calibration,                 # end the calibration stream
 
-    bytes(bytearray([6,0])) : lambda: testpulsepin.value(0),    # disable test pulses
-    bytes(bytearray([6,1])) : lambda: testpulsepin.value(1),     # enable test pulses
+    bytes(bytearray([6,0])) : lambda args : setpin(testpulsepin, 0),    # disable test pulses
+    bytes(bytearray([6,1])) : lambda args : setpin(testpulsepin, 1),    # enable test pulses
 
     bytes(bytearray([7,1])) : checkstate,                       # check the state of the pybaord
     bytes(bytearray([7,0])) : setstate,                         # set the current state of the board
+
+    bytes(bytearray([8,0])) : setdest,                          # set the port of the DMA stream on this host
+
+    bytes(bytearray([9,0])) : peak_config,                      # set the DMA peak finder threshold, width window and pile-up veto
+    bytes(bytearray([9,1])) : peak_rejected,                    # read the peaks rejected by the peak finder
+    bytes(bytearray([9,2])) : dma_buffer,                       # set/read the DMA buffer size and overruns
+    bytes(bytearray([9,3])) : udp_stats,                        # read the stream datagrams sent and failed
+}
+
+legacy = {
+    bytes(bytearray([2,1])) : ADC_IT_poll,                      # legacy python ADC interrupts method
+    bytes(bytearray([2,2])) : adc.read_interleaved,             # TODO: Implement this feature properly - requires deinit adc ability??
 }
 
+def acknowledge(msg, sender):
+    header = bytes(msg[:4])
+    for last in replies:
+        if last[0] == header and last[1] == sender:
+            return last[2]                  # retry of a command that already ran
+    command = header[:2]
+    if command in commands:
+        try:
+            reply = header + bytes([ACK_OK]) + commands[command](msg[4:])
+        except Exception:
+            reply = header + bytes([ACK_ERROR])
+    else:
+        reply = header + bytes([ACK_UNKNOWN])
+    replies.append((header, sender, reply))
+    if len(replies) > REPLY_CACHE:
+        replies.pop(0)
+    return reply
+
 #==================================================================================#
 # MAIN LOOP
 #==================================================================================#
 
 while True:
-    mode = s.recv(2)            # wait until the board receives the 2 byte command code, no timeout
+    msg, destipv4 = s.recvfrom(64)  # wait until the board receives a command, no timeout, reply to the sender
     print("MODE RECEIVED")
-    commands[mode]()            # reference commands dictionary and run the corresponding function
\ No newline at end of file
+    if len(msg) == 2:
+        legacy[msg]()               # reference legacy dictionary and run the corresponding function
+    else:
+        s.sendto(acknowledge(msg, destipv4), destipv4)
@@ -0,0 +1,81 @@
+'''Fixtures shared by the tests: a simulated board on loopback, and an APIC connected to it that runs in a temporary
+folder, so its run files and catalog go to a fresh histdata.'''
+
+import os
+import socket
+import sys
+import threading
+
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MAPIC_functions as MAPIC
+import MAPIC_runfile
+import MAPIC_sim
+
+def free_port():
+    '''Return a UDP port on loopback that nothing is bound to.'''
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def board_words(time_us, adc=1000):
+    '''Return the records SendDataPeak sends for peaks at time_us: time_s 0 and the 32 bit cycle counter in us, cut
+    to 20 bits by the shift into the packed word.'''
+    cycles = (numpy.asarray(time_us, dtype='int64')*MAPIC_runfile.CLOCK_MHZ) & 0xFFFFFFFF
+    words = numpy.zeros(2*len(cycles), dtype='uint32')
+    words[1::2] = (((cycles//MAPIC_runfile.CLOCK_MHZ) << 12) & 0xFFFFFFFF) | adc
+    return words
+
+def exported(apic, runno):
+    '''Return the ADC values and times in us of the text export of run runno.'''
+    name = apic.createfileno(runno) + '.txt'
+    seconds = numpy.loadtxt('histdata/data_time' + name, dtype=str, ndmin=1)
+    time_us = numpy.array([int(s.replace('.', '')) for s in seconds], dtype='int64')
+    return numpy.loadtxt('histdata/ADC_count' + name, ndmin=1), time_us
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''Run the test in an empty folder with a histdata folder in it.'''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'histdata').mkdir()
+    return tmp_path
+
+@pytest.fixture
+def board():
+    '''Return a function starting a PyboardSim on a free port with the given arguments, closed after the test.'''
+    sims = []
+
+    def start(rate=100000, seed=1, **kwargs):
+        sim = MAPIC_sim.PyboardSim(('127.0.0.1', free_port()), rate=rate, seed=seed, **kwargs)
+        thread = threading.Thread(target=sim.serve, daemon=True)
+        thread.start()
+        sims.append((sim, thread))
+        return sim
+
+    yield start
+    for sim, thread in sims:
+        sim.stop()
+        thread.join()                           # serve must leave recvfrom before its socket is closed
+        sim.close()
+
+@pytest.fixture
+def connect(workdir, board):
+    '''Return a function starting a PyboardSim with the given arguments and returning (apic, sim), the APIC
+    streaming from it on its own ports.'''
+    apics = []
+
+    def start(tout=2, **kwargs):
+        sim = board(**kwargs)
+        apic = MAPIC.APIC(tout, sim.sock.getsockname(), port=free_port(), dmaport=free_port())
+        apic.setdest()
+        apics.append(apic)
+        return apic, sim
+
+    yield start
+    for apic in apics:
+        apic.sock.close()
+        apic.sockdma.close()
+        apic.catalog.close()
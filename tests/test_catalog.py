@@ -0,0 +1,73 @@
+import os
+
+import numpy
+
+import MAPIC_catalog
+import MAPIC_runfile
+
+def write_run(path, header, words, dtype='uint32'):
+    writer = MAPIC_runfile.RunWriter(str(path), header, dtype)
+    writer.write(numpy.asarray(words, dtype=dtype))
+    writer.close()
+
+def test_next_run_never_reuses_numbers(tmp_path):
+    catalog = MAPIC_catalog.RunCatalog(str(tmp_path / MAPIC_catalog.CATALOG_NAME))
+    assert catalog.next_run('run') == 0
+    catalog.start('run', 0, {'format': 'peak', 'start': 1.0}, ['histdata/run0000.mapic'])
+    catalog.start('run', 1, {'format': 'peak', 'start': 2.0}, ['histdata/run0001.mapic'])
+    catalog.start('board1_run', 0, {'format': 'peak', 'start': 3.0}, [])
+    assert catalog.next_run('run') == 2 and catalog.next_run('board1_run') == 1
+    catalog.db.execute('DELETE FROM runs WHERE run = 0')     # a deleted run does not free its number
+    assert catalog.next_run('run') == 2
+
+def test_start_finish_and_query(tmp_path):
+    catalog = MAPIC_catalog.RunCatalog(str(tmp_path / MAPIC_catalog.CATALOG_NAME))
+    for run, gainpos in enumerate([100, 134, 134]):
+        catalog.start('run', run, {'format': 'peak', 'start': 1000.0 + run, 'gainpos': gainpos, 'threshpos': 128,
+            'polarity': 1}, ['run%04i.mapic' % run])
+    catalog.start('run', 1, {'format': 'peak', 'start': 5000.0}, [])      # a resumed run keeps its record
+    catalog.finish('run', 1, 500, {'centroid': 2480.5}, end=2000.0)
+    catalog.add_paths('run', 1, ['ADC_count0001.txt', 'run0001.mapic'])
+
+    record = catalog.get('run', 1)
+    assert record['start'] == 1001.0 and record['end'] == 2000.0 and record['events'] == 500
+    assert record['stats'] == {'centroid': 2480.5}
+    assert record['paths'] == ['run0001.mapic', 'ADC_count0001.txt']
+    assert [r['run'] for r in catalog.query(gainpos=134)] == [1, 2]
+    assert [r['run'] for r in catalog.query(since=1001.5)] == [2]
+    assert catalog.get('run', 7) is None
+
+def test_rebuild_records_the_files_in_the_folder(tmp_path):
+    write_run(tmp_path / 'run0000.mapic', {'format': 'peak', 'start': 10.0, 'gainpos': 134}, numpy.zeros(200))
+    write_run(tmp_path / 'run0001.mapic', {'format': 'histogram', 'start': 20.0}, numpy.full(4096, 2), 'int64')
+    write_run(tmp_path / 'run0002.mapic', {'format': 'itpoll', 'start': 30.0}, numpy.zeros(300), 'uint16')
+    os.mkdir(tmp_path / 'run0003')
+    for part in range(2):
+        write_run(tmp_path / 'run0003' / ('part%04i.mapic' % part), {'format': 'peak', 'continuous': True,
+            'start': 40.0 + part}, numpy.zeros(50))
+    (tmp_path / 'run0003' / 'part0000.mapic.index.npy').write_bytes(b'')     # left by a RunReader
+    (tmp_path / 'ADC_count0004.txt').write_text('1\n')
+    (tmp_path / 'notes.txt').write_text('not a run')
+
+    catalog = MAPIC_catalog.RunCatalog(str(tmp_path / MAPIC_catalog.CATALOG_NAME))
+    runs = {record['run']: record for record in catalog.query()}
+    assert sorted(runs) == [0, 1, 2, 3, 4]
+    assert runs[0]['events'] == 100 and runs[0]['gainpos'] == 134 and runs[0]['start'] == 10.0
+    assert runs[1]['events'] == 2*4096 and runs[1]['format'] == 'histogram'
+    assert runs[2]['events'] is None            # not peak records
+    assert runs[3]['format'] == 'continuous' and runs[3]['events'] == 50 and len(runs[3]['paths']) == 2
+    assert runs[3]['start'] == 40.0
+    assert runs[4]['format'] == 'text'
+    assert catalog.next_run('run') == 5
+
+def test_apic_numbers_runs_from_the_catalog(connect):
+    apic, sim = connect()
+    apic.start_peak_find(2000, save=True).join()
+    apic.finish_peak_find()
+    record = apic.catalog.get(apic.runprefix, 0)
+    assert record['events'] == len(apic.data) and record['end'] is not None
+    assert record['stats']['peaks_lost'] == 0
+    assert abs(record['stats']['centroid'] - 2480) < 20
+    assert apic.raw_dat_count == 1
+    again, sim = connect()                      # a new session carries on from the catalog
+    assert again.raw_dat_count == 1
@@ -0,0 +1,56 @@
+import numpy
+
+import MAPIC_functions as MAPIC
+import MAPIC_runfile
+
+DELTA_MAX = (1 << MAPIC.DELTA_BITS) - 1           # longest gap of one compact word, as in peakfind.h
+
+def compact_words(time_us, adc, last_us):
+    '''Encode peaks as the words of one STREAM_COMPACT packet, as AddCompactPeak in peakfind.c.'''
+    words = []
+    for t, a in zip(time_us, adc):
+        delta = t - last_us
+        while delta > DELTA_MAX:
+            high = min(delta >> MAPIC.DELTA_BITS, DELTA_MAX)
+            words.append(high << 12)            # escape word, adc 0
+            delta -= high << MAPIC.DELTA_BITS
+        words.append((delta << 12) | a)
+        last_us = t
+    return words
+
+def test_decode_compact_with_escape_words():
+    rng = numpy.random.RandomState(0)
+    gaps = rng.exponential(100, 300).astype('int64')
+    gaps[[10, 50, 51]] = [DELTA_MAX + 1, 5*10**6, 3*10**11]     # gaps needing one or two escape words
+    time_us = 1000 + numpy.cumsum(gaps)
+    adc = rng.randint(600, 4096, len(time_us))
+    packets = [(0, 100), (100, 200), (200, 300)]
+    words, bases, lengths = [], [], []
+    for start, end in packets:
+        base = 0 if start == 0 else int(time_us[start - 1])
+        packet = compact_words(time_us[start:end], adc[start:end], base)
+        words += packet
+        bases.append(base)
+        lengths.append(len(packet))
+    assert sum(lengths) > 300                   # escape words were needed
+
+    data, decoded = MAPIC.decode_compact(numpy.array(words, dtype='uint32'), bases, numpy.array(lengths))
+    assert numpy.array_equal(data, adc)
+    assert numpy.array_equal(decoded, time_us)
+
+    # without the middle packet, the last one still decodes from the base time in its header
+    keep = numpy.r_[0:lengths[0], lengths[0] + lengths[1]:sum(lengths)]
+    data, decoded = MAPIC.decode_compact(numpy.array(words, dtype='uint32')[keep], [bases[0], bases[2]],
+        numpy.array([lengths[0], lengths[2]]))
+    assert numpy.array_equal(decoded, numpy.r_[time_us[:100], time_us[200:]])
+
+def test_compact_run_matches_the_peak_records(connect):
+    apic, sim = connect()
+    apic.start_peak_find(20000, compact=True, save=True).join()
+    apic.finish_peak_find()
+    assert len(apic.data) >= 20000
+    assert (numpy.diff(apic.data_time) >= 0).all()
+    header, words = MAPIC_runfile.load_run(apic.runpath(0))     # saved as 8 byte peak records
+    adc, time_us = MAPIC.decode_peaks(words)
+    assert numpy.array_equal(adc, apic.data)
+    assert numpy.array_equal(time_us, apic.data_time)
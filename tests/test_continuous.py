@@ -0,0 +1,104 @@
+import os
+import time
+
+import numpy
+import pytest
+
+import MAPIC_analysis
+import MAPIC_functions as MAPIC
+import MAPIC_runfile
+import MAPIC_sim
+from conftest import exported
+
+def run_for(apic, seconds, **kwargs):
+    '''Take a continuous run for about seconds and finish it.'''
+    receiver = apic.start_continuous(**kwargs)
+    time.sleep(seconds)
+    apic.stop_peak_find()
+    apic.finish_peak_find()
+    return receiver
+
+def part_peaks(paths):
+    return sum(len(MAPIC_runfile.load_run(path)[1])//2 for path in paths)
+
+def test_parts_rotate_and_hold_every_peak(connect):
+    apic, sim = connect(rate=50000)
+    receiver = run_for(apic, 0.6, save=True, spillbytes=64*1024)
+    assert len(receiver.parts) > 1
+    assert os.path.dirname(receiver.parts[0]) == os.path.join('histdata', 'run0000')
+    assert part_peaks(receiver.parts) == apic.hist.total() == receiver.stats()['peaks']
+    record = apic.catalog.get(apic.runprefix, 0)
+    assert record['format'] == 'continuous' and record['events'] == apic.hist.total()
+    assert record['paths'] == receiver.parts and apic.raw_dat_count == 1
+
+def test_run_ending_right_after_a_part_rotation(connect):
+    '''With spillbytes of one record every spill closes its part, so the run ends with no part open.'''
+    apic, sim = connect(rate=20000)
+    receiver = run_for(apic, 0.4, save=True, spillbytes=8)
+    assert receiver.writer is None
+    assert apic.raw_dat_count == 1
+    record = apic.catalog.get(apic.runprefix, 0)
+    assert record['end'] is not None and record['events'] == apic.hist.total() > 0
+    run_for(apic, 0.2, save=True, spillbytes=8)     # the next run takes the next number and folder
+    assert apic.raw_dat_count == 2 and os.path.isdir(os.path.join('histdata', 'run0001'))
+
+def test_resume_carries_on_the_same_run(connect):
+    apic, sim = connect(rate=50000)
+    first = run_for(apic, 0.4, save=True)
+    peaks = apic.hist.total()
+    second = run_for(apic, 0.4, resume=True)
+    assert apic.raw_dat_count == 1              # the run kept its number
+    assert second.directory == first.directory and len(second.parts) == len(first.parts) + 1
+    assert apic.hist.total() > peaks
+    assert part_peaks(second.parts) == apic.hist.total() == second.stats()['peaks']
+    assert apic.catalog.get(apic.runprefix, 0)['events'] == apic.hist.total()
+
+def test_keep_deletes_the_oldest_parts(connect):
+    apic, sim = connect(rate=50000)
+    receiver = run_for(apic, 0.6, save=True, spillbytes=16*1024, keep=2)
+    assert len(receiver.parts) == 2
+    assert sorted(os.listdir(receiver.directory)) == sorted(os.path.basename(path) for path in receiver.parts)
+    assert receiver.part > 2                    # older parts were written and deleted
+
+def test_memory_stays_within_the_window(connect):
+    apic, sim = connect(rate=100000)
+    receiver = run_for(apic, 0.5, save=False, window=1000)
+    adc, time_us = receiver.decode()
+    assert len(adc) == 1000 < apic.hist.total()
+    assert (numpy.diff(time_us) >= 0).all()     # the latest peaks, oldest first
+    assert receiver.buffer.nbytes < 2*1024*1024
+
+def test_export_of_a_resumed_continuous_run(connect):
+    apic, sim = connect(rate=20000)
+    run_for(apic, 0.3, save=True, spillbytes=16*1024)
+    run_for(apic, 0.3, resume=True)
+    apic.export_text(0)
+    adc, time_us = exported(apic, 0)
+    reader = apic.open_run(0)
+    assert len(adc) == len(reader) == apic.hist.total() > 0
+    assert numpy.array_equal(adc, reader.decode()[0])
+    assert numpy.array_equal(time_us, reader.decode()[1])
+
+def headers(*seqs):
+    '''Return the stream headers of packets seqs of 10 peaks each.'''
+    seq = numpy.array(seqs, dtype='int64')
+    return numpy.column_stack((seq, numpy.full(len(seq), 10), 10*seq, numpy.zeros(len(seq), dtype='int64')))
+
+def test_packets_received_again_after_a_spill_are_duplicates():
+    receiver = MAPIC.ContinuousReceiver(None, MAPIC_analysis.Histogram(), MAPIC_analysis.RateMonitor())
+    receiver.account(headers(0, 2, 3))
+    receiver.account(headers(3, 1, 4))          # 3 again, 1 late
+    stats = receiver.account(headers(1, 5), final=True)
+    assert stats['packets'] == 8 and stats['packets_duplicate'] == 2
+    assert stats['packets_lost'] == 0 and stats['first_lost_packet'] is None
+    assert stats['peaks'] == stats['peaks_sent'] == 60
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_stop_sends_the_last_partial_packet(connect, compact):
+    '''The board sends packets once full, and the peaks of the last one when stopped.'''
+    apic, sim = connect(rate=2000)
+    receiver = run_for(apic, 0.5, save=False, compact=compact)
+    stats = receiver.stats()
+    assert stats['peaks_lost'] == 0 and stats['packets_lost'] == 0
+    assert apic.hist.total() == stats['peaks_sent']
+    assert apic.hist.total() % (MAPIC_sim.SEND_COMPACT if compact else MAPIC_sim.SEND_PEAKS) != 0
@@ -0,0 +1,74 @@
+import asyncio
+import concurrent.futures
+import socket
+
+import pytest
+
+import MAPIC_control
+import MAPIC_sim
+
+def count_calls(sim, command):
+    '''Wrap the handler of command on sim to count how many times the board runs it.'''
+    calls = []
+    handler = sim.commands[command]
+
+    def counted(addr, args):
+        calls.append(args)
+        return handler(addr, args)
+
+    sim.commands[command] = counted
+    return calls
+
+def test_a_retry_gets_the_cached_reply(board):
+    sim = board()
+    calls = count_calls(sim, bytes([1, 0]))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2)
+        datagram = MAPIC_control.request(1, 0, 7, bytes([99]))
+        replies = []
+        for attempt in range(2):                # as a resend after the first reply was lost
+            sock.sendto(datagram, sim.sock.getsockname())
+            replies.append(MAPIC_control.parse_reply(sock.recv(1500)))
+    assert replies[0] == replies[1] == (1, 0, 7, MAPIC_control.ACK_OK, b'')
+    assert len(calls) == 1                      # the board ran the command once
+
+def test_commands_survive_lost_requests(connect):
+    apic, sim = connect(cmdloss=0.3)            # seeded, every command gets through within its retries
+    for gainpos in range(100, 120):
+        apic.apply_profile(gainpos, 128, 1)
+        assert apic.posGAIN == gainpos
+    assert sim.pots[MAPIC_sim.I2C_GAIN] == 119 and sim.polarity == 1
+
+def test_unknown_command_raises(connect):
+    apic, sim = connect()
+    with pytest.raises(ValueError):
+        apic.command(99, 0)
+
+def test_no_reply_raises_after_the_retries(connect):
+    apic, sim = connect()
+    sim.cmdloss = 1.0
+    with pytest.raises(socket.timeout):
+        apic.setpolarity(1)
+
+def test_commands_from_several_threads(connect):
+    apic, sim = connect()
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        replies = list(pool.map(lambda i: apic.peak_rejected(), range(20)))
+    assert all(reply == replies[0] for reply in replies)
+
+def test_asyncio_client_runs_queries_at_once(board):
+    sim = board(cmdloss=0.2)
+
+    async def session():
+        client = await MAPIC_control.ControlClient.connect(sim.sock.getsockname(), port=0)
+        try:
+            profile = await client.apply_profile(120, 130, 1)
+            queries = await asyncio.gather(client.read_i2c(), client.check_state(), client.udp_stats())
+        finally:
+            client.close()
+        return profile, queries
+
+    profile, (pots, state, udp) = asyncio.run(session())
+    assert profile == (120, 130, 1, 0)
+    assert pots == (120, 130)
+    assert isinstance(state, str) and len(udp) == 3
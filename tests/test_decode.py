@@ -0,0 +1,42 @@
+import numpy
+
+import MAPIC_functions as MAPIC
+import MAPIC_runfile
+from conftest import board_words
+
+WRAP_US = 1 << 20                               # the 20 bit time_us of a peak record wraps after this many us
+
+def test_encode_decode_round_trip_past_the_20_bit_wrap():
+    rng = numpy.random.RandomState(0)
+    n = MAPIC.DECODE_BLOCK + 5000               # more than one decode block
+    time_us = numpy.cumsum(rng.randint(0, 300000, n)).astype('int64')
+    assert time_us[-1] > 100*WRAP_US
+    adc = rng.randint(0, 4096, n).astype('uint16')
+    data, decoded = MAPIC.decode_peaks(MAPIC.encode_peaks(adc, time_us))
+    assert data.dtype == numpy.dtype('uint16') and decoded.dtype == numpy.dtype('int64')
+    assert numpy.array_equal(data, adc)
+    assert numpy.array_equal(decoded, time_us)
+
+def test_board_times_are_unwrapped_across_both_clock_wraps():
+    rng = numpy.random.RandomState(1)
+    time_us = numpy.cumsum(rng.randint(0, 400000, 2000)).astype('int64')   # about 400 s, 20 cycle counter wraps
+    data, decoded = MAPIC.decode_peaks(board_words(time_us))
+    assert (data == 1000).all()
+    assert numpy.abs(decoded - time_us).max() <= 1
+
+def test_a_run_decoded_in_pieces_matches_the_whole_run():
+    time_us = numpy.arange(0, 45*10**6, 1000, dtype='int64')               # 45 s in 1 ms steps
+    words = board_words(time_us)
+    whole = MAPIC.decode_peaks(words)[1]
+    clock = MAPIC_runfile.BoardClock()
+    pieces = [MAPIC.decode_peaks(words[start:start + 2*777], clock)[1] for start in range(0, len(words), 2*777)]
+    assert numpy.array_equal(numpy.concatenate(pieces), whole)
+    state = MAPIC_runfile.BoardClock(clock.state())                        # as saved in the header of a part
+    assert abs(int(MAPIC.decode_peaks(board_words([45*10**6]), state)[1][0]) - 45*10**6) <= 1
+
+def test_decode_of_a_buffer_view_leaves_it_untouched():
+    words = MAPIC.encode_peaks(numpy.arange(1, 11, dtype='uint16'), numpy.arange(10, dtype='int64')*10**6)
+    before = words.copy()
+    MAPIC.decode_peaks(words[:8])
+    assert numpy.array_equal(words, before)
+    assert len(MAPIC.decode_peaks(words[:0])[0]) == 0
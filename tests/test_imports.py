@@ -0,0 +1,19 @@
+import json
+
+import MAPIC_bench
+import MAPIC_functions as MAPIC
+
+def test_the_core_imports_within_budget_without_gui_modules():
+    seconds, loaded = MAPIC_bench.import_time(repeat=3)
+    assert loaded == []                         # no tkinter, matplotlib or scipy
+    assert seconds < MAPIC_bench.IMPORT_BUDGET
+
+def test_load_config_writes_the_defaults_the_first_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(MAPIC, 'default', dict(MAPIC.DEFAULTS))
+    path = tmp_path / 'MAPIC_config.json'
+    assert MAPIC.load_config(str(path)) == MAPIC.DEFAULTS
+    assert json.loads(path.read_text()) == MAPIC.DEFAULTS
+
+    path.write_text(json.dumps({'bins': 80}))   # settings saved before a setting was added keep its default
+    config = MAPIC.load_config(str(path))
+    assert config['bins'] == 80 and config['peakfinder'] == MAPIC.DEFAULTS['peakfinder']
@@ -0,0 +1,72 @@
+import socket
+
+import numpy
+import pytest
+
+import MAPIC_functions as MAPIC
+
+COUNT = 180                                     # peaks in every packet
+
+@pytest.fixture
+def receiver():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        yield MAPIC.PeakStreamReceiver(sock, 100000, 1)
+
+def arrive(receiver, seqs):
+    '''Add the headers of the packets seqs to receiver as if they had been received, in that order.'''
+    for seq in seqs:
+        receiver.headers += numpy.array([seq, COUNT, seq*COUNT, MAPIC.STREAM_PEAKS], dtype='uint32').tobytes()
+        receiver.boardpeaks = max(receiver.boardpeaks, (seq + 1)*COUNT)
+
+def test_no_loss(receiver):
+    arrive(receiver, range(10))
+    stats = receiver.stats()
+    assert stats['packets'] == stats['packets_sent'] == 10
+    assert stats['packets_lost'] == stats['peaks_lost'] == stats['packets_reordered'] == 0
+    assert stats['first_lost_packet'] is None and stats['first_lost_peak'] is None
+
+def test_lost_duplicate_and_reordered_packets(receiver):
+    arrive(receiver, [0, 1, 3, 2, 5, 5, 6])
+    stats = receiver.stats()
+    assert stats['packets'] == 7 and stats['packets_sent'] == 7
+    assert stats['packets_lost'] == 1 and stats['first_lost_packet'] == 4
+    assert stats['first_lost_peak'] == 4*COUNT
+    assert stats['packets_duplicate'] == 1 and stats['packets_reordered'] == 1
+    assert stats['peaks'] == 6*COUNT and stats['peaks_lost'] == COUNT
+
+def test_first_packet_lost(receiver):
+    arrive(receiver, [1, 2])
+    stats = receiver.stats()
+    assert stats['first_lost_packet'] == 0 and stats['first_lost_peak'] == 0
+
+def test_counts_carry_over_between_calls(receiver):
+    '''stats only looks at the packets since its last call, the totals must be the same as in one call.'''
+    order = [0, 2, 1, 1, 4, 3, 7, 8, 8, 10]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        once = MAPIC.PeakStreamReceiver(sock, 100000, 1)
+    arrive(once, order)
+    for i, seq in enumerate(order):
+        arrive(receiver, [seq])
+        if i % 3 == 0:
+            receiver.stats()
+    assert receiver.stats() == once.stats()
+
+def test_a_late_packet_is_not_lost(receiver):
+    arrive(receiver, [0, 2])
+    assert receiver.stats()['packets_lost'] == 1
+    arrive(receiver, [1, 3])
+    stats = receiver.stats()
+    assert stats['packets_lost'] == 0 and stats['first_lost_packet'] is None
+
+def test_losses_of_a_simulated_stream(connect):
+    apic, sim = connect(loss=0.05, reorder=0.05, seed=3)
+    apic.start_peak_find(50000, save=False).join()
+    apic.finish_peak_find()
+    stats = apic.stream_stats()
+    assert sim.dropped > 0 and sim.reordered > 0
+    # a dropped last packet is never known to have been sent
+    assert sim.dropped - 1 <= stats['packets_lost'] <= sim.dropped
+    assert stats['packets'] + stats['packets_lost'] == stats['packets_sent']
+    assert stats['packets_reordered'] == sim.reordered
+    assert stats['peaks'] == len(apic.data)
+    assert stats['peaks_lost'] == stats['peaks_sent'] - stats['peaks']
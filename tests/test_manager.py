@@ -0,0 +1,45 @@
+import socket
+
+import pytest
+
+import MAPIC_manager
+from conftest import free_port
+
+@pytest.fixture
+def manager(workdir, board):
+    '''Return a function making a BoardManager of the given boards, closed after the test.'''
+    managers = []
+
+    def start(boards):
+        port, dmaport = free_port(), free_port()
+        managers.append(MAPIC_manager.BoardManager(2, boards, port, dmaport))
+        return managers[-1]
+
+    yield start
+    for manager in managers:
+        manager.close()
+        for apic in manager.devices:
+            apic.catalog.close()
+
+def test_peak_find_on_two_boards(manager, board):
+    sims = [board(rate=50000, seed=1), board(rate=50000, seed=2)]
+    boards = manager([sim.sock.getsockname() for sim in sims])
+    boards.setdest()
+    boards.peak_find(20000)
+    assert all(len(apic.data) >= 20000 for apic in boards.devices)
+    assert boards.hist.total() == sum(apic.hist.total() for apic in boards.devices)
+    assert all(stats['peaks_lost'] == 0 for stats in boards.stream_stats())
+
+def test_an_unreachable_board_stops_the_ones_that_started(manager, board):
+    sim = board(rate=50000)
+    boards = manager([sim.sock.getsockname(), ('127.0.0.1', free_port())])     # nothing answers the second
+    boards.devices[0].setdest()
+    with pytest.raises(socket.timeout):
+        boards.start_peak_find(10**7)
+    assert sim.streamstop.is_set() and not sim.stream.is_alive()     # stopped, not left streaming 10**7 peaks
+    assert len(boards.selector.get_map()) == 0
+    assert all(apic.receiver.writer.fp.closed for apic in boards.devices)
+
+    with pytest.raises(socket.timeout):         # the sockets were released, so the next run can register them
+        boards.start_peak_find(10**7)
+    assert len(boards.selector.get_map()) == 0
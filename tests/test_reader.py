@@ -0,0 +1,124 @@
+import os
+import time
+
+import numpy
+import pytest
+
+import MAPIC_functions as MAPIC
+import MAPIC_runfile
+from conftest import board_words
+
+def write_peaks(path, adc, time_us, chunk=1000, header=None):
+    '''Write peaks to a peak run file in chunks of chunk records, as a receiver flushes them.'''
+    words = MAPIC.encode_peaks(numpy.asarray(adc, dtype='uint32'), numpy.asarray(time_us, dtype='int64'))
+    writer = MAPIC_runfile.RunWriter(str(path), dict({'format': 'peak'}, **(header or {})), 'uint32')
+    for start in range(0, len(words), 2*chunk):
+        writer.write(words[start:start + 2*chunk])
+    writer.close()
+    return str(path)
+
+@pytest.fixture
+def peaks():
+    rng = numpy.random.RandomState(0)
+    time_us = numpy.cumsum(rng.randint(1, 200, 20000)).astype('int64')
+    adc = rng.randint(600, 4096, 20000).astype('uint16')
+    return adc, time_us
+
+def test_decode_matches_load_run(tmp_path, peaks):
+    path = write_peaks(tmp_path / 'run0000.mapic', *peaks)
+    reader = MAPIC_runfile.RunReader(path)
+    adc, time_us = MAPIC.decode_peaks(MAPIC_runfile.load_run(path)[1])
+    assert len(reader) == len(adc)
+    assert reader.bounds() == (time_us[0], time_us[-1])
+    data, times = reader.decode()
+    assert numpy.array_equal(data, adc) and numpy.array_equal(times, time_us)
+    data, times = reader.decode(1500, 7300)     # across chunks
+    assert numpy.array_equal(data, adc[1500:7300]) and numpy.array_equal(times, time_us[1500:7300])
+
+def test_time_spans_match_a_mask(tmp_path, peaks):
+    adc, time_us = peaks
+    reader = MAPIC_runfile.RunReader(write_peaks(tmp_path / 'run0000.mapic', adc, time_us))
+    for t0, t1 in [(None, None), (0, 10), (time_us[5000], time_us[5000] + 1), (123456, 987654),
+            (time_us[-1], None), (time_us[-1] + 1, None), (None, time_us[0])]:
+        mask = numpy.ones(len(time_us), dtype=bool)
+        if t0 is not None:
+            mask &= time_us >= t0
+        if t1 is not None:
+            mask &= time_us < t1
+        data, times = reader.read(t0, t1)
+        assert numpy.array_equal(data, adc[mask]) and numpy.array_equal(times, time_us[mask])
+        hist = reader.histogram(t0, t1)
+        assert numpy.array_equal(hist.counts, numpy.bincount(adc[mask], minlength=4096))
+
+def test_the_index_is_written_once_and_rebuilt_when_the_run_changes(tmp_path, peaks):
+    adc, time_us = peaks
+    path = write_peaks(tmp_path / 'run0000.mapic', adc, time_us)
+    MAPIC_runfile.RunReader(path)
+    index = path + MAPIC_runfile.INDEX_SUFFIX
+    assert numpy.array_equal(numpy.load(index), time_us)
+    written = os.path.getmtime(index)
+    MAPIC_runfile.RunReader(path)
+    assert os.path.getmtime(index) == written   # reused
+
+    time.sleep(0.01)
+    write_peaks(path, adc[:100], time_us[:100] + 5)
+    reader = MAPIC_runfile.RunReader(path)
+    assert len(reader) == 100 and numpy.array_equal(reader.decode()[1], time_us[:100] + 5)
+
+def test_wrapped_board_times_are_unwrapped(tmp_path, peaks):
+    adc, time_us = peaks
+    time_us = time_us*200                       # a run of about 3 minutes, both board clock wraps many times
+    words = board_words(time_us, adc)
+    writer = MAPIC_runfile.RunWriter(str(tmp_path / 'run0000.mapic'), {'format': 'peak'}, 'uint32')
+    for start in range(0, len(words), 2000):
+        writer.write(words[start:start + 2000])
+    writer.close()
+    reader = MAPIC_runfile.RunReader(str(tmp_path / 'run0000.mapic'))
+    assert numpy.abs(reader.decode()[1] - time_us).max() <= 1
+
+def test_a_part_is_read_alone_from_the_clock_in_its_header(tmp_path, peaks):
+    adc, time_us = peaks
+    time_us = time_us*200
+    words = board_words(time_us, adc)
+    clock = MAPIC_runfile.BoardClock()
+    clock.times(words[:20000].view(MAPIC_runfile.PEAK_DTYPE))  # the part before, deleted by keep
+    writer = MAPIC_runfile.RunWriter(str(tmp_path / 'part0001.mapic'), {'format': 'peak', 'clock': clock.state()},
+        'uint32')
+    writer.write(words[20000:])
+    writer.close()
+    reader = MAPIC_runfile.RunReader(str(tmp_path / 'part0001.mapic'))
+    assert numpy.abs(reader.decode()[1] - time_us[10000:]).max() <= 1
+
+def test_compressed_runs_must_be_recoded(tmp_path, peaks):
+    path = write_peaks(tmp_path / 'run0000.mapic', *peaks)
+    MAPIC_runfile.recode_run(path, str(tmp_path / 'run0001.mapic'), 'zlib')
+    with pytest.raises(ValueError):
+        MAPIC_runfile.RunReader(str(tmp_path / 'run0001.mapic'))
+    MAPIC_runfile.recode_run(str(tmp_path / 'run0001.mapic'), str(tmp_path / 'run0002.mapic'))
+    reader = MAPIC_runfile.RunReader(str(tmp_path / 'run0002.mapic'))
+    assert numpy.array_equal(reader.decode()[0], peaks[0])
+
+def test_parts_of_a_resumed_run_follow_each_other(tmp_path, peaks):
+    adc, time_us = peaks
+    os.mkdir(tmp_path / 'run0000')
+    write_peaks(tmp_path / 'run0000' / 'part0000.mapic', adc[:10000], time_us[:10000])
+    write_peaks(tmp_path / 'run0000' / 'part0001.mapic', adc[10000:], time_us[10000:])     # rotated, same clock
+    write_peaks(tmp_path / 'run0000' / 'part0002.mapic', adc[:5000], time_us[:5000])       # resumed, clock restarted
+    reader = MAPIC_runfile.RunReader(str(tmp_path / 'run0000'))
+    assert len(reader) == 25000
+    data, times = reader.decode()
+    assert numpy.array_equal(times[:20000], time_us)
+    assert numpy.array_equal(times[20000:], time_us[:5000] - time_us[0] + time_us[-1])
+    assert numpy.array_equal(data, numpy.r_[adc, adc[:5000]])
+    start, stop = reader.span(time_us[-1] + 1, None)
+    assert stop - start == 4999
+
+def test_open_run_reads_a_saved_run(connect):
+    apic, sim = connect()
+    apic.start_peak_find(20000, save=True).join()
+    apic.finish_peak_find()
+    reader = apic.open_run(0)
+    adc, time_us = reader.decode()
+    assert numpy.array_equal(adc, apic.data) and numpy.array_equal(time_us, apic.data_time)
+    fit = reader.fit((2300, 2700), 1, 'ADU', time_us[len(time_us)//2], None)
+    assert abs(fit['lines'][0]['centroid'] - 2480) < 5
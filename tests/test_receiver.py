@@ -0,0 +1,50 @@
+import socket
+
+import numpy
+import pytest
+
+import MAPIC_functions as MAPIC
+import MAPIC_sim
+
+def test_buffer_holds_the_run_and_one_more_datagram():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        receiver = MAPIC.PeakStreamReceiver(sock, 1000, 1)
+    assert receiver.buffer.nbytes == 1000*MAPIC.PEAK_BYTES + MAPIC.MAX_PAYLOAD_SIZE
+    assert receiver.buffer.dtype == numpy.dtype('uint32')
+
+def test_adc_peak_find_receives_the_requested_peaks(connect):
+    apic, sim = connect()
+    apic.adc_peak_find(20000)
+    assert len(apic.data) >= 20000
+    assert len(apic.data) == len(apic.data_time) == apic.receiver.peaks
+    assert apic.data.min() > MAPIC_sim.PP_THR and apic.data.max() < 4096
+    assert (numpy.diff(apic.data_time) >= 0).all()
+
+def test_start_peak_find_receives_on_its_own_thread(connect):
+    apic, sim = connect(rate=20000)
+    receiver = apic.start_peak_find(20000, save=False)
+    assert receiver.is_alive()                  # returns at once, the run takes about a second
+    receiver.join(0.3)
+    apic.update_histogram()
+    assert 0 < apic.hist.total() < 20000        # partial results while the run is going
+    receiver.join()
+    apic.finish_peak_find()
+    assert apic.hist.total() == len(apic.data) >= 20000
+
+def test_stop_peak_find_keeps_the_peaks_received(connect):
+    apic, sim = connect(rate=20000)
+    receiver = apic.start_peak_find(10**7, save=False)
+    receiver.join(0.3)
+    apic.stop_peak_find()
+    apic.finish_peak_find()
+    assert not receiver.is_alive()
+    assert 0 < len(apic.data) < 10**7
+
+def test_a_silent_board_ends_the_run_with_a_timeout(connect):
+    apic, sim = connect(tout=0.5, loss=1.0)
+    receiver = apic.start_peak_find(1000, save=False)
+    receiver.join(5)
+    assert not receiver.is_alive()
+    assert isinstance(receiver.error, socket.timeout)
+    with pytest.raises(socket.timeout):
+        apic.finish_peak_find()
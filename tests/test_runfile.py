@@ -0,0 +1,61 @@
+import numpy
+import pytest
+
+import MAPIC_functions as MAPIC
+import MAPIC_runfile
+from conftest import exported
+
+@pytest.mark.parametrize('codec', [None] + sorted(MAPIC_runfile.CODECS))
+def test_chunks_read_back_with_every_codec(tmp_path, codec):
+    path = str(tmp_path / 'run0000.mapic')
+    words = numpy.arange(10000, dtype='uint32')
+    writer = MAPIC_runfile.RunWriter(path, {'format': 'peak', 'gainpos': 134}, 'uint32', codec)
+    for start in range(0, len(words), 3000):
+        writer.write(words[start:start + 3000])
+    writer.write(words[:0])                     # empty chunks are not written
+    writer.close()
+
+    header, loaded = MAPIC_runfile.load_run(path)
+    assert header['gainpos'] == 134 and header['codec'] == codec
+    assert numpy.array_equal(loaded, words)
+    assert MAPIC_runfile.scan_run(path)[1] == words.nbytes
+
+def test_a_chunk_cut_short_is_ignored(tmp_path):
+    path = str(tmp_path / 'run0000.mapic')
+    writer = MAPIC_runfile.RunWriter(path, {}, 'uint32')
+    writer.write(numpy.arange(100, dtype='uint32'))
+    writer.write(numpy.arange(100, dtype='uint32'))
+    writer.close()
+    with open(path, 'r+b') as fp:
+        fp.truncate(fp.seek(0, 2) - 10)         # as a crash while writing the last chunk
+    header, loaded = MAPIC_runfile.load_run(path)
+    assert numpy.array_equal(loaded, numpy.arange(100, dtype='uint32'))
+    assert MAPIC_runfile.scan_run(path)[1] == 400
+
+def test_not_a_run_file(tmp_path):
+    path = tmp_path / 'data.txt'
+    path.write_text('1 2 3')
+    with pytest.raises(ValueError):
+        MAPIC_runfile.load_run(str(path))
+
+def test_saved_run_holds_the_peaks_received(connect):
+    apic, sim = connect()
+    apic.start_peak_find(20000, save=True).join()
+    apic.finish_peak_find()
+    header, words = MAPIC_runfile.load_run(apic.runpath(0))
+    assert header['format'] == 'peak' and header['polarity'] == apic.polarity
+    adc, time_us = MAPIC.decode_peaks(words)
+    assert numpy.array_equal(adc, apic.data)
+    assert numpy.array_equal(time_us, apic.data_time)
+    assert apic.raw_dat_count == 1
+
+@pytest.mark.parametrize('codec', [None, 'zlib'])
+def test_export_text_of_a_saved_run(connect, monkeypatch, codec):
+    monkeypatch.setitem(MAPIC.default, 'codec', codec)
+    apic, sim = connect(rate=50000)
+    apic.adc_peak_find(20000)
+    apic.export_text(0)
+    adc, time_us = exported(apic, 0)
+    assert numpy.array_equal(adc, apic.data) and numpy.array_equal(time_us, apic.data_time)
+    assert apic.runfiles(0) == [apic.runpath(0)]
+    assert 'histdata/ADC_count0000.txt' in apic.catalog.get(apic.runprefix, 0)['paths']
@@ -0,0 +1,25 @@
+import numpy
+
+import MAPIC_runfile
+
+def test_peak_records_carry_the_board_clock(connect):
+    apic, sim = connect(rate=20000, speed=4)
+    apic.adc_peak_find(40000)                   # 2 s of stream, past the first 2^20 us wrap
+    records = apic.receiver.received(2).view(MAPIC_runfile.PEAK_DTYPE)
+    assert (records['time_s'] == 0).all()
+    assert ((records['packed'] >> 12) < MAPIC_runfile.WRAP_US).all()
+    assert (numpy.diff((records['packed'] >> 12).astype('int64')) < -MAPIC_runfile.WRAP_US//2).sum() >= 1
+    assert (numpy.diff(apic.data_time) >= 0).all()
+    assert apic.data_time[-1] > MAPIC_runfile.WRAP_US
+
+def test_times_and_rate_run_through_the_cycle_counter_wrap(connect):
+    apic, sim = connect(rate=2000, speed=100)
+    apic.adc_peak_find(50000)                   # 25 s of stream, past the 19.88 s cycle counter wrap
+    intervals = numpy.diff(apic.data_time)
+    assert apic.data_time[-1] > (1 << 32)/MAPIC_runfile.CLOCK_MHZ
+    assert (intervals >= 0).all()
+    assert intervals.max() < 20000              # no jump where the cycle counter wrapped
+    assert abs(apic.rate.stats()['mean'] - 2000) < 100
+
+    reader = apic.open_run(apic.raw_dat_count - 1)
+    assert numpy.array_equal(reader.decode()[1], apic.data_time)
@@ -0,0 +1,15 @@
+import MAPIC_sim
+import MAPIC_sweep
+
+def test_each_point_is_taken_at_its_own_profile(connect):
+    '''The next profile is applied while a point is analysed, never while it acquires.'''
+    apic, sim = connect(rate=50000)
+    gains = [120, 134, 150]
+    sweep = MAPIC_sweep.Sweep(apic, MAPIC_sweep.grid(gains, [128]), maxpeaks=20000, tol=0.5, settle=0.05)
+    results = sweep.run()
+    assert sweep.error is None
+    assert [result['gainpos'] for result in results] == gains
+    for gainpos, result in zip(gains, results):
+        assert result['converged'] and result['peaks'] > 0
+        assert abs(result['line_centroid'] - 2480*gainpos/MAPIC_sim.GAIN_POS) < 5
+    assert sim.pots[MAPIC_sim.I2C_GAIN] == gains[-1]